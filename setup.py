@@ -17,6 +17,9 @@ setuptools.setup(
         "PyYAML>=5.4.1",
         "lxml>=4.6.3"
     ],
+    extras_require={
+        "columnar": ["numpy>=1.17"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
     ],
@@ -26,7 +29,10 @@ setuptools.setup(
             'merge-annotations=tinyvoc.merge_annotations:main',
             'prepare-annotations=tinyvoc.prepare_annotations:main',
             'video-to-frame=tinyvoc.video_to_frame:main',
-            'explode-zipped-images=tinyvoc.explode_zipped_images:main'
+            'explode-zipped-images=tinyvoc.explode_zipped_images:main',
+            'tinyvoc-benchmark=tinyvoc.benchmark:main',
+            'tinyvoc-index=tinyvoc.annotationindex:main',
+            'tinyvoc-stats=tinyvoc.datasetstats:main'
         ]
     }
 )
@@ -0,0 +1,93 @@
+"""
+    A fake ffmpeg/ffprobe for the video_to_frame tests: the "video" has N_FRAMES frames at FPS frames per second, every
+    frame is a small png or jpeg that carries its frame number (see frame_number). Only the options used by
+    tinyvoc.video_to_frame are understood.
+"""
+import json
+import math
+import os
+import re
+import struct
+import sys
+import zlib
+
+FPS = 5
+N_FRAMES = 23
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def png_frame(nr: int) -> bytes:
+    # the IDAT data contains "IEND" and a png signature, only the chunk lengths tell where the image ends
+    return (b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", 4, 3, 8, 2, 0, 0, 0))
+            + _png_chunk(b"tEXt", b"frame\x00%d;" % nr) + _png_chunk(b"IDAT", b"IEND\x89PNG\r\n\x1a\n" * (nr % 3))
+            + _png_chunk(b"IEND", b""))
+
+
+def _jpeg_segment(marker: int, data: bytes) -> bytes:
+    return bytes([0xFF, marker]) + struct.pack(">H", len(data) + 2) + data
+
+
+def jpeg_frame(nr: int) -> bytes:
+    # EOI markers in the header segments are skipped by their length, the entropy coded data has stuffed 0xff bytes
+    # and restart markers
+    return (b"\xff\xd8" + _jpeg_segment(0xE0, b"JFIF\x00\xff\xd9\xff\xd8") + _jpeg_segment(0xFE, b"frame %d;" % nr)
+            + _jpeg_segment(0xDB, b"\x00" + bytes(64)) + _jpeg_segment(0xC0, b"\x08\x00\x03\x00\x04\x01\x01\x11\x00")
+            + _jpeg_segment(0xDA, b"\x01\x01\x00\x00\x3f\x00") + b"\x12\xff\x00\x34" * (nr % 4 + 1) + b"\xff\xd0\x56"
+            + b"\xff\xd9")
+
+
+def frame_number(data: bytes) -> int:
+    return int(re.search(rb"frame[\x00 ](\d+);", data).group(1))
+
+
+def ffprobe(argv) -> None:
+    json.dump({"streams": [{"r_frame_rate": "%d/1" % FPS, "nb_frames": str(N_FRAMES)}],
+               "format": {"duration": str(N_FRAMES / FPS)}}, sys.stdout)
+
+
+def ffmpeg(argv) -> None:
+    opts = {}
+    i = 0
+    while i < len(argv):
+        if argv[i] in ("-v", "-ss", "-i", "-vf", "-vsync", "-frames:v", "-f", "-c:v", "-q:v"):
+            opts[argv[i]] = argv[i + 1]
+            i += 2
+        elif argv[i] == "-nostdin":
+            i += 1
+        else:
+            opts["output"] = argv[i]
+            i += 1
+    if not os.path.isfile(opts["-i"]):
+        sys.exit(1)
+    first = int(math.ceil(float(opts.get("-ss", 0)) * FPS))
+    every = 1
+    if "-vf" in opts:
+        every = int(re.fullmatch(r"select=not\(mod\(n\\,(\d+)\)\)", opts["-vf"]).group(1))
+    frames = list(range(first, N_FRAMES, every))[:int(opts.get("-frames:v", N_FRAMES))]
+    if opts["output"] == "-":
+        make = png_frame if opts["-c:v"] == "png" else jpeg_frame
+        for nr in frames:
+            sys.stdout.buffer.write(make(nr))
+    else:
+        # like ffmpeg's image2 muxer, numbered from 1
+        for n, nr in enumerate(frames):
+            with open(opts["output"] % (n + 1), "wb") as f:
+                f.write(png_frame(nr))
+
+
+def install(directory) -> dict:
+    """
+        writes ffmpeg and ffprobe executables to directory, returns their paths
+    """
+    paths = {}
+    for tool in ("ffmpeg", "ffprobe"):
+        path = os.path.join(str(directory), tool)
+        with open(path, "w") as f:
+            f.write("#!%s\nimport sys\nsys.path.insert(0, %r)\nimport fake_ffmpeg\nfake_ffmpeg.%s(sys.argv[1:])\n"
+                    % (sys.executable, os.path.dirname(os.path.abspath(__file__)), tool))
+        os.chmod(path, 0o755)
+        paths[tool] = path
+    return paths
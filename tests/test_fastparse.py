@@ -0,0 +1,212 @@
+"""
+    The fast parser must write the same annotations as the etree parser. Modified annotations are spliced into the original
+    bytes (see tinyvoc.fastparse.splice_annotation), so the outputs are compared (canonicalized) for inputs that are
+    easy to get wrong on the bytes, and for every kind of modification.
+"""
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from tinyvoc.fastparse import size_element, splice_annotation, text_element
+from tinyvoc.objectfilter import ObjectFilter
+from tinyvoc.pvocutils import PascalVocAnnotation
+
+
+def voc_object(name, box=(1, 2, 30, 40), occluded=0, extra=""):
+    return ("<object><name>%s</name><pose>Unspecified</pose><truncated>0</truncated><difficult>0</difficult>"
+            "<occluded>%d</occluded><bndbox><xmin>%d</xmin><ymin>%d</ymin><xmax>%d</xmax><ymax>%d</ymax></bndbox>%s"
+            "</object>") % ((name, occluded) + tuple(box) + (extra,))
+
+
+def voc(objects, header="<folder>f</folder><filename>frame_000001.PNG</filename>"
+                        "<size><width>640</width><height>480</height><depth>3</depth></size>"):
+    return ("<annotation>%s%s</annotation>" % (header, "".join(objects))).encode()
+
+
+PLAIN = voc([voc_object("Car"), voc_object("Pedestrian", (5, 5, 50, 60), 1), voc_object("Car", (100, 100, 120, 130))])
+
+PRETTY = b"""<?xml version="1.0" encoding="utf-8"?>
+<annotation>
+  <folder>f</folder>
+  <filename>frame_000001.PNG</filename>
+  <size>
+    <width>640</width>
+    <height>480</height>
+    <depth>3</depth>
+  </size>
+  <object>
+    <name>Car</name>
+    <occluded>0</occluded>
+    <bndbox><xmin>1</xmin><ymin>2</ymin><xmax>30</xmax><ymax>40</ymax></bndbox>
+  </object>
+  <object>
+    <name>Pedestrian</name>
+    <occluded>1</occluded>
+    <bndbox><xmin>5</xmin><ymin>5</ymin><xmax>50</xmax><ymax>60</ymax></bndbox>
+  </object>
+  <object>
+    <name>Car</name>
+    <occluded>0</occluded>
+    <bndbox><xmin>100</xmin><ymin>100</ymin><xmax>120</xmax><ymax>130</ymax></bndbox>
+  </object>
+</annotation>
+"""
+
+INPUTS = {
+    "plain": PLAIN,
+    "pretty": PRETTY,
+    "no_size": voc([voc_object("Car"), voc_object("Pedestrian")], "<folder /><filename>a.png</filename>"),
+    "no_objects": voc([]),
+    "no_objects_no_size": voc([], "<filename>a.png</filename>"),
+    "comment": PLAIN.replace(b"<filename>", b"<!-- <object><name>X</name></object> --><filename>"),
+    "cdata": PLAIN.replace(b"<name>Pedestrian</name>", b"<name><![CDATA[Pedestrian]]></name>"),
+    # a regex for the objects would end them at the hidden end tags
+    "comment_in_object": PLAIN.replace(b"<name>Pedestrian</name>", b"<name>Pedestrian</name><!-- </object> -->"),
+    "cdata_in_object": PLAIN.replace(b"<name>Pedestrian</name>", b"<name><![CDATA[Ped</object>]]></name>"),
+    "namespace": PLAIN.replace(b"<annotation>", b'<annotation xmlns:cvat="http://cvat.org"><cvat:meta>x</cvat:meta>'),
+    "bom": b"\xef\xbb\xbf" + PRETTY,
+    "utf16": PRETTY.replace(b'encoding="utf-8"', b'encoding="utf-16"').decode().encode("utf-16"),
+    "entities": PLAIN.replace(b"frame_000001.PNG", b"a&amp;b &lt;c&gt; &#233;.png"),
+    "non_ascii": PLAIN.replace(b"<folder>f</folder>", "<folder>map é ü</folder>".encode()),
+    "object_in_text": voc([voc_object("Car", extra="<attributes><attribute><name>n</name><value>&lt;object&gt;</value>"
+                                                   "</attribute></attributes>"), voc_object("Pedestrian")]),
+    "object_tag_prefix": voc([voc_object("Car", extra="<objectid>7</objectid>"), voc_object("Pedestrian")]),
+    "header_after_objects": voc([voc_object("Car"), voc_object("Pedestrian")], "").replace(
+        b"</annotation>", b"<filename>late.png</filename><size><width>1</width><height>1</height><depth>1</depth></size></annotation>"),
+}
+
+
+def set_filename(a, other):
+    a.filename = "000042.PNG"
+
+
+def set_folder_empty(a, other):
+    a.folder = ""
+
+
+def set_size(a, other):
+    a.size = (1920, 1080, 3)
+
+
+def drop_first(a, other):
+    a.objects = a.objects[1:]
+
+
+def drop_last(a, other):
+    a.objects = a.objects[:-1]
+
+
+def drop_all(a, other):
+    a.objects = []
+
+
+def reverse(a, other):
+    a.objects = a.objects[::-1]
+
+
+def rename_and_resize(a, other):
+    a.filename = "renamed.png"
+    a.size = (10, 20, 1)
+    a.objects = a.objects[::2]
+
+
+def relabel(a, other):
+    for o in a.objects:
+        o.name = "X"
+
+
+def add_foreign(a, other):
+    a.objects = a.objects + other.objects[:1]
+
+
+def tree_access(a, other):
+    a.tree.getroot().find("filename").text = "tree.png"
+
+
+EDITS = [set_filename, set_folder_empty, set_size, drop_first, drop_last, drop_all, reverse, rename_and_resize, relabel,
+         add_foreign, tree_access]
+
+
+def written(data, parser, edit, object_filter=None):
+    a = PascalVocAnnotation(data, "a.xml", parser=parser, object_filter=object_filter)
+    other = PascalVocAnnotation(voc([voc_object("Bike", (7, 7, 9, 9))]), "b.xml", parser=parser)
+    if edit is not None:
+        edit(a, other)
+    buf = io.BytesIO()
+    a.write(buf)
+    return buf.getvalue()
+
+
+def canonical(data):
+    return ET.canonicalize(ET.tostring(ET.fromstring(data)), strip_text=True)
+
+
+@pytest.mark.parametrize("name", sorted(INPUTS))
+@pytest.mark.parametrize("edit", [None] + EDITS, ids=lambda e: "unmodified" if e is None else e.__name__)
+def test_fast_writes_the_same_as_etree(name, edit):
+    data = INPUTS[name]
+    assert canonical(written(data, "fast", edit)) == canonical(written(data, "etree", edit))
+
+
+@pytest.mark.parametrize("name", sorted(INPUTS))
+@pytest.mark.parametrize("object_filter", [ObjectFilter(labels=["Car"]), ObjectFilter(occluded="drop"), ObjectFilter(labels=["None"])],
+                         ids=["labels", "occluded", "nothing_left"])
+def test_filtered_fast_writes_the_same_as_etree(name, object_filter):
+    data = INPUTS[name]
+    for edit in (None, set_filename):
+        assert canonical(written(data, "fast", edit, object_filter)) == canonical(written(data, "etree", edit, object_filter))
+
+
+def test_splicing_keeps_the_formatting():
+    out = written(PRETTY, "fast", rename_and_resize)
+    assert out.startswith(b'<?xml version="1.0" encoding="utf-8"?>\n<annotation>\n  <folder>f</folder>\n  <filename>renamed.png</filename>')
+    assert b"\n  <size><width>10</width><height>20</height><depth>1</depth></size>\n  <object>\n    <name>Car</name>" in out
+    # the second object is cut out with its indentation
+    assert b"Pedestrian" not in out
+    assert out.endswith(b"</object>\n</annotation>\n")
+    assert out.count(b"<object>") == 2
+
+
+def test_unmodified_is_a_byte_copy():
+    for data in INPUTS.values():
+        assert written(data, "fast", None) == data
+
+
+def test_splice_header_elements():
+    data = voc([voc_object("Car")])
+    out = splice_annotation(data, {"filename": text_element("filename", "x&y.png"), "size": size_element((1, 2, 3))})
+    assert out == data.replace(b"frame_000001.PNG", b"x&amp;y.png").replace(
+        b"<width>640</width><height>480</height>", b"<width>1</width><height>2</height>")
+
+
+def test_splice_inserts_missing_size():
+    data = voc([voc_object("Car")], "<filename>a.png</filename>")
+    out = splice_annotation(data, {"size": size_element((1, 2, 3))})
+    assert out == data.replace(b"<object>", size_element((1, 2, 3)) + b"<object>", 1)
+    empty = voc([], "<filename>a.png</filename>")
+    assert splice_annotation(empty, {"size": size_element((1, 2, 3))}) == empty.replace(b"</annotation>", size_element((1, 2, 3)) + b"</annotation>")
+
+
+def test_splice_removes_objects():
+    objects = [voc_object("A"), voc_object("B"), voc_object("C")]
+    data = voc(objects)
+    assert splice_annotation(data, {}, [0, 2], 3) == voc([objects[0], objects[2]])
+    assert splice_annotation(data, {}, [], 3) == voc([])
+
+
+@pytest.mark.parametrize("data,elements,kept,n_objects", [
+    (INPUTS["comment"], {"filename": b"<filename>x</filename>"}, None, 0),
+    (INPUTS["cdata"], {}, [0], 3),
+    (INPUTS["utf16"], {"filename": b"<filename>x</filename>"}, None, 0),
+    (b"\xff\xfe" + PLAIN, {}, None, 0),
+    (PRETTY.replace(b'encoding="utf-8"', b'encoding="UTF-32"'), {}, None, 0),
+    (INPUTS["header_after_objects"], {"filename": b"<filename>x</filename>"}, None, 0),
+    (voc([voc_object("A")], "<filename>a</filename><filename>b</filename>"), {"filename": b"<filename>x</filename>"}, None, 0),
+    (voc(["<object><name>A</name><object><name>B</name></object></object>"]), {}, [0], 2),
+    (PLAIN, {}, [0, 1], 4),
+    (PLAIN, {}, [1, 0], 3),
+    (PLAIN, {}, [0, 3], 3),
+])
+def test_splice_refuses_unsafe_input(data, elements, kept, n_objects):
+    assert splice_annotation(data, elements, kept, n_objects) is None
@@ -0,0 +1,53 @@
+"""
+    The indexed image locator must find the same images as the probing one.
+"""
+import os
+
+import pytest
+
+from tinyvoc.pvocutils import ImageLocator, IndexedImageLocator
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "src"
+    for rel in ("a.png", "JPEGImages/b.png", "JPEGImages/sub/c.png", "sub/d.png", "JPEGImages/a.png"):
+        touch(str(root / rel))
+    touch(str(tmp_path / "extra" / "e.png"))
+    touch(str(tmp_path / "elsewhere" / "f.png"))
+    os.makedirs(str(root / "dir.png"))
+    # two links to the same directory, and a link to a file
+    os.symlink(str(tmp_path / "elsewhere"), str(root / "link1"))
+    os.symlink(str(tmp_path / "elsewhere"), str(root / "JPEGImages" / "link2"))
+    os.symlink(str(tmp_path / "elsewhere" / "f.png"), str(root / "JPEGImages" / "g.png"))
+    return tmp_path
+
+
+NAMES = ["a.png", "b.png", "sub/c.png", "c.png", "sub/d.png", "d.png", "e.png", "link1/f.png", "link2/f.png", "f.png",
+         "g.png", "dir.png", "missing.png", "x/../a.png", "./a.png", "../src/a.png", "JPEGImages/b.png"]
+
+
+def test_same_images_as_probing(tree, monkeypatch):
+    monkeypatch.chdir(str(tree))
+    root = str(tree / "src")
+    extra = [str(tree / "extra")]
+    probing = ImageLocator(extra)
+    indexed = IndexedImageLocator(extra)
+    indexed.index_roots([root])
+    for name in NAMES + [os.path.join(root, "a.png"), "src/a.png"]:
+        assert indexed.locate_filename(name, root) == probing.locate_filename(name, root), name
+
+
+def test_only_candidate_directories_are_listed(tree):
+    root = str(tree / "src")
+    indexed = IndexedImageLocator()
+    indexed.index_roots([root])
+    assert sorted(indexed.index) == sorted([root, os.path.join(root, "JPEGImages")])
+    indexed.locate_filename("sub/c.png", root)
+    assert os.path.join(root, "JPEGImages", "sub") in indexed.index
+    assert os.path.join(root, "link1") not in indexed.index
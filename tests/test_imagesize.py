@@ -0,0 +1,229 @@
+"""
+    Image sizes from small fixture headers of every supported format, and clipping or rejecting boxes with ImageValidator.
+"""
+import io
+import os
+import struct
+import time
+import xml.etree.ElementTree as ET
+import zlib
+
+import pytest
+
+from tinyvoc.hashcache import HashCache
+from tinyvoc.imagesize import ImageValidator, probe_image_size
+from tinyvoc.pvocutils import PascalVocAnnotation
+
+
+def jpeg_segment(marker: int, data: bytes) -> bytes:
+    return bytes([0xFF, marker]) + struct.pack(">H", len(data) + 2) + data
+
+
+def jpeg(width: int, height: int, components: int = 3, sof: int = 0xC0, exif: bytes = b"") -> bytes:
+    sof_data = struct.pack(">BHHB", 8, height, width, components) + b"\x01\x11\x00" * components
+    return (b"\xff\xd8" + jpeg_segment(0xE0, b"JFIF\x00\x01\x01") + (jpeg_segment(0xE1, exif) if exif else b"")
+            + jpeg_segment(0xDB, b"\x00" + bytes(64)) + b"\xff\xff" + jpeg_segment(sof, sof_data)
+            + jpeg_segment(0xDA, b"\x01\x01\x00\x00\x3f\x00") + b"\x12\x34\xff\xd9")
+
+
+def png(width: int, height: int, color_type: int) -> bytes:
+    ihdr = b"IHDR" + struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + ihdr + struct.pack(">I", zlib.crc32(ihdr)) + bytes(20)
+
+
+def bmp_core(width: int, height: int, bpp: int) -> bytes:
+    return b"BM" + bytes(12) + struct.pack("<IHHHH", 12, width, height, 1, bpp) + bytes(16)
+
+
+def bmp_info(width: int, height: int, bpp: int) -> bytes:
+    return b"BM" + bytes(12) + struct.pack("<IiiHHI", 40, width, height, 1, bpp, 0) + bytes(30)
+
+
+def riff(chunk: bytes, data: bytes) -> bytes:
+    return b"RIFF" + struct.pack("<I", len(data) + 12) + b"WEBP" + chunk + struct.pack("<I", len(data)) + data
+
+
+def webp_vp8(width: int, height: int) -> bytes:
+    # frame tag, start code, 14 bit sizes with 2 bit scale
+    return riff(b"VP8 ", b"\x50\x02\x00\x9d\x01\x2a" + struct.pack("<HH", width | 0x4000, height | 0x8000) + bytes(10))
+
+
+def webp_vp8l(width: int, height: int) -> bytes:
+    bits = (width - 1) | ((height - 1) << 14) | (1 << 28)
+    return riff(b"VP8L", b"\x2f" + struct.pack("<I", bits) + bytes(10))
+
+
+def webp_vp8x(width: int, height: int, alpha: bool) -> bytes:
+    return riff(b"VP8X", bytes([0x10 if alpha else 0, 0, 0, 0]) + (width - 1).to_bytes(3, "little")
+                + (height - 1).to_bytes(3, "little") + bytes(10))
+
+
+HEADERS = {
+    "jpeg_baseline": (jpeg(640, 480), (640, 480, 3)),
+    "jpeg_progressive_gray": (jpeg(1, 65535, 1, sof=0xC2), (1, 65535, 1)),
+    # a SOF marker in the exif data is skipped with the exif segment
+    "jpeg_exif": (jpeg(1920, 1080, exif=b"Exif\x00\x00\xff\xc0\x00\x11\x08\x00\x10\x00\x10\x03" + bytes(100)), (1920, 1080, 3)),
+    "jpeg_huffman_table_is_not_sof": (jpeg(32, 16).replace(b"\xff\xdb", b"\xff\xc4", 1), (32, 16, 3)),
+    "png_rgb": (png(800, 600, 2), (800, 600, 3)),
+    "png_gray": (png(3, 5, 0), (3, 5, 1)),
+    "png_gray_alpha": (png(3, 5, 4), (3, 5, 2)),
+    "png_palette": (png(3, 5, 3), (3, 5, 3)),
+    "png_rgba": (png(70000, 2, 6), (70000, 2, 4)),
+    "gif87a": (b"GIF87a" + struct.pack("<HH", 320, 200) + bytes(30), (320, 200, 3)),
+    "gif89a": (b"GIF89a" + struct.pack("<HH", 1, 2) + bytes(30), (1, 2, 3)),
+    "bmp_core": (bmp_core(30, 20, 24), (30, 20, 3)),
+    "bmp_core_palette": (bmp_core(30, 20, 8), (30, 20, 1)),
+    "bmp_info": (bmp_info(640, 480, 24), (640, 480, 3)),
+    "bmp_info_top_down": (bmp_info(640, -480, 32), (640, 480, 4)),
+    "webp_vp8": (webp_vp8(550, 368), (550, 368, 3)),
+    "webp_vp8l": (webp_vp8l(386, 395), (386, 395, 4)),
+    "webp_vp8x": (webp_vp8x(1000, 16384, False), (1000, 16384, 3)),
+    "webp_vp8x_alpha": (webp_vp8x(1, 1, True), (1, 1, 4)),
+}
+
+NOT_IMAGES = {
+    "text": b"<annotation></annotation>",
+    "empty": b"",
+    "truncated_jpeg": jpeg(640, 480)[:30],
+    "jpeg_without_sof": b"\xff\xd8" + jpeg_segment(0xE0, b"JFIF\x00") + b"\xff\xd9",
+    "truncated_png": png(10, 10, 2)[:20],
+    "zero_width_png": png(0, 10, 2),
+    "zero_height_gif": b"GIF89a" + struct.pack("<HH", 10, 0) + bytes(30),
+    "short_bmp": b"BM" + bytes(20),
+    "unknown_webp_chunk": riff(b"ALPH", bytes(30)),
+    "truncated_webp": webp_vp8(10, 10)[:28],
+}
+
+
+@pytest.mark.parametrize("name", sorted(HEADERS))
+def test_probe_image_size(tmp_path, name):
+    data, expected = HEADERS[name]
+    path = tmp_path / "image"
+    path.write_bytes(data)
+    assert probe_image_size(str(path)) == expected
+
+
+@pytest.mark.parametrize("name", sorted(NOT_IMAGES))
+def test_probe_unknown(tmp_path, name):
+    path = tmp_path / "image"
+    path.write_bytes(NOT_IMAGES[name])
+    assert probe_image_size(str(path)) is None
+
+
+def test_probe_missing(tmp_path):
+    assert probe_image_size(str(tmp_path / "missing.png")) is None
+    assert probe_image_size(str(tmp_path)) is None
+
+
+def box_object(name, box):
+    return ("<object><name>%s</name><bndbox><xmin>%s</xmin><ymin>%s</ymin><xmax>%s</xmax><ymax>%s</ymax></bndbox>"
+            "</object>") % ((name,) + tuple(box))
+
+
+POLYGON = "<object><name>P</name><polygon><x1>1</x1><y1>1</y1></polygon></object>"
+
+
+def annotation(objects, size="<size><width>100</width><height>50</height><depth>3</depth></size>", parser="etree"):
+    data = "<annotation><filename>a.png</filename>%s%s</annotation>" % (size, "".join(objects))
+    return PascalVocAnnotation(data.encode(), "a.xml", parser=parser)
+
+
+def boxes(a):
+    return [(o.name, None if o.boundingbox is None else
+             (o.boundingbox.xmin, o.boundingbox.ymin, o.boundingbox.xmax, o.boundingbox.ymax)) for o in a.objects]
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "a.png"
+    path.write_bytes(png(100, 50, 2))
+    return str(path)
+
+
+# name, box, after clipping (None: rejected), rejected with the reject policy
+BOXES = [
+    ("inside", (10, 10, 20, 20), (10, 10, 20, 20), False),
+    ("whole_image", (0, 0, 100, 50), (0, 0, 100, 50), False),
+    ("right", (90, 10, 120, 20), (90, 10, 100, 20), True),
+    ("top_left", (-5, -3.5, 20, 20), (0, 0, 20, 20), True),
+    ("bottom", (10, 40, 20, 50.5), (10, 40, 20, 50), True),
+    ("around", (-1, -1, 101, 51), (0, 0, 100, 50), True),
+    ("outside", (110, 10, 120, 20), None, True),
+    ("above", (10, -20, 20, -10), None, True),
+    ("empty", (10, 10, 10, 20), None, True),
+    ("inverted", (20, 10, 10, 20), None, True),
+]
+
+
+@pytest.mark.parametrize("name,box,clipped,rejected", BOXES, ids=[b[0] for b in BOXES])
+@pytest.mark.parametrize("policy", ["clip", "reject"])
+def test_validate_box(image, policy, name, box, clipped, rejected):
+    a = annotation([box_object(name, box), box_object("other", (1, 1, 2, 2)), POLYGON])
+    v = ImageValidator(policy)
+    assert v.validate(a, image)
+    if clipped is None or (policy == "reject" and rejected):
+        expected = []
+    else:
+        expected = [(name, tuple(float(x) for x in clipped))]
+    assert boxes(a) == expected + [("other", (1.0, 1.0, 2.0, 2.0)), ("P", None)]
+    assert v.report["rejected_boxes"] == (0 if expected else 1)
+    assert v.report["clipped_boxes"] == (1 if expected and clipped != box else 0)
+
+
+@pytest.mark.parametrize("parser", ["etree", "fast"])
+def test_clipped_boxes_are_written(image, parser):
+    a = annotation([box_object("right", (90, 10, 120, 20)), box_object("outside", (110, 10, 120, 20))], parser=parser)
+    assert ImageValidator("clip").validate(a, image)
+    buf = io.BytesIO()
+    a.write(buf)
+    root = ET.fromstring(buf.getvalue())
+    assert [o.findtext("name") for o in root.iter("object")] == ["right"]
+    assert [float(root.find("object/bndbox/" + c).text) for c in ("xmin", "ymin", "xmax", "ymax")] == [90, 10, 100, 20]
+
+
+@pytest.mark.parametrize("policy", ["clip", "reject"])
+def test_all_boxes_rejected(image, policy):
+    v = ImageValidator(policy)
+    assert not v.validate(annotation([box_object("outside", (110, 10, 120, 20)), box_object("empty", (5, 5, 5, 5))]), image)
+    assert v.report["rejected_annotations"] == 1
+    # without objects there was nothing to reject
+    assert v.validate(annotation([]), image)
+    assert v.validate(annotation([POLYGON]), image)
+    assert v.report["rejected_annotations"] == 1
+
+
+@pytest.mark.parametrize("size,expected,counter", [
+    ("", (100, 50, 3), "filled_sizes"),
+    ("<size><width>0</width><height>0</height><depth>3</depth></size>", (100, 50, 3), "filled_sizes"),
+    ("<size><width>50</width><height>100</height><depth>1</depth></size>", (100, 50, 1), "corrected_sizes"),
+    ("<size><width>50</width><height>100</height><depth>0</depth></size>", (100, 50, 3), "corrected_sizes"),
+    ("<size><width>100</width><height>50</height><depth>1</depth></size>", (100, 50, 1), None),
+])
+def test_validate_size(image, size, expected, counter):
+    a = annotation([box_object("inside", (10, 10, 20, 20))], size)
+    v = ImageValidator()
+    assert v.validate(a, image)
+    assert a.size == expected
+    for c in ("filled_sizes", "corrected_sizes"):
+        assert v.report[c] == (1 if c == counter else 0)
+
+
+def test_unknown_size_keeps_the_annotation(tmp_path):
+    a = annotation([box_object("outside", (110, 10, 120, 20))])
+    v = ImageValidator("reject")
+    assert v.validate(a, str(tmp_path / "missing.png"))
+    assert len(a.objects) == 1
+    assert v.report["unknown_size"] == 1
+
+
+def test_sizes_are_cached(tmp_path, image):
+    # files that were just written are not cached (see RACY_WINDOW)
+    os.utime(image, (time.time() - 60, time.time() - 60))
+    cache = HashCache(tmp_path / "cache.db")
+    v = ImageValidator(cache=cache)
+    v.prefetch([image, image, str(tmp_path / "missing.png"), ""])
+    assert v.image_size(image) == (100, 50, 3)
+    assert v.report["probed_images"] == 1
+    again = ImageValidator(cache=cache)
+    assert again.image_size(image) == (100, 50, 3)
+    assert again.report["probed_images"] == 0
@@ -0,0 +1,16 @@
+"""
+    tinyvoc-index and tinyvoc.columnar need the columnar extra, without numpy they must say how to install it.
+"""
+import importlib
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize("module", ["tinyvoc.annotationindex", "tinyvoc.columnar"])
+def test_missing_numpy_points_to_the_extra(module, monkeypatch):
+    monkeypatch.setitem(sys.modules, "numpy", None)
+    for name in ("tinyvoc.annotationindex", "tinyvoc.columnar"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    with pytest.raises(ImportError, match=r"pip install tinyvoc\[columnar\]"):
+        importlib.import_module(module)
@@ -0,0 +1,163 @@
+"""
+    Frame extraction, with a fake ffmpeg (see fake_ffmpeg.py) that decodes a video of numbered frames.
+"""
+import io
+import math
+import os
+import sys
+
+import pytest
+
+import fake_ffmpeg
+from tinyvoc import video_to_frame
+from tinyvoc.video_to_frame import StreamFrameExtractor, clear_directory, iter_jpeg_frames, iter_png_frames, plan_segments
+
+
+class TricklePipe(object):
+    """
+        returns at most a few bytes per read, like a pipe that is written slowly
+    """
+    def __init__(self, data: bytes) -> None:
+        self.data = io.BytesIO(data)
+        self.reads = 0
+
+    def read(self, n: int) -> bytes:
+        self.reads += 1
+        return self.data.read(min(n, 1 + self.reads % 7))
+
+
+def frames_of(plan, every):
+    return [seg.first_frame + i * every for seg in plan for i in range(seg.count)]
+
+
+@pytest.mark.parametrize("fps,n_frames,every,start,end,segments,expected", [
+    (25.0, 10, 1, None, None, 1, list(range(10))),
+    (25.0, 10, 3, None, None, 4, [0, 3, 6, 9]),
+    (10.0, 100, 1, 2.0, 3.0, 3, list(range(20, 30))),
+    (10.0, 100, 4, 2.05, 3.0, 2, [21, 25, 29]),
+    (10.0, 100, 1, 9.5, 20.0, 2, list(range(95, 100))),
+    (30000 / 1001, 300, 1, 1.0, 2.0, 1, list(range(30, 60))),
+    (10.0, 100, 1, 5.0, 4.0, 3, []),
+    (10.0, 3, 1, None, None, 8, [0, 1, 2]),
+])
+def test_plan_segments(fps, n_frames, every, start, end, segments, expected):
+    plan = plan_segments(fps, n_frames, every, start, end, segments)
+    assert frames_of(plan, every) == expected
+    assert len(plan) <= segments and all(seg.count > 0 for seg in plan)
+    if len(plan) > 0:
+        assert max(seg.count for seg in plan) - min(seg.count for seg in plan) <= 1
+
+
+@pytest.mark.parametrize("split,make", [(iter_png_frames, fake_ffmpeg.png_frame), (iter_jpeg_frames, fake_ffmpeg.jpeg_frame)],
+                         ids=["png", "jpeg"])
+def test_pipe_splitters(split, make):
+    frames = [make(nr) for nr in range(8)]
+    assert list(split(io.BytesIO(b"".join(frames)))) == frames
+    assert list(split(TricklePipe(b"".join(frames)))) == frames
+    assert list(split(io.BytesIO(b""))) == []
+
+
+@pytest.mark.parametrize("split,make", [(iter_png_frames, fake_ffmpeg.png_frame), (iter_jpeg_frames, fake_ffmpeg.jpeg_frame)],
+                         ids=["png", "jpeg"])
+def test_pipe_splitters_reject_broken_streams(split, make):
+    data = make(0) + make(1)
+    with pytest.raises(Exception, match="unexpected end of frame stream"):
+        list(split(io.BytesIO(data[:-3])))
+    with pytest.raises(Exception, match="is not a"):
+        list(split(io.BytesIO(data + b"not an image at all")))
+    other = fake_ffmpeg.jpeg_frame if make is fake_ffmpeg.png_frame else fake_ffmpeg.png_frame
+    with pytest.raises(Exception, match="is not a"):
+        list(split(io.BytesIO(other(0))))
+
+
+@pytest.fixture
+def tools(tmp_path):
+    return fake_ffmpeg.install(tmp_path)
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "a video.mp4"
+    path.write_bytes(b"not really a video")
+    return str(path)
+
+
+def extracted(directory, ext):
+    out = {}
+    for name in os.listdir(str(directory)):
+        assert name.endswith(ext)
+        with open(os.path.join(str(directory), name), "rb") as f:
+            out[name] = fake_ffmpeg.frame_number(f.read())
+    return out
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(),
+    dict(format="jpeg"),
+    dict(every=3, segments=3),
+    dict(every=2, start=1.0, end=3.5, segments=2),
+    dict(start=4.0, segments=4),
+])
+def test_stream_extractor(tmp_path, tools, video, kwargs):
+    dest = tmp_path / "out dir"
+    n = StreamFrameExtractor(video, str(dest), prefix="cam", ffmpeg=tools["ffmpeg"], ffprobe=tools["ffprobe"], **kwargs).run()
+    fps = fake_ffmpeg.FPS
+    first = 0 if "start" not in kwargs else math.ceil(kwargs["start"] * fps)
+    last = fake_ffmpeg.N_FRAMES if "end" not in kwargs else math.ceil(kwargs["end"] * fps)
+    expected = range(first, last, kwargs.get("every", 1))
+    ext = ".jpg" if kwargs.get("format") == "jpeg" else ".PNG"
+    assert n == len(expected)
+    assert extracted(dest, ext) == {"cam_%06d%s" % (nr, ext): nr for nr in expected}
+
+
+def test_stream_extractor_fails_with_ffmpeg(tmp_path, tools):
+    with pytest.raises(Exception, match="failed with exit code 1"):
+        StreamFrameExtractor(str(tmp_path / "missing.mp4"), str(tmp_path / "out"), ffmpeg=tools["ffmpeg"]).run()
+
+
+def test_clear_directory(tmp_path):
+    d = tmp_path / "out"
+    (d / "sub").mkdir(parents=True)
+    for name in ("a.PNG", "b.txt", ".keep", "sub/c.PNG"):
+        (d / name).write_bytes(b"")
+    os.symlink(str(d / "sub"), str(d / "link"))
+    clear_directory(str(d))
+    assert sorted(os.listdir(str(d))) == [".keep", "sub"]
+    assert os.listdir(str(d / "sub")) == ["c.PNG"]
+    clear_directory(str(tmp_path / "new" / "dir"))
+    assert os.listdir(str(tmp_path / "new" / "dir")) == []
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["video-to-frame"] + [str(a) for a in argv])
+    video_to_frame.main()
+
+
+def test_main_renames_the_frames(tmp_path, tools, video, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    dest = tmp_path / "frames; touch injected; echo"
+    dest.mkdir()
+    (dest / "stale.PNG").write_bytes(b"")
+    run_main(monkeypatch, "--source", video, "--destination", dest, "--prefix", "cam", "--ffmpeg", tools["ffmpeg"])
+    assert extracted(dest, ".PNG") == {"cam_%06d.PNG" % nr: nr for nr in range(fake_ffmpeg.N_FRAMES)}
+    assert os.path.isfile(str(dest) + "_frames_lineage.yaml")
+    assert not os.path.exists(str(tmp_path / "injected"))
+
+
+def test_main_stream(tmp_path, tools, video, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    dest = tmp_path / "frames"
+    run_main(monkeypatch, "--source", video, "--destination", dest, "--prefix", "cam", "--stream", "--every", "5",
+             "--format", "jpeg", "--segments", "2", "--ffmpeg", tools["ffmpeg"], "--ffprobe", tools["ffprobe"])
+    assert extracted(dest, ".jpg") == {"cam_%06d.jpg" % nr: nr for nr in range(0, fake_ffmpeg.N_FRAMES, 5)}
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, "--source", video, "--destination", dest, "--prefix", "cam", "--stream", "--every", "5",
+                 "--format", "jpeg", "--segments", "2", "--ffmpeg", tools["ffmpeg"], "--ffprobe", tools["ffprobe"])
+
+
+def test_main_fails_with_ffmpeg(tmp_path, monkeypatch, video):
+    monkeypatch.chdir(str(tmp_path))
+    dest = tmp_path / "frames"
+    with pytest.raises(Exception, match="failed with exit code"):
+        run_main(monkeypatch, "--source", video, "--destination", dest, "--prefix", "cam", "--ffmpeg", "false")
+    assert not os.path.exists(str(dest) + "_frames_lineage.yaml")
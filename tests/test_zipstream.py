@@ -0,0 +1,114 @@
+"""
+    The sequential zip reader must read back what zipfile writes: stored, deflated and bzip2 members, with sizes in the
+    local header (seekable output) or in a data descriptor (streamed output), and with zip64 headers.
+"""
+import hashlib
+import io
+import os
+import zipfile
+
+import pytest
+
+from tinyvoc.zipstream import HashingReader, decompress_member, iter_members
+
+
+class WriteOnly(object):
+    """
+        a stream zipfile can't seek in, so it writes data descriptors (like a zip written to a pipe)
+    """
+    def __init__(self) -> None:
+        self.buf = io.BytesIO()
+
+    def write(self, data) -> int:
+        return self.buf.write(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class TrickleReader(object):
+    def __init__(self, data: bytes) -> None:
+        self.data = io.BytesIO(data)
+        self.reads = 0
+
+    def read(self, n: int = -1) -> bytes:
+        self.reads += 1
+        return self.data.read(min(n if n >= 0 else 1 << 30, 1 + self.reads % 13))
+
+
+CONTENTS = {
+    "empty.xml": b"",
+    "a/annotation.xml": b"<annotation><filename>a.png</filename></annotation>\n" * 50,
+    "random.bin": os.urandom(200000),
+    # data descriptor signatures in the data of a stored member
+    "fake_descriptor.bin": b"PK\x07\x08" * 10 + os.urandom(100) + b"PK\x07\x08\x00\x00\x00\x00",
+    "dir/": b"",
+    "café ü.xml": b"<annotation />",
+}
+
+
+def write_zip(compression, streamed, zip64=False) -> bytes:
+    out = WriteOnly() if streamed else io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression=compression) as z:
+        for name, data in CONTENTS.items():
+            if name.endswith("/"):
+                z.mkdir(name) if hasattr(z, "mkdir") else z.writestr(name, data)
+                continue
+            with z.open(name, "w", force_zip64=zip64) as f:
+                f.write(data)
+    return (out.buf if streamed else out).getvalue()
+
+
+def read_back(data: bytes, reader=io.BytesIO, want=lambda name: True):
+    return {m.filename: (decompress_member(m) if m.data is not None else None) for m in iter_members(reader(data), want)}
+
+
+CASES = [(c, s, z) for c in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2) for s in (False, True) for z in (False, True)]
+
+
+@pytest.mark.parametrize("compression,streamed,zip64", CASES,
+                         ids=["%s-%s%s" % (c, "descriptor" if s else "sized", "-zip64" if z else "") for c, s, z in CASES])
+def test_round_trip(compression, streamed, zip64):
+    data = write_zip(compression, streamed, zip64)
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        infos = z.infolist()
+        expected = {i.filename: z.read(i) for i in infos}
+        assert all(bool(i.flag_bits & 0x8) == streamed for i in infos if not i.is_dir())
+    assert expected == CONTENTS
+    # a zip64 extra field with both sizes in the local headers
+    assert (b"\x01\x00\x10\x00" in data) == zip64
+    assert read_back(data) == expected
+    assert read_back(data, TrickleReader) == expected
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+@pytest.mark.parametrize("streamed", [False, True])
+def test_unwanted_members_are_skipped(compression, streamed):
+    data = write_zip(compression, streamed)
+    members = read_back(data, want=lambda name: name.endswith(".xml"))
+    assert list(members) == list(CONTENTS)
+    assert members == {name: (value if name.endswith(".xml") else None) for name, value in CONTENTS.items()}
+
+
+def test_hashing_reader_hashes_the_whole_stream():
+    data = write_zip(zipfile.ZIP_DEFLATED, True)
+    reader = HashingReader(io.BytesIO(data))
+    assert len(list(iter_members(reader))) == len(CONTENTS)
+    reader.drain()
+    assert reader.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_bad_crc():
+    data = bytearray(write_zip(zipfile.ZIP_STORED, False))
+    pos = data.find(b"<annotation><filename>")
+    data[pos + 1] ^= 1
+    with pytest.raises(Exception, match="bad crc"):
+        read_back(bytes(data))
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_truncated(streamed):
+    data = write_zip(zipfile.ZIP_DEFLATED, streamed)
+    end = data.find(b"PK\x01\x02")
+    with pytest.raises(Exception, match="unexpected end of zip stream"):
+        read_back(data[:end // 2])
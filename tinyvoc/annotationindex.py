@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+"""
+    Memory-mapped index of one or more annotation sources, to select annotations without parsing xml.
+
+    The index is a directory with the columns of an AnnotationTable (see tinyvoc.columnar: label codes, boxes, image ids,
+    ...) as .npy files, plus per annotation where its xml is: the source (annotation directory, zip or sharded dataset),
+    the file or member, the byte offset and size in the source file and a crc32 of the xml. Everything is memory-mapped
+    when the index is loaded, so opening a big index is instant.
+
+    AnnotationIndex.query selects annotations by label, box area, aspect ratio or id. The result can be used as source for
+    the writers: it loads the original xml of the selected annotations (with a single read per annotation).
+
+    requires numpy (pip install tinyvoc[columnar])
+"""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import zipfile
+import zlib
+from array import array
+from typing import Dict, Generator, Iterable, List, Optional, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("tinyvoc.annotationindex requires numpy, install it with: pip install tinyvoc[columnar]") from e
+
+from .columnar import AnnotationTable
+from .hashutil import hash_from_Str
+from .parallel import write_annotations
+from .pvocutils import (AnnotationDirectory, AnnotationZip, DataLineage, DirAnnotationWriter, FileAnnotationRef,
+                        ImageTreatmentSetting, LineageSource, PascalVocAnnotation, ZipAnnotationRef)
+from .shards import ShardAnnotationRef, ShardedAnnotationSource, open_source
+
+INDEX_VERSION = 1
+_IMAGE_COLUMNS = ("source_codes", "members", "byte_offsets", "byte_sizes", "checksums")
+
+
+def default_index_path(path) -> str:
+    path = str(path)
+    if os.path.isfile(path):
+        return path + ".index"
+    return os.path.join(path, ".tinyvoc-index")
+
+
+class AnnotationIndex(object):
+    """
+        table: AnnotationTable with the objects and images
+        sources: list of {"kind": "dir"|"zip"|"shards", "path": ..., "root_dir": ...} dicts
+        source_codes: int32 array (n_images), index in sources
+        members: unicode array (n_images), the annotation file (dir), zip member (zip) or shard file (shards)
+        byte_offsets, byte_sizes: int64 arrays (n_images), where the (compressed, for zips) xml is in the file
+        checksums: uint32 array (n_images), crc32 of the xml
+    """
+    def __init__(self, path: str, table: AnnotationTable, sources: List[Dict], source_codes, members, byte_offsets, byte_sizes,
+                 checksums, fingerprint: str = "", parser: str = "etree") -> None:
+        self.path = path
+        self.table = table
+        self.sources = sources
+        self.source_codes = source_codes
+        self.members = members
+        self.byte_offsets = byte_offsets
+        self.byte_sizes = byte_sizes
+        self.checksums = checksums
+        self.fingerprint = fingerprint
+        self.parser = parser
+
+    def __len__(self) -> int:
+        return self.table.n_images
+
+    @classmethod
+    def build(cls, sources: Sequence, path: Union[str, pathlib.Path]) -> "AnnotationIndex":
+        """
+            indexes all annotations of sources (AnnotationDirectory, AnnotationZip or ShardedAnnotationSource objects)
+            and saves the index to the directory path
+        """
+        path = str(path)
+        source_dicts = []
+        source_codes = array("i")
+        members: List[str] = []
+        offsets = array("q")
+        sizes = array("q")
+        checksums = array("L")
+
+        def annotations() -> Generator[PascalVocAnnotation, None, None]:
+            for code, s in enumerate(sources):
+                if isinstance(s, AnnotationZip):
+                    kind = "zip"
+                    infos = {info.filename: info for info in zipfile.ZipFile(str(s.zipfile)).infolist()}
+                elif isinstance(s, ShardedAnnotationSource):
+                    kind = "shards"
+                else:
+                    kind = "dir"
+                root_dir = None if s.root_dir is None else os.path.abspath(str(s.root_dir))
+                source_dicts.append({"kind": kind, "path": os.path.abspath(str(s.zipfile if kind == "zip" else s.path)), "root_dir": root_dir})
+                for ref in s.generate_refs():
+                    annotation = ref.load()
+                    source_codes.append(code)
+                    if kind == "zip":
+                        info = infos[ref.member]
+                        members.append(ref.member)
+                        offsets.append(info.header_offset)
+                        sizes.append(info.compress_size)
+                        checksums.append(info.CRC)
+                    elif kind == "shards":
+                        members.append(os.path.basename(ref.shard_path) + ":" + ref.member)
+                        offsets.append(ref.loc[1])
+                        sizes.append(ref.loc[2])
+                        checksums.append(ref.loc[3])
+                    else:
+                        members.append(os.path.relpath(ref.path, str(s.path)))
+                        offsets.append(0)
+                        sizes.append(os.path.getsize(ref.path))
+                        checksums.append(ref_crc32(ref.path))
+                    yield annotation
+
+        table = AnnotationTable.from_annotations(annotations())
+        index = cls(path, table, source_dicts, np.frombuffer(source_codes, dtype=np.int32),
+                    np.array(members, dtype=str), np.frombuffer(offsets, dtype=np.int64), np.frombuffer(sizes, dtype=np.int64),
+                    np.array(checksums, dtype=np.uint32))
+        index.fingerprint = hash_from_Str(json.dumps(source_dicts) + hash_from_Str(index.checksums.tobytes().hex()))
+        index.save(path)
+        logging.info(f"indexed {len(index)} annotations with {len(table)} objects in {path}")
+        return index
+
+    def save(self, path: Union[str, pathlib.Path]) -> None:
+        path = str(path)
+        self.table.save(path)
+        for c in _IMAGE_COLUMNS:
+            np.save(os.path.join(path, c + ".npy"), getattr(self, c))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"version": INDEX_VERSION, "sources": self.sources, "fingerprint": self.fingerprint}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: Union[str, pathlib.Path], parser: str = "etree") -> "AnnotationIndex":
+        """
+            memory-maps an index. parser is used to parse the annotations of query results
+        """
+        path = str(path)
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise Exception(f"unsupported annotation index version {meta.get('version')} in {path}, rebuild the index")
+        columns = {c: np.load(os.path.join(path, c + ".npy"), mmap_mode="r") for c in _IMAGE_COLUMNS}
+        return cls(path, AnnotationTable.load(path), meta["sources"], fingerprint=meta["fingerprint"], parser=parser, **columns)
+
+    def query(self, labels: Optional[Iterable[str]] = None, min_area: Optional[float] = None, max_area: Optional[float] = None,
+              min_aspect: Optional[float] = None, max_aspect: Optional[float] = None, ids: Optional[Iterable[str]] = None) -> "IndexQuery":
+        """
+            selects the annotations that have at least one object matching all of the given object conditions (label in
+            labels, box area in [min_area, max_area] pixels, aspect ratio width/height in [min_aspect, max_aspect]), and
+            whose id is in ids. without object conditions, annotations without objects are selected too.
+        """
+        t = self.table
+        mask = None
+        if labels is not None:
+            codes = [c for c in (t.label_code(l) for l in labels) if c is not None]
+            mask = np.isin(t.label_codes, codes)
+        if any(v is not None for v in (min_area, max_area, min_aspect, max_aspect)):
+            w = t.boxes[:, 2] - t.boxes[:, 0]
+            h = t.boxes[:, 3] - t.boxes[:, 1]
+            box_mask = np.ones(len(t), dtype=bool)
+            if min_area is not None:
+                box_mask &= w * h >= min_area
+            if max_area is not None:
+                box_mask &= w * h <= max_area
+            if min_aspect is not None or max_aspect is not None:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    aspect = np.where(h > 0, w / h, np.inf)
+                if min_aspect is not None:
+                    box_mask &= aspect >= min_aspect
+                if max_aspect is not None:
+                    box_mask &= aspect <= max_aspect
+            mask = box_mask if mask is None else mask & box_mask
+        if mask is None:
+            images = np.arange(len(self), dtype=np.int64)
+            n_objects = len(t)
+        else:
+            images = np.unique(t.image_ids[mask])
+            n_objects = int(np.count_nonzero(mask))
+        if ids is not None:
+            images = images[np.isin(t.annotation_ids[images], list(ids))]
+            selected = np.isin(t.image_ids, images)
+            n_objects = int(np.count_nonzero(selected if mask is None else selected & mask))
+        description = json.dumps({"labels": sorted(labels) if labels is not None else None, "min_area": min_area,
+                                  "max_area": max_area, "min_aspect": min_aspect, "max_aspect": max_aspect,
+                                  "ids": sorted(ids) if ids is not None else None}, sort_keys=True)
+        return IndexQuery(self, images, n_objects, description)
+
+    def ref(self, image_nr: int):
+        """
+            returns a ref (like the ones of the sources) to load the annotation of image image_nr
+        """
+        source = self.sources[int(self.source_codes[image_nr])]
+        member = str(self.members[image_nr])
+        if source["kind"] == "zip":
+            return ZipAnnotationRef(source["path"], member, source["root_dir"], int(self.checksums[image_nr]),
+                                    0, parser=self.parser)
+        if source["kind"] == "shards":
+            shard, id = member.split(":", 1)
+            loc = [0, int(self.byte_offsets[image_nr]), int(self.byte_sizes[image_nr]), int(self.checksums[image_nr])]
+            return ShardAnnotationRef(os.path.join(source["path"], shard), id, loc, source["root_dir"], self.parser)
+        return FileAnnotationRef(os.path.join(source["path"], member), source["root_dir"], parser=self.parser)
+
+
+def ref_crc32(path: str) -> int:
+    with open(path, "rb") as f:
+        return zlib.crc32(f.read())
+
+
+class IndexQuery(object):
+    """
+        The annotations selected by AnnotationIndex.query. Has the interface of the sources (generate_refs,
+        generate_annotations, as_lineage_source), so it can be passed to the writers.
+    """
+    def __init__(self, index: AnnotationIndex, images, n_objects: int, description: str) -> None:
+        self.index = index
+        self.images = images
+        self.n_objects = n_objects
+        self.description = description
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    @property
+    def root_dir(self) -> Optional[str]:
+        roots = {s["root_dir"] for s in self.index.sources}
+        return roots.pop() if len(roots) == 1 else None
+
+    def ids(self) -> List[str]:
+        return [str(x) for x in self.index.table.annotation_ids[self.images]]
+
+    def filenames(self) -> List[str]:
+        return [str(x) for x in self.index.table.filenames[self.images]]
+
+    def generate_refs(self) -> Generator[object, None, None]:
+        for i in self.images:
+            yield self.index.ref(int(i))
+
+    def generate_annotations(self) -> Generator[PascalVocAnnotation, None, None]:
+        for ref in self.generate_refs():
+            yield ref.load()
+
+    def as_lineage_source(self) -> LineageSource:
+        src = LineageSource()
+        src.annotation_path = os.path.abspath(self.index.path)
+        src.root_dir = self.root_dir or ""
+        src.source_hash = hash_from_Str(self.index.fingerprint + self.description)
+        return src
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="build and query a memory-mapped index of annotation sources")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="index one or more sources (annotation directories, zips or sharded datasets)")
+    build.add_argument("--source", type=pathlib.Path, required=True, action="append", help="source to index (repeat for more)")
+    build.add_argument("--output", type=pathlib.Path, help="index directory (default: .tinyvoc-index in the source directory, or <zip>.index)")
+    query = sub.add_parser("query", help="select annotations from an index")
+    query.add_argument("index", type=pathlib.Path, help="index directory")
+    query.add_argument("--label", type=str, action="append", help="object label (repeat for more)")
+    query.add_argument("--min-area", type=float, help="minimum box area in pixels")
+    query.add_argument("--max-area", type=float, help="maximum box area in pixels")
+    query.add_argument("--min-aspect", type=float, help="minimum aspect ratio (width / height) of the box")
+    query.add_argument("--max-aspect", type=float, help="maximum aspect ratio (width / height) of the box")
+    query.add_argument("--id", type=str, action="append", help="annotation id (repeat for more)")
+    query.add_argument("--destination", type=pathlib.Path, help="write the selected annotations (renamed, images symlinked) to this directory instead of printing their ids")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+    if args.command == "build":
+        output = args.output or default_index_path(args.source[0])
+        os.makedirs(output, exist_ok=True)
+        AnnotationIndex.build([open_source(s) for s in args.source], output)
+        return
+    index = AnnotationIndex.load(args.index)
+    q = index.query(args.label, args.min_area, args.max_area, args.min_aspect, args.max_aspect, args.id)
+    if args.destination is None:
+        for id in q.ids():
+            print(id)
+        return
+    writer = DirAnnotationWriter(args.destination)
+    write_annotations([q], writer, ImageTreatmentSetting.SYMLINK_IMAGE_RENAME)
+    writer.close()
+    writer.write_dataset_meta()
+    lineage = DataLineage()
+    lineage.add_source(q.as_lineage_source())
+    writer.write_lineage(lineage)
+    print(f"wrote {len(q)} annotations ({q.n_objects} matching objects) to {args.destination}")
+
+
+if __name__ == "__main__":
+    main()
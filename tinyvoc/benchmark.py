@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""
+    Benchmarks for the hot paths of tinyvoc, on synthetic datasets (see tinyvoc.synthetic).
+
+    Every benchmark is run --repeat times, the result has the best and the median time and the throughput (items per
+    second, based on the best time). Results are written as JSON, and can be compared with the results of another run
+    (eg of another tinyvoc version) with --compare.
+"""
+import argparse
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics as stats
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .pvocutils import AnnotationZip, AnnotationDirectory, DirAnnotationWriter, ImageTreatmentSetting, PascalVocAnnotation
+from .hashutil import hash_from_file
+from .prepare_annotations import process_annotation
+from . import statistics
+from .synthetic import make_dataset, DEFAULT_LABELS
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="benchmark tinyvoc on synthetic datasets")
+    parser.add_argument("--images", type=int, default=2000, help="number of images in the synthetic dataset (default=2000)")
+    parser.add_argument("--min-objects", type=int, default=0, help="minimum number of objects per image (default=0)")
+    parser.add_argument("--max-objects", type=int, default=8, help="maximum number of objects per image (default=8)")
+    parser.add_argument("--labels", type=int, default=len(DEFAULT_LABELS), help="size of the label vocabulary (default=%d)" % len(DEFAULT_LABELS))
+    parser.add_argument("--image-size", type=int, default=4096, help="size of the dummy image files in bytes (default=4096)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs per benchmark (default=3)")
+    parser.add_argument("--only", type=str, action="append", help="only run benchmarks whose name starts with this (repeat for more)")
+    parser.add_argument("--workdir", type=pathlib.Path, help="directory for the synthetic datasets (default: a temporary directory)")
+    parser.add_argument("--output", type=pathlib.Path, help="json file to write the results to")
+    parser.add_argument("--compare", type=pathlib.Path, help="json file of a previous run to compare with")
+    return parser.parse_args()
+
+
+class BenchmarkResult(object):
+    def __init__(self, name: str, times: List[float], items: int) -> None:
+        self.name = name
+        self.times = times
+        self.items = items
+
+    def to_dict(self) -> Dict:
+        best = min(self.times)
+        return {
+            "best_seconds": best,
+            "median_seconds": stats.median(self.times),
+            "items": self.items,
+            "items_per_second": self.items / best if best > 0 else None,
+        }
+
+
+def run_benchmark(name: str, fn: Callable[[], int], repeat: int, setup: Optional[Callable[[], None]] = None) -> BenchmarkResult:
+    """
+        times fn (which returns the number of items it processed) repeat times. setup is called before every run, untimed.
+    """
+    times = []
+    items = 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        items = fn()
+        times.append(time.perf_counter() - start)
+    return BenchmarkResult(name, times, items)
+
+
+class BenchmarkSuite(object):
+    """
+        Generates the synthetic datasets in workdir and defines the benchmarks, as (name, function, setup) tuples.
+    """
+    def __init__(self, workdir: str, images: int = 2000, objects: Tuple[int, int] = (0, 8), labels: int = len(DEFAULT_LABELS), image_size: int = 4096) -> None:
+        self.workdir = workdir
+        self.labels = list(DEFAULT_LABELS[:labels]) + [f"Label{i}" for i in range(len(DEFAULT_LABELS), labels)]
+        self.zip_root = os.path.join(workdir, "zipdataset")
+        self.dir_root = os.path.join(workdir, "dirdataset")
+        self.zip_path = make_dataset(self.zip_root, images, objects, self.labels, "zip", image_size)
+        self.dir_path = make_dataset(self.dir_root, images, objects, self.labels, "dir", image_size)
+        with zipfile.ZipFile(self.zip_path) as z:
+            self.xml = [z.read(info) for info in z.infolist()]
+        self._annotations: List[PascalVocAnnotation] = []
+
+    def _fresh_annotations(self) -> None:
+        """
+            benchmarks that modify annotations get new ones before every run
+        """
+        self._annotations = [PascalVocAnnotation(x, None, self.zip_root) for x in self.xml]
+
+    def benchmarks(self) -> List[Tuple[str, Callable[[], int], Optional[Callable[[], None]]]]:
+        out_dir = os.path.join(self.workdir, "out")
+
+        def iterate(source) -> Callable[[], int]:
+            return lambda: sum(1 for _ in source.generate_annotations())
+
+        def process() -> int:
+            for a in self._annotations:
+                process_annotation(a, self.labels[:2], concat_type=True, prefix="img")
+            return len(self._annotations)
+
+        def clean_output() -> None:
+            if os.path.isdir(out_dir):
+                shutil.rmtree(out_dir)
+            self._fresh_annotations()
+
+        def write(treat: ImageTreatmentSetting) -> Callable[[], int]:
+            def fn() -> int:
+                writer = DirAnnotationWriter(out_dir)
+                writer.extra_search_path = [os.path.join(self.zip_root, "JPEGImages")]
+                for a in self._annotations:
+                    writer.add_annotation(a, treat)
+                writer.close()
+                return len(self._annotations)
+            return fn
+
+        def hash_files() -> int:
+            n = 0
+            image_dir = os.path.join(self.zip_root, "JPEGImages")
+            for fn in os.listdir(image_dir):
+                hash_from_file(os.path.join(image_dir, fn))
+                n += 1
+            hash_from_file(self.zip_path)
+            return n + 1
+
+        def components() -> int:
+            n = 0
+            for a in self._annotations:
+                statistics.connected_components(a)
+                n += 1
+            return n
+
+        result = []
+        for parser in ("etree", "fast"):
+            result.append((f"iterate_zip_{parser}", iterate(AnnotationZip(self.zip_path, self.zip_root, parser=parser)), None))
+            result.append((f"iterate_directory_{parser}", iterate(AnnotationDirectory(self.dir_path, parser=parser)), None))
+        result.append(("process_annotation", process, self._fresh_annotations))
+        for treat in ImageTreatmentSetting:
+            result.append((f"add_annotation_{treat.name.lower()}", write(treat), clean_output))
+        result.append(("hash_from_file", hash_files, None))
+        result.append(("connected_components", components, self._fresh_annotations))
+        return result
+
+
+def environment() -> Dict[str, str]:
+    try:
+        from importlib.metadata import version
+        tinyvoc_version = version("tinyvoc")
+    except Exception:
+        tinyvoc_version = "unknown"
+    return {"tinyvoc": tinyvoc_version, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+
+def compare(results: Dict, previous: Dict) -> None:
+    print(f"{'benchmark':40} {'previous':>12} {'now':>12} {'change':>8}")
+    for name, r in results.items():
+        old = previous.get("results", {}).get(name)
+        if old is None:
+            print(f"{name:40} {'-':>12} {r['best_seconds']:12.4f}")
+            continue
+        change = (r["best_seconds"] / old["best_seconds"] - 1.0) * 100 if old["best_seconds"] > 0 else 0.0
+        print(f"{name:40} {old['best_seconds']:12.4f} {r['best_seconds']:12.4f} {change:+7.1f}%")
+
+
+def main():
+    args = get_args()
+    workdir = str(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="tinyvoc-benchmark-")
+    try:
+        suite = BenchmarkSuite(workdir, args.images, (args.min_objects, args.max_objects), args.labels, args.image_size)
+        results = {}
+        for name, fn, setup in suite.benchmarks():
+            if args.only and not any(name.startswith(o) for o in args.only):
+                continue
+            r = run_benchmark(name, fn, args.repeat, setup).to_dict()
+            results[name] = r
+            print(f"{name:40} {r['best_seconds']:10.4f}s {r['items_per_second'] or 0:12.1f} items/s", file=sys.stderr)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        "environment": environment(),
+        "params": {"images": args.images, "min_objects": args.min_objects, "max_objects": args.max_objects,
+                   "labels": args.labels, "image_size": args.image_size, "repeat": args.repeat},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
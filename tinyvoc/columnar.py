@@ -0,0 +1,166 @@
+"""
+    Compact columnar representation of a dataset, for analysis of datasets that are too big to keep as PascalVocAnnotation objects.
+
+    Every object is a row in a couple of numpy arrays (box, label code, image index, occluded flag). Labels, filenames and
+    annotation ids are interned in small tables. A table can be saved as a .npz file, or as a directory of .npy files
+    that can be memory-mapped.
+
+    requires numpy (pip install tinyvoc[columnar])
+"""
+from array import array
+import os
+import pathlib
+from typing import Dict, Generator, Iterable, List, Optional, Union
+import xml.etree.ElementTree as ET
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("tinyvoc.columnar requires numpy, install it with: pip install tinyvoc[columnar]") from e
+
+from .pvocutils import PascalVocAnnotation
+
+_COLUMNS = ("boxes", "label_codes", "image_ids", "occluded", "object_offsets", "image_sizes", "labels", "filenames", "annotation_ids")
+
+
+class AnnotationTable(object):
+    """
+        boxes: float32 array (n_objects, 4) with xmin, ymin, xmax, ymax
+        label_codes: int32 array (n_objects), index in labels
+        image_ids: int32 array (n_objects), index of the annotation the object belongs to
+        occluded: bool array (n_objects)
+        object_offsets: int64 array (n_images + 1), objects of image i are rows object_offsets[i]:object_offsets[i+1]
+        image_sizes: int32 array (n_images, 3) with width, height, depth (0 if unknown)
+        labels, filenames, annotation_ids: string tables (numpy unicode arrays)
+    """
+    def __init__(self, boxes, label_codes, image_ids, occluded, object_offsets, image_sizes, labels, filenames, annotation_ids) -> None:
+        self.boxes = boxes
+        self.label_codes = label_codes
+        self.image_ids = image_ids
+        self.occluded = occluded
+        self.object_offsets = object_offsets
+        self.image_sizes = image_sizes
+        self.labels = labels
+        self.filenames = filenames
+        self.annotation_ids = annotation_ids
+
+    def __len__(self) -> int:
+        return len(self.label_codes)
+
+    @property
+    def n_images(self) -> int:
+        return len(self.annotation_ids)
+
+    @classmethod
+    def from_annotations(cls, annotations: Union[Iterable[PascalVocAnnotation], "AnnotationZip", "AnnotationDirectory"]) -> "AnnotationTable":
+        """
+            builds a table from an AnnotationZip, AnnotationDirectory or any iterable of PascalVocAnnotation objects.
+            the annotations are consumed one by one, only the table is kept in memory.
+        """
+        if hasattr(annotations, "generate_annotations"):
+            annotations = annotations.generate_annotations()
+        boxes = array("f")
+        label_codes = array("i")
+        image_ids = array("i")
+        occluded = array("b")
+        offsets = array("q", [0])
+        sizes = array("i")
+        label_index: Dict[str, int] = {}
+        filenames: List[str] = []
+        annotation_ids: List[str] = []
+        for img_nr, annot in enumerate(annotations):
+            filenames.append(annot.filename or "")
+            annotation_ids.append(annot.id)
+            sizes.extend(annot.size or (0, 0, 0))
+            for o in annot.objects:
+                bb = o.boundingbox
+                if bb is None:
+                    continue
+                boxes.extend((bb.xmin, bb.ymin, bb.xmax, bb.ymax))
+                label_codes.append(label_index.setdefault(o.name, len(label_index)))
+                image_ids.append(img_nr)
+                occluded.append(1 if o.occluded else 0)
+            offsets.append(len(label_codes))
+        labels = sorted(label_index, key=label_index.get)
+        return cls(
+            np.frombuffer(boxes, dtype=np.float32).reshape(-1, 4),
+            np.frombuffer(label_codes, dtype=np.int32),
+            np.frombuffer(image_ids, dtype=np.int32),
+            np.frombuffer(occluded, dtype=np.int8).astype(bool),
+            np.frombuffer(offsets, dtype=np.int64),
+            np.frombuffer(sizes, dtype=np.int32).reshape(-1, 3),
+            np.array(labels, dtype=str),
+            np.array(filenames, dtype=str),
+            np.array(annotation_ids, dtype=str),
+        )
+
+    def save(self, path: Union[str, pathlib.Path]) -> None:
+        """
+            saves to a .npz file if path ends with .npz, otherwise to a directory of .npy files (which load can memory-map)
+        """
+        path = str(path)
+        columns = {c: getattr(self, c) for c in _COLUMNS}
+        if path.endswith(".npz"):
+            np.savez(path, **columns)
+            return
+        os.makedirs(path, exist_ok=True)
+        for c, v in columns.items():
+            np.save(os.path.join(path, c + ".npy"), v)
+
+    @classmethod
+    def load(cls, path: Union[str, pathlib.Path], mmap: bool = True) -> "AnnotationTable":
+        """
+            loads a table written by save. tables saved as a directory are memory-mapped unless mmap is False
+        """
+        path = str(path)
+        if path.endswith(".npz"):
+            with np.load(path) as f:
+                return cls(**{c: f[c] for c in _COLUMNS})
+        mode = "r" if mmap else None
+        return cls(**{c: np.load(os.path.join(path, c + ".npy"), mmap_mode=mode) for c in _COLUMNS})
+
+    def objects_of(self, image_nr: int) -> slice:
+        return slice(int(self.object_offsets[image_nr]), int(self.object_offsets[image_nr + 1]))
+
+    def to_annotation(self, image_nr: int) -> PascalVocAnnotation:
+        """
+            converts one image back to a PascalVocAnnotation. only the fields in the table are restored (eg no attributes).
+        """
+        root = ET.Element("annotation")
+        ET.SubElement(root, "folder").text = ""
+        ET.SubElement(root, "filename").text = str(self.filenames[image_nr])
+        size = ET.SubElement(root, "size")
+        for name, v in zip(("width", "height", "depth"), self.image_sizes[image_nr]):
+            ET.SubElement(size, name).text = str(int(v))
+        sl = self.objects_of(image_nr)
+        for box, code, occl in zip(self.boxes[sl], self.label_codes[sl], self.occluded[sl]):
+            obj = ET.SubElement(root, "object")
+            ET.SubElement(obj, "name").text = str(self.labels[code])
+            ET.SubElement(obj, "occluded").text = "1" if occl else "0"
+            bndbox = ET.SubElement(obj, "bndbox")
+            for name, v in zip(("xmin", "ymin", "xmax", "ymax"), box):
+                ET.SubElement(bndbox, name).text = _format_coord(v)
+        annot = PascalVocAnnotation(ET.ElementTree(root))
+        annot.id = str(self.annotation_ids[image_nr])
+        return annot
+
+    def generate_annotations(self) -> Generator[PascalVocAnnotation, None, None]:
+        """
+            yields all images as PascalVocAnnotation objects, so a table can be used as annotation source for a writer
+        """
+        for i in range(self.n_images):
+            yield self.to_annotation(i)
+
+    def label_code(self, label: str) -> Optional[int]:
+        hits = np.nonzero(self.labels == label)[0]
+        if len(hits) == 0:
+            return None
+        return int(hits[0])
+
+
+def _format_coord(v: float) -> str:
+    v = float(v)
+    if v == int(v):
+        return str(int(v))
+    return str(v)
+
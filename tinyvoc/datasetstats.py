@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+"""
+    Dataset level statistics: label counts, box width/height/area/aspect ratio histograms, objects per image, occlusion
+    rate and overlap factor (see tinyvoc.statistics) over all annotations of one or more sources.
+
+    The histograms have fixed bins, so the statistics of two parts of a dataset can be merged exactly (DatasetStatistics.merge).
+    That is how the work is split over worker processes (every worker computes the statistics of a batch of annotations,
+    the main process merges them), and the json output of separate runs can be merged the same way. Memory use only
+    depends on the number of labels, not on the number of annotations or objects.
+
+    Objects without a bounding box (eg polygons) are not counted (like in tinyvoc.columnar), only their number is kept
+    (objects_without_box).
+"""
+import argparse
+import bisect
+import collections
+import itertools
+import json
+import logging
+import math
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from .parallel import batched
+from .pvocutils import PascalVocAnnotation
+from .shards import open_source
+from .statistics import component_indices
+from .threadpool import ordered_map
+
+STATISTICS_VERSION = 1
+
+
+def geometric_edges(start: float, stop: float, bins_per_octave: int) -> List[float]:
+    """
+        bin edges from start to stop (both powers of 2), with bins_per_octave bins for every doubling
+    """
+    n = int(round(math.log2(stop / start) * bins_per_octave))
+    return [start * 2 ** (i / bins_per_octave) for i in range(n + 1)]
+
+
+SIZE_EDGES = geometric_edges(1, 16384, 4)
+AREA_EDGES = geometric_edges(1, 2 ** 28, 2)
+ASPECT_EDGES = geometric_edges(1 / 64, 64, 4)
+COUNT_EDGES = [float(i) for i in range(65)] + [128.0, 256.0, 512.0, 1024.0]
+OVERLAP_EDGES = [1 + i / 4 for i in range(29)]
+
+
+class Histogram(object):
+    """
+        counts[0] is the number of values below edges[0], counts[i] the number of values in [edges[i-1], edges[i]) and
+        counts[-1] the number of values >= edges[-1]. also keeps the number, sum, minimum and maximum of the values.
+    """
+    def __init__(self, edges: Sequence[float]) -> None:
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.n = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        self.counts[bisect.bisect_right(self.edges, value)] += 1
+        self.n += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram") -> None:
+        if other.edges != self.edges:
+            raise Exception("can not merge histograms with different bins")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def mean(self) -> Optional[float]:
+        return self.sum / self.n if self.n > 0 else None
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+            approximate quantile: interpolated linearly in the bin that contains it (the min and max close the outer bins)
+        """
+        if self.n == 0:
+            return None
+        target = q * self.n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c > 0 and seen + c >= target:
+                lo = self.edges[i - 1] if i > 0 else self.min
+                hi = self.edges[i] if i < len(self.edges) else self.max
+                lo, hi = max(lo, self.min), min(hi, self.max)
+                return lo + (hi - lo) * (target - seen) / c
+            seen += c
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {
+            "n": self.n, "mean": self.mean(),
+            "min": self.min if self.n > 0 else None, "max": self.max if self.n > 0 else None,
+            "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+            "sum": self.sum, "edges": self.edges, "counts": self.counts,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "Histogram":
+        h = cls(d["edges"])
+        h.counts = list(d["counts"])
+        h.n = d["n"]
+        h.sum = d["sum"]
+        h.min = d["min"] if d["min"] is not None else math.inf
+        h.max = d["max"] if d["max"] is not None else -math.inf
+        return h
+
+
+class DatasetStatistics(object):
+    HISTOGRAMS = {
+        "width": SIZE_EDGES, "height": SIZE_EDGES, "area": AREA_EDGES, "aspect_ratio": ASPECT_EDGES,
+        "objects_per_image": COUNT_EDGES, "overlap_factor": OVERLAP_EDGES,
+    }
+
+    def __init__(self) -> None:
+        self.images = 0
+        self.objects = 0
+        self.occluded = 0
+        self.objects_without_box = 0
+        # label -> [objects, occluded objects, images]
+        self.labels: Dict[str, List[int]] = {}
+        self.histograms: Dict[str, Histogram] = {k: Histogram(edges) for k, edges in self.HISTOGRAMS.items()}
+
+    def add_annotation(self, annotation: PascalVocAnnotation) -> None:
+        self.images += 1
+        boxes = []
+        seen = set()
+        h = self.histograms
+        for o in annotation.objects:
+            b = o.boundingbox
+            if b is None:
+                self.objects_without_box += 1
+                continue
+            occluded = o.occluded
+            counts = self.labels.get(o.name)
+            if counts is None:
+                counts = self.labels[o.name] = [0, 0, 0]
+            counts[0] += 1
+            if o.name not in seen:
+                seen.add(o.name)
+                counts[2] += 1
+            if occluded:
+                counts[1] += 1
+                self.occluded += 1
+            # like the filters (see tinyvoc.objectfilter), the size of a box is xmax - xmin by ymax - ymin
+            w = b.xmax - b.xmin
+            ht = b.ymax - b.ymin
+            h["width"].add(w)
+            h["height"].add(ht)
+            h["area"].add(w * ht)
+            if ht > 0:
+                h["aspect_ratio"].add(w / ht)
+            boxes.append((b.xmin, b.ymin, b.xmax, b.ymax))
+        self.objects += len(boxes)
+        h["objects_per_image"].add(len(boxes))
+        if len(boxes) > 0:
+            h["overlap_factor"].add(len(boxes) / len(component_indices(boxes)))
+
+    def add_annotations(self, annotations: Iterable[PascalVocAnnotation]) -> "DatasetStatistics":
+        for annotation in annotations:
+            self.add_annotation(annotation)
+        return self
+
+    def merge(self, other: "DatasetStatistics") -> "DatasetStatistics":
+        self.images += other.images
+        self.objects += other.objects
+        self.occluded += other.occluded
+        self.objects_without_box += other.objects_without_box
+        for label, counts in other.labels.items():
+            mine = self.labels.setdefault(label, [0, 0, 0])
+            for i, c in enumerate(counts):
+                mine[i] += c
+        for k, hist in other.histograms.items():
+            self.histograms[k].merge(hist)
+        return self
+
+    def to_dict(self) -> Dict:
+        """
+            json serializable, the summary numbers first (for dvc metrics), then the histograms
+        """
+        return {
+            "version": STATISTICS_VERSION,
+            "images": self.images,
+            "objects": self.objects,
+            "objects_without_box": self.objects_without_box,
+            "empty_images": self.histograms["objects_per_image"].counts[1],
+            "occlusion_rate": self.occluded / self.objects if self.objects > 0 else 0.0,
+            "labels": {label: {"objects": c[0], "occluded": c[1], "images": c[2],
+                               "occlusion_rate": c[1] / c[0] if c[0] > 0 else 0.0}
+                       for label, c in sorted(self.labels.items())},
+            "histograms": {k: h.to_dict() for k, h in self.histograms.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "DatasetStatistics":
+        if d.get("version") != STATISTICS_VERSION:
+            raise Exception(f"unsupported statistics version {d.get('version')}")
+        s = cls()
+        s.images = d["images"]
+        s.objects = d["objects"]
+        s.objects_without_box = d.get("objects_without_box", 0)
+        s.labels = {label: [c["objects"], c["occluded"], c["images"]] for label, c in d["labels"].items()}
+        s.occluded = sum(c[1] for c in s.labels.values())
+        for k, h in d["histograms"].items():
+            s.histograms[k] = Histogram.from_dict(h)
+        return s
+
+
+def _batch_statistics(refs: list) -> DatasetStatistics:
+    return DatasetStatistics().add_annotations(ref.load() for ref in refs)
+
+
+def _load(ref) -> PascalVocAnnotation:
+    return ref.load()
+
+
+def dataset_statistics(sources: list, jobs: int = 1, batch_size: int = 256) -> DatasetStatistics:
+    """
+        statistics of all annotations of sources (anything with generate_refs, eg AnnotationZip, AnnotationDirectory,
+        ShardedAnnotationSource or an AnnotationIndex query). with jobs > 1, batches of annotations are parsed and counted
+        in worker processes and the partial results merged; at most 2 batches per worker are in flight.
+    """
+    result = DatasetStatistics()
+    if jobs <= 1:
+        for s in sources:
+            # sources with workers (AnnotationZip) decompress and parse in threads
+            result.add_annotations(ordered_map(_load, s.generate_refs(), getattr(s, "workers", 1)))
+        return result
+    refs = itertools.chain.from_iterable(s.generate_refs() for s in sources)
+    batches = batched(refs, batch_size)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        in_flight = collections.deque()
+        while True:
+            for batch in itertools.islice(batches, 2 * jobs - len(in_flight)):
+                in_flight.append(pool.submit(_batch_statistics, batch))
+            if len(in_flight) == 0:
+                break
+            result.merge(in_flight.popleft().result())
+    return result
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="compute statistics (label counts, box size histograms, occlusion and overlap) of annotation sources")
+    parser.add_argument("--source", type=pathlib.Path, action="append", default=[], help="annotation directory, zip or sharded dataset (repeat for more)")
+    parser.add_argument("--merge", type=pathlib.Path, action="append", default=[], help="statistics json of another run to merge into the result (repeat for more)")
+    parser.add_argument("--output", type=pathlib.Path, help="json file to write the statistics to (default: print them)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes (default=1)")
+    parser.add_argument("--parser", choices=["etree", "fast"], default="etree", help="annotation parser (default=etree)")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+    if len(args.source) == 0 and len(args.merge) == 0:
+        raise Exception("nothing to do: give at least one --source or --merge")
+    result = dataset_statistics([open_source(s, parser=args.parser) for s in args.source], jobs=args.jobs)
+    for pth in args.merge:
+        with open(pth) as f:
+            result.merge(DatasetStatistics.from_dict(json.load(f)))
+    d = result.to_dict()
+    if args.output is None:
+        print(json.dumps(d, indent=2))
+        return
+    with open(args.output, "w") as f:
+        json.dump(d, f, indent=2)
+    logging.info(f"{result.images} images, {result.objects} objects, {len(result.labels)} labels")
+
+
+if __name__ == "__main__":
+    main()
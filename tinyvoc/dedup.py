@@ -0,0 +1,126 @@
+"""
+    Content addressed image deduplication for the annotation writers.
+
+    Several sources (eg CVAT exports of the same video) can reference the same image. With a deduplicator, the writer
+    identifies images by the sha256 of their content (using the hash cache, see tinyvoc.hashcache), links or copies every
+    unique image once, and handles the annotations of a duplicate image according to a policy:
+
+    - merge: the objects of the duplicate annotation are added to the first annotation of the image (objects with the same
+      label, occlusion and bounding box are only kept once), no new annotation is written
+    - drop: the duplicate annotation is left out
+    - flag: the duplicate annotation is written, but refers to the image of the first one, and it is listed in duplicates.json
+"""
+import copy
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .hashutil import hash_from_file
+from .threadpool import ordered_map
+
+POLICIES = ("merge", "drop", "flag")
+
+ObjectKey = Tuple[str, bool, Optional[tuple]]
+
+
+def object_key(o) -> ObjectKey:
+    """
+        what makes two objects (PascalVocObject) the same for the merge policy
+    """
+    return (o.name, o.occluded, o.record.bndbox)
+
+
+class UniqueImage(object):
+    """
+        The first annotation that was written for an image: its id, the image filename it refers to (relative to the
+        image dir), the path of its xml, the keys of its objects and its split (if any). extra holds the <object>
+        elements merged into it.
+    """
+    __slots__ = ("id", "filename", "xml_path", "keys", "split", "extra")
+
+    def __init__(self, id: str, filename: str, xml_path: str, keys: Set[ObjectKey], split: Optional[str] = None) -> None:
+        self.id = id
+        self.filename = filename
+        self.xml_path = xml_path
+        self.keys = keys
+        self.split = split
+        self.extra = []
+
+
+class ImageDeduplicator(object):
+    """
+        Keeps track of the images that were written, by content hash. Hashes are computed once per file (digest is
+        thread safe), prefetch hashes a list of files on threads threads.
+    """
+    def __init__(self, policy: str = "merge", threads: int = 4) -> None:
+        if policy not in POLICIES:
+            raise Exception(f"unknown dedup policy {policy}")
+        self.policy = policy
+        self.threads = max(1, threads)
+        self.images: Dict[str, UniqueImage] = {}
+        self.duplicates: Dict[str, str] = {}
+        self.report: Dict[str, int] = {"unique_images": 0, "duplicate_images": 0, "merged_objects": 0,
+                                       "merged_annotations": 0, "dropped_annotations": 0, "flagged_annotations": 0}
+        self._digests: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def digest(self, path: str) -> str:
+        key = os.path.realpath(path)
+        with self._lock:
+            d = self._digests.get(key)
+        if d is None:
+            d = hash_from_file(key)
+            with self._lock:
+                self._digests[key] = d
+        return d
+
+    def prefetch(self, paths: Iterable[str]) -> None:
+        """
+            hashes the (existing) files in paths in parallel, so the digest calls that follow are answered from memory
+        """
+        todo = {os.path.realpath(p) for p in paths if p}
+        with self._lock:
+            todo = [p for p in todo if p not in self._digests and os.path.isfile(p)]
+        for _ in ordered_map(self.digest, todo, self.threads):
+            pass
+
+    def find(self, digest: str) -> Optional[UniqueImage]:
+        return self.images.get(digest)
+
+    def add_unique(self, digest: str, annotation, xml_path: str, split: Optional[str] = None) -> None:
+        self.images[digest] = UniqueImage(annotation.id, annotation.filename, xml_path, {object_key(o) for o in annotation.objects}, split)
+        self.report["unique_images"] += 1
+
+    def merge(self, first: UniqueImage, annotation) -> List[str]:
+        """
+            remembers the objects of annotation that first doesn't have yet, returns their labels.
+            the elements are added to the xml of first by write_merged
+        """
+        labels = []
+        for o in annotation.objects:
+            k = object_key(o)
+            if k in first.keys:
+                continue
+            first.keys.add(k)
+            first.extra.append(copy.deepcopy(o.el))
+            labels.append(o.name)
+        self.report["merged_objects"] += len(labels)
+        self.report["merged_annotations"] += 1
+        return labels
+
+    def write_merged(self) -> int:
+        """
+            rewrites the annotations that got objects of duplicates, returns how many there were
+        """
+        from .pvocutils import PascalVocAnnotation, PascalVocObject
+        from .fastparse import object_record
+        n = 0
+        for image in self.images.values():
+            if len(image.extra) == 0:
+                continue
+            annotation = PascalVocAnnotation(image.xml_path)
+            annotation.objects = annotation.objects + [PascalVocObject(el, object_record(el, None)) for el in image.extra]
+            annotation.write(image.xml_path)
+            image.extra = []
+            n += 1
+        return n
@@ -2,46 +2,185 @@
 import sys
 import os
 import argparse
+import json
+import logging
 import pathlib
+import tempfile
+import threading
 import zipfile
+import zlib
+from typing import Dict, List, Optional, Tuple
 from .pvocutils import DataLineage, LineageSource, SingleFileLineageSource, filter_args_for_datalineage
+from .hashcache import add_hash_cache_args, configure_hash_cache_from_args, HASH_CACHE_ARGS
+from .threadpool import ordered_map
+from . import perf
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="dataset preparation")
     parser.add_argument("--source", type=pathlib.Path, required=True, help="input zipfile")
-    parser.add_argument("--destination", type=pathlib.Path, required=True, help="output directory (will be deleted)")
+    parser.add_argument("--destination", type=pathlib.Path, required=True, help="output directory (files that are not in the zip are removed)")
+    parser.add_argument("--threads", type=int, default=4, help="number of threads for extracting (default=4)")
+    parser.add_argument("--perf-metrics", type=pathlib.Path, help="json file to write timings, counters and throughput of the processing stages to (enables instrumentation)")
+    add_hash_cache_args(parser)
     return parser.parse_args()
 
 
+def _member_path(opth: str, name: str) -> Optional[str]:
+    """
+        path of a zip member in the output directory, None for members that would end up outside of it
+    """
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if len(parts) == 0 or ".." in parts:
+        return None
+    return os.path.join(opth, *parts)
+
+
+def _file_crc(path: str) -> int:
+    crc = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+class ZipExploder(object):
+    """
+        Extracts a zipfile to a directory, only writing the members that are new or changed since the previous run.
+        A member is unchanged when its crc and size are the ones recorded in the manifest, and the file on disk still has
+        the size and mtime it had after extraction. Files without manifest entry are compared by their crc.
+        Members are extracted by a pool of threads (every thread reads from its own ZipFile) and written atomically
+        (to a temporary file that is renamed). Files in the output directory that are not in the zip are removed.
+    """
+    def __init__(self, zip_path: str, destination: str, manifest_path: str, threads: int = 4) -> None:
+        self.zip_path = zip_path
+        self.destination = destination
+        self.manifest_path = manifest_path
+        self.threads = threads
+        self._local = threading.local()
+        self._open_zips = []
+        self.counts = {"extracted": 0, "unchanged": 0, "removed": 0}
+
+    def _load_manifest(self) -> Dict[str, List[int]]:
+        if not os.path.isfile(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as f:
+            return json.load(f).get("members", {})
+
+    def _save_manifest(self, members: Dict[str, List[int]]) -> None:
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"members": members}, f)
+        os.replace(tmp, self.manifest_path)
+
+    def _zip(self) -> zipfile.ZipFile:
+        zip = getattr(self._local, "zip", None)
+        if zip is None:
+            zip = zipfile.ZipFile(self.zip_path, "r")
+            self._local.zip = zip
+            self._open_zips.append(zip)
+        return zip
+
+    def _is_unchanged(self, info: zipfile.ZipInfo, path: str, previous: Optional[List[int]]) -> bool:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if st.st_size != info.file_size:
+            return False
+        if previous is not None and previous == [info.CRC, info.file_size, st.st_mtime_ns]:
+            return True
+        return _file_crc(path) == info.CRC
+
+    def _extract(self, item) -> Tuple[List[int], bool]:
+        """
+            extracts one member (if needed), returns its manifest entry and whether it was extracted
+        """
+        info, path, previous = item
+        with perf.timer("hashing"):
+            extracted = not self._is_unchanged(info, path, previous)
+        if extracted:
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tinyvoc-", suffix=".part")
+            try:
+                with perf.timer("unzipping"), os.fdopen(fd, "wb") as f, self._zip().open(info) as src:
+                    for block in iter(lambda: src.read(1 << 20), b""):
+                        f.write(block)
+                perf.count("bytes_written", info.file_size)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return [info.CRC, info.file_size, os.stat(path).st_mtime_ns], extracted
+
+    def _remove_stale(self, wanted: set) -> None:
+        for root, dirs, files in os.walk(self.destination, topdown=False):
+            for fn in files:
+                path = os.path.join(root, fn)
+                if path not in wanted:
+                    os.unlink(path)
+                    self.counts["removed"] += 1
+            if root != self.destination and len(os.listdir(root)) == 0:
+                os.rmdir(root)
+
+    def run(self) -> Dict[str, int]:
+        os.makedirs(self.destination, exist_ok=True)
+        previous = self._load_manifest()
+        with zipfile.ZipFile(self.zip_path, "r") as zip_ref:
+            items = []
+            for info in zip_ref.infolist():
+                path = _member_path(self.destination, info.filename)
+                if path is None:
+                    logging.warning(f"skipping zip member {info.filename} (outside of the destination)")
+                    continue
+                if info.is_dir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+                items.append((info, path, previous.get(info.filename)))
+        members = {}
+        try:
+            results = ordered_map(self._extract, items, self.threads, max_pending=16 * self.threads)
+            for (info, _, _), (entry, extracted) in zip(items, results):
+                members[info.filename] = entry
+                self.counts["extracted" if extracted else "unchanged"] += 1
+        finally:
+            for z in self._open_zips:
+                z.close()
+        self._remove_stale(set(path for _, path, _ in items))
+        self._save_manifest(members)
+        return self.counts
+
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     args = get_args()
+    if args.perf_metrics:
+        perf.enable()
+    configure_hash_cache_from_args(args)
     pth = os.path.abspath(args.source)
     opth = os.path.abspath(args.destination)
     lineage = DataLineage()
     lineage.add_source(SingleFileLineageSource(pth))
-    for k,v in filter_args_for_datalineage(vars(args)).items():
+    for k,v in filter_args_for_datalineage(vars(args), ignore=("threads", "perf_metrics") + HASH_CACHE_ARGS).items():
         lineage.add_param(k,v)
     lineage_fn = str(args.destination.absolute())
     if lineage_fn.endswith("/"):
         lineage_fn = lineage_fn[:-1]
+    manifest_fn = lineage_fn + "_frames_manifest.json"
     lineage_fn += "_frames_lineage.yaml"
     if os.path.isfile(lineage_fn) and os.path.isdir(opth):
         old_lineage = DataLineage(lineage_fn)
         if lineage.is_uptodate_with(old_lineage):
             print("nothing to do, already done")
+            perf.write_report(args.perf_metrics)
             sys.exit(0)
     if len(str(opth)) < 3:
         raise Exception("invalid very short path {opth}.")
-    os.system("rm -f {opth}/*".format(opth=opth))
-    os.system("mkdir -p {opth}".format(opth=opth))
-    with zipfile.ZipFile(pth, 'r') as zip_ref:
-        zip_ref.extractall(opth)
+    counts = ZipExploder(pth, opth, manifest_fn, threads=args.threads).run()
+    print("extracted {extracted}, unchanged {unchanged}, removed {removed}".format(**counts))
     lineage.dump_yaml(lineage_fn)
+    perf.write_report(args.perf_metrics)
 
 if __name__ == '__main__':
     main()
-
-
-
-
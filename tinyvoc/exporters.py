@@ -0,0 +1,239 @@
+"""
+    Writers that export annotations as COCO json or as YOLO txt files instead of pascal voc xml files.
+
+    They are DirAnnotationWriters that only replace how an annotation is written (see DirAnnotationWriter._write_annotation),
+    so ids, the image treatments (linking, copying, renaming, rewriting paths), image deduplication (drop and flag), splits,
+    metrics and the data lineage work the same as for voc output, and an export is a single pass over the sources.
+    Incremental writing is not supported.
+
+    COCO: one json file (annotations/instances_default.json). The images and the objects are streamed to disk as they are
+    added (the objects to a temporary file that is appended at close), so memory use does not depend on the size of the
+    dataset. Image ids are numbered from 1 in the order the annotations are added, category ids from 1 in the order of
+    the classes (see below). bbox is [xmin, ymin, width, height] with width = xmax - xmin.
+
+    YOLO: one labels/<image name>.txt per image with a "<class> <x center> <y center> <width> <height>" line per object
+    (relative to the image size, so annotations without a size are skipped, unless the size is read from the image
+    with DirAnnotationWriter.enable_validation), classes.txt with the class names (line n
+    is class n) and images.txt with the path of every image (relative to the output root, or absolute). With the image treatments that link or copy, the images are
+    put in images/ (so the label file of every image is found by replacing images with labels in its path). As every
+    image has one label file, the flag dedup policy is not supported.
+
+    The classes are the given classes (eg the valid labels of prepare-annotations) followed by the labels that were not
+    given, in the order they are first seen.
+
+    Objects without a bounding box (eg polygons) can't be exported and are skipped; they are counted in the report of the
+    writer (objects_without_box).
+"""
+import json
+import logging
+import os
+import shutil
+from typing import Dict, List, Optional
+
+from . import perf
+from .pvocutils import DirAnnotationWriter, ImageTreatmentSetting, PascalVocAnnotation, _LINKING_TREATMENTS
+
+FORMATS = ("voc", "coco", "yolo")
+
+
+class _ClassList(object):
+    def __init__(self, classes: Optional[List[str]] = None) -> None:
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for c in classes or []:
+            self.get(c)
+
+    def get(self, name: str) -> int:
+        """
+            the (0 based) index of name, added at the end if it is new
+        """
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+
+class _NoIncremental(object):
+    """
+        mixin for the export writers: what DirAnnotationWriter supports, but they don't
+    """
+    def enable_incremental(self, params: Dict) -> None:
+        raise Exception(f"incremental writing is not supported for {self.format} output")
+
+    def enable_dedup(self, policy: str = "merge", threads: int = 4) -> None:
+        if policy == "merge":
+            # merging rewrites the first annotation of an image at close, which was already exported
+            raise Exception(f"the merge dedup policy is not supported for {self.format} output")
+        super().enable_dedup(policy, threads)
+
+    def write_dataset_meta(self):
+        """
+            nothing to do: everything is written at close
+        """
+        pass
+
+
+class CocoAnnotationWriter(_NoIncremental, DirAnnotationWriter):
+    format = "coco"
+
+    def __init__(self, root_dir: str, annotation_output_dir: Optional[str] = None, classes: Optional[List[str]] = None,
+                 filename: str = "instances_default.json") -> None:
+        if annotation_output_dir is None:
+            annotation_output_dir = os.path.join(root_dir, "annotations")
+        super().__init__(root_dir, annotation_output_dir)
+        self.classes = _ClassList(classes)
+        self.json_path = os.path.join(self.annotation_output_dir, filename)
+        self.n_images = 0
+        self.n_objects = 0
+        self.report: Dict[str, int] = {"objects_without_box": 0}
+        # opened on the first annotation, so nothing is left behind if nothing is written
+        self._images = None
+        self._objects = None
+        self._closed = False
+
+    def _open(self) -> None:
+        self._images = open(self.json_path + ".part", "w")
+        self._images.write('{"images":[')
+        self._objects = open(self.json_path + ".objects.part", "w")
+
+    def _write_annotation(self, annotation: PascalVocAnnotation) -> str:
+        if self._images is None:
+            self._open()
+        with perf.timer("writing"):
+            self.n_images += 1
+            size = annotation.size or (0, 0, 0)
+            image = {"id": self.n_images, "file_name": annotation.filename, "width": size[0], "height": size[1]}
+            self._images.write(("," if self.n_images > 1 else "") + json.dumps(image, separators=(",", ":")))
+            for o in annotation.objects:
+                b = o.boundingbox
+                if b is None:
+                    self.report["objects_without_box"] += 1
+                    continue
+                self.n_objects += 1
+                w = b.xmax - b.xmin
+                h = b.ymax - b.ymin
+                obj = {
+                    "id": self.n_objects, "image_id": self.n_images, "category_id": self.classes.get(o.name) + 1,
+                    "bbox": [b.xmin, b.ymin, w, h], "area": w * h, "iscrowd": 0, "segmentation": [],
+                    "attributes": dict(o.attributes, occluded=bool(o.occluded)),
+                }
+                self._objects.write(("," if self.n_objects > 1 else "") + json.dumps(obj, separators=(",", ":")))
+        return self.json_path
+
+    def close(self) -> None:
+        super().close()
+        if self._closed:
+            return
+        self._closed = True
+        if self._images is None:
+            self._open()
+        with perf.timer("writing"):
+            self._objects.close()
+            f = self._images
+            f.write('],"annotations":[')
+            with open(self.json_path + ".objects.part") as objects:
+                shutil.copyfileobj(objects, f)
+            categories = [{"id": i + 1, "name": name, "supercategory": ""} for i, name in enumerate(self.classes.names)]
+            f.write('],"categories":' + json.dumps(categories, separators=(",", ":")) + "}")
+            f.close()
+            os.remove(self.json_path + ".objects.part")
+            os.replace(self.json_path + ".part", self.json_path)
+        logging.info(f"wrote {self.n_images} images and {self.n_objects} objects to {self.json_path}")
+        if self.report["objects_without_box"] > 0:
+            logging.warning(f"skipped {self.report['objects_without_box']} objects without bounding box")
+
+
+class YoloAnnotationWriter(_NoIncremental, DirAnnotationWriter):
+    format = "yolo"
+
+    def __init__(self, root_dir: str, annotation_output_dir: Optional[str] = None, classes: Optional[List[str]] = None) -> None:
+        if annotation_output_dir is None:
+            annotation_output_dir = os.path.join(root_dir, "labels")
+        super().__init__(root_dir, annotation_output_dir)
+        self.image_dir = os.path.join(self.root_dir, "images")
+        self.classes = _ClassList(classes)
+        self.report: Dict[str, int] = {"objects_without_box": 0, "annotations_without_size": 0}
+        self._linked = False
+        self._image_list = None
+        self._closed = False
+
+    def add_located_annotation(self, annotation: PascalVocAnnotation, img_path: str, treat_image: ImageTreatmentSetting, ref=None) -> None:
+        self._linked = treat_image in _LINKING_TREATMENTS
+        return super().add_located_annotation(annotation, img_path, treat_image, ref)
+
+    def enable_dedup(self, policy: str = "merge", threads: int = 4) -> None:
+        if policy == "flag":
+            # a flagged duplicate refers to the image of the first annotation, so it would get (and overwrite) its label file
+            raise Exception(f"the flag dedup policy is not supported for {self.format} output")
+        super().enable_dedup(policy, threads)
+
+    def _validate(self, annotation: PascalVocAnnotation, img_path: str) -> bool:
+        # after the validation, which can fill in the size from the image
+        if not super()._validate(annotation, img_path):
+            return False
+        size = annotation.size
+        if size is None or size[0] <= 0 or size[1] <= 0:
+            logging.warning(f"annotation {annotation.id} has no image size, can't write yolo labels, removing annotation")
+            self.report["annotations_without_size"] += 1
+            return False
+        return True
+
+    def _write_annotation(self, annotation: PascalVocAnnotation) -> str:
+        width, height = annotation.size[:2]
+        # like in voc, a relative image filename is relative to image_dir
+        image = annotation.filename
+        if not os.path.isabs(image):
+            image = os.path.normpath(os.path.join("images", image))
+        if self._linked:
+            # the image is in images/, the label file must have the same name
+            name = os.path.splitext(os.path.basename(annotation.filename))[0]
+        else:
+            name = annotation.id
+        pth = os.path.join(self.annotation_output_dir, name + ".txt")
+        lines = []
+        for o in annotation.objects:
+            b = o.boundingbox
+            if b is None:
+                self.report["objects_without_box"] += 1
+                continue
+            lines.append("%d %.6f %.6f %.6f %.6f\n" % (self.classes.get(o.name), (b.xmin + b.xmax) / 2 / width,
+                                                       (b.ymin + b.ymax) / 2 / height, (b.xmax - b.xmin) / width,
+                                                       (b.ymax - b.ymin) / height))
+        with perf.timer("writing"):
+            with open(pth, "w") as f:
+                f.writelines(lines)
+            if self._image_list is None:
+                self._image_list = open(os.path.join(self.root_dir, "images.txt.part"), "w")
+            self._image_list.write(image + "\n")
+        return pth
+
+    def close(self) -> None:
+        super().close()
+        if self._closed:
+            return
+        self._closed = True
+        if self._image_list is None:
+            self._image_list = open(os.path.join(self.root_dir, "images.txt.part"), "w")
+        self._image_list.close()
+        os.replace(os.path.join(self.root_dir, "images.txt.part"), os.path.join(self.root_dir, "images.txt"))
+        with open(os.path.join(self.root_dir, "classes.txt"), "w") as f:
+            f.writelines(name + "\n" for name in self.classes.names)
+        if self.report["annotations_without_size"] > 0:
+            logging.warning(f"skipped {self.report['annotations_without_size']} annotations without image size")
+        if self.report["objects_without_box"] > 0:
+            logging.warning(f"skipped {self.report['objects_without_box']} objects without bounding box")
+
+
+def create_writer(fmt: str, root_dir: str, annotation_output_dir: Optional[str] = None, classes: Optional[List[str]] = None) -> DirAnnotationWriter:
+    """
+        the writer for fmt (one of FORMATS). annotation_output_dir defaults to Annotations (voc), annotations (coco) or
+        labels (yolo) in root_dir
+    """
+    if fmt == "voc":
+        return DirAnnotationWriter(root_dir, annotation_output_dir)
+    if fmt == "coco":
+        return CocoAnnotationWriter(root_dir, annotation_output_dir, classes)
+    if fmt == "yolo":
+        return YoloAnnotationWriter(root_dir, annotation_output_dir, classes)
+    raise Exception(f"unknown output format {fmt}, should be one of {', '.join(FORMATS)}")
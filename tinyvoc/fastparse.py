@@ -0,0 +1,226 @@
+"""
+    Single pass parser that turns a pascal voc xml file into lightweight records, without keeping a DOM around.
+
+    The xml is parsed with the C accelerated xml.etree.ElementTree parser, or with lxml (backend="lxml"). Every element
+    is visited once and only the fields we use are kept. For files as small as VOC annotations, this turned out to be
+    faster than lxml.etree.iterparse (which has a high per-file overhead) and than lxml element access from python.
+    A modified annotation is written by splice_annotation: the changed header elements (filename, folder, size) are
+    replaced in the original bytes and removed objects are cut out, so no DOM is built or serialized (serializing with
+    xml.etree is slower than parsing). Other changes (eg a renamed object) need a DOM: with keep_root, the parsed
+    (xml.etree) root element is kept in the record, so PascalVocAnnotation (parser="fast") can use it instead of parsing
+    the bytes again.
+"""
+from typing import Dict, List, Optional, Tuple
+import re
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+PARSERS = ("etree", "fast")
+
+
+class ObjectRecord(object):
+    """
+        the fields of one <object>. index is the position of the object in the xml file (None for new objects)
+    """
+    __slots__ = ("index", "name", "bndbox", "occluded", "attributes")
+
+    def __init__(self, index: Optional[int]) -> None:
+        self.index = index
+        self.name: Optional[str] = None
+        self.bndbox: Optional[Tuple[float, float, float, float]] = None
+        self.occluded = False
+        self.attributes: Dict[str, str] = {}
+
+
+class AnnotationRecord(object):
+    """
+        rejected is the number of objects that were left out by the object filter. root is the parsed root element
+        (only with parse_record(..., keep_root=True)). objects is None if they were not read yet (see parse_record)
+    """
+    __slots__ = ("filename", "folder", "size", "objects", "rejected", "root")
+
+    def __init__(self) -> None:
+        self.filename: Optional[str] = None
+        self.folder: Optional[str] = None
+        self.size: Optional[Tuple[int, int, int]] = None
+        self.objects: Optional[List[ObjectRecord]] = []
+        self.rejected = 0
+        self.root = None
+
+
+def _to_int(text: Optional[str]) -> int:
+    try:
+        return int(float(text))
+    except (TypeError, ValueError):
+        return 0
+
+
+def object_record(el, index: Optional[int]) -> ObjectRecord:
+    """
+        reads the fields of an <object> element (ElementTree or lxml) in one pass
+    """
+    o = ObjectRecord(index)
+    for child in el:
+        tag = child.tag
+        if tag == "name":
+            o.name = child.text
+        elif tag == "bndbox" and len(child) > 0:
+            coords = {c.tag: c.text for c in child}
+            o.bndbox = (float(coords["xmin"]), float(coords["ymin"]), float(coords["xmax"]), float(coords["ymax"]))
+        elif tag == "occluded":
+            o.occluded = _to_int(child.text) == 1
+        elif tag == "attributes":
+            for a in child:
+                o.attributes[a.findtext("name")] = a.findtext("value")
+    return o
+
+
+def filtered_object_record(el, index: int, object_filter) -> Optional[ObjectRecord]:
+    """
+        like object_record, but returns None as soon as a field is rejected by object_filter (a tinyvoc.objectfilter.ObjectFilter)
+    """
+    o = ObjectRecord(index)
+    for child in el:
+        tag = child.tag
+        if tag == "name":
+            o.name = child.text
+            if not object_filter.accepts_name(o.name):
+                return None
+        elif tag == "bndbox" and len(child) > 0:
+            coords = {c.tag: c.text for c in child}
+            o.bndbox = (float(coords["xmin"]), float(coords["ymin"]), float(coords["xmax"]), float(coords["ymax"]))
+            if not object_filter.accepts_box(o.bndbox):
+                return None
+        elif tag == "occluded":
+            o.occluded = _to_int(child.text) == 1
+            if not object_filter.accepts_occluded(o.occluded):
+                return None
+        elif tag == "attributes":
+            for a in child:
+                o.attributes[a.findtext("name")] = a.findtext("value")
+    return o if object_filter.accepts(o) else None
+
+
+def parse_record(data: bytes, backend: str = "etree", object_filter=None, keep_root: bool = False) -> AnnotationRecord:
+    """
+        parses the xml in data into an AnnotationRecord. backend is "etree" or "lxml" (falls back to etree if lxml is missing)
+        objects rejected by object_filter (see tinyvoc.objectfilter) are skipped, the index of the other objects is still
+        their position in the xml. keep_root keeps the root element in the record (with the etree backend). without an
+        object_filter, the objects are then left for later (objects is None, read them from root with object_record),
+        as annotations that are only copied or have their header changed don't need them.
+    """
+    if backend == "lxml" and lxml_etree is not None:
+        root = lxml_etree.fromstring(data)
+    else:
+        root = ET.fromstring(data)
+    rec = AnnotationRecord()
+    lazy = False
+    if keep_root and backend != "lxml":
+        rec.root = root
+        lazy = object_filter is None
+        if lazy:
+            rec.objects = None
+    n_objects = 0
+    for el in root:
+        tag = el.tag
+        if tag == "object":
+            if lazy:
+                continue
+            if object_filter is None:
+                rec.objects.append(object_record(el, n_objects))
+            else:
+                o = filtered_object_record(el, n_objects, object_filter)
+                if o is None:
+                    rec.rejected += 1
+                else:
+                    rec.objects.append(o)
+            n_objects += 1
+        elif tag == "filename":
+            rec.filename = el.text
+        elif tag == "folder":
+            rec.folder = el.text
+        elif tag == "size":
+            rec.size = (_to_int(el.findtext("width")), _to_int(el.findtext("height")), _to_int(el.findtext("depth")))
+    return rec
+
+
+_OBJECT_RE = re.compile(rb"<object[\s>].*?</object\s*>", re.S)
+_OBJECT_START_RE = re.compile(rb"<object[\s/>]")
+_ROOT_END_RE = re.compile(rb"</annotation\s*>")
+_NOT_SPLICEABLE = (b"<!--", b"<![CDATA[", b"<!DOCTYPE", b"<!ENTITY")
+
+
+def _escape(text: str) -> bytes:
+    # like xml.etree, encoded so it fits in any ascii compatible document
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return text.encode("ascii", "xmlcharrefreplace")
+
+
+def text_element(tag: str, text: Optional[str]) -> bytes:
+    if not text:
+        return b"<%s />" % tag.encode()
+    return b"<%s>%s</%s>" % (tag.encode(), _escape(text), tag.encode())
+
+
+def size_element(size: Tuple[int, int, int]) -> bytes:
+    return b"<size><width>%d</width><height>%d</height><depth>%d</depth></size>" % tuple(size)
+
+
+def splice_annotation(data: bytes, elements: Dict[str, bytes], kept: Optional[List[int]] = None, n_objects: int = 0) -> Optional[bytes]:
+    """
+        the annotation xml in data, with the header elements in elements (tag -> new element, see text_element and
+        size_element) replaced (a missing size is inserted before the objects) and, if kept is not None, only the objects
+        whose index is in kept (in increasing order; n_objects is the number of objects in data).
+        returns None when this can't be done safely on the bytes (comments, CDATA, encodings that are not ascii compatible,
+        elements that are not where VOC puts them, ...): the caller should serialize a DOM instead.
+    """
+    if data[:2] in (b"\xff\xfe", b"\xfe\xff") or any(x in data for x in _NOT_SPLICEABLE):
+        return None
+    decl = re.match(rb"\s*<\?xml[^>]*encoding=[\"']([^\"']+)", data)
+    if decl is not None and decl.group(1).lower().startswith((b"utf-16", b"utf-32", b"ucs")):
+        return None
+    objects = [m.span() for m in _OBJECT_RE.finditer(data)]
+    if len(objects) != len(_OBJECT_START_RE.findall(data)):
+        # nested or unterminated objects
+        return None
+    first_object = objects[0][0] if len(objects) > 0 else len(data)
+    edits = []
+    for tag, element in elements.items():
+        matches = list(re.finditer(rb"<%s(?:\s[^>]*)?(?:/>|>.*?</%s\s*>)" % (tag.encode(), tag.encode()), data, re.S))
+        if len(matches) == 1 and matches[0].end() <= first_object:
+            edits.append((matches[0].start(), matches[0].end(), element))
+        elif len(matches) == 0 and tag == "size":
+            pos = first_object if len(objects) > 0 else None
+            if pos is None:
+                end = _ROOT_END_RE.search(data)
+                if end is None:
+                    return None
+                pos = end.start()
+            edits.append((pos, pos, element))
+        else:
+            return None
+    if kept is not None:
+        if len(objects) != n_objects or any(b <= a for a, b in zip(kept, kept[1:])) or any(i < 0 or i >= n_objects for i in kept):
+            return None
+        keep = set(kept)
+        for i, (start, end) in enumerate(objects):
+            if i not in keep:
+                # with the indentation in front of it
+                while start > 0 and data[start - 1:start] in (b" ", b"\t", b"\n", b"\r"):
+                    start -= 1
+                edits.append((start, end, b""))
+    edits.sort(key=lambda e: (e[0], e[1]))
+    out = []
+    pos = 0
+    for start, end, replacement in edits:
+        if start < pos:
+            return None
+        out.append(data[pos:start])
+        out.append(replacement)
+        pos = end
+    out.append(data[pos:])
+    return b"".join(out)
@@ -0,0 +1,144 @@
+"""
+    Cheap file copies for the annotation writers.
+
+    A copy is made with the cheapest method that works: a hardlink (same filesystem, no data is written), a reflink
+    (copy on write clone on btrfs/xfs/...), os.copy_file_range (the kernel copies the data, without going through
+    userspace) and finally shutil.copy2. Copies are written to a temporary file that is renamed, so a destination is
+    never half written.
+
+    CopyPool runs the copies on a bounded thread pool, so they overlap with whatever the caller is doing (eg writing xml).
+"""
+import collections
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from . import perf
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux ioctl to clone a file (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+METHODS = ("hardlink", "reflink", "copy_file_range", "copy")
+
+# errors that mean "this method is not possible here", as opposed to real io errors
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL,
+                errno.ENOTTY, errno.EBADF, errno.ETXTBSY}
+
+
+def _reflink(src: str, tmp: str) -> None:
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink not supported on this platform")
+    with open(src, "rb") as s, open(tmp, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _copy_file_range(src: str, tmp: str) -> None:
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    with open(src, "rb") as s, open(tmp, "wb") as d:
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            n = os.copy_file_range(s.fileno(), d.fileno(), min(remaining, 1 << 30))
+            if n == 0:
+                break
+            remaining -= n
+
+
+def fast_copy(src: str, dst: str, allow_hardlink: bool = True) -> str:
+    """
+        copies src to dst (replacing dst), returns the method that was used (see METHODS).
+        with allow_hardlink, dst can be a hardlink to src: they share their content, so modifying one modifies the other.
+    """
+    # hardlinking a symlink would link the symlink itself
+    src = os.path.realpath(src)
+    dirname = os.path.dirname(os.path.abspath(dst))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tinyvoc-", suffix=".part")
+    os.close(fd)
+    try:
+        if allow_hardlink:
+            os.unlink(tmp)
+            try:
+                os.link(src, tmp)
+                os.replace(tmp, dst)
+                return "hardlink"
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+        for method, fn in (("reflink", _reflink), ("copy_file_range", _copy_file_range)):
+            try:
+                fn(src, tmp)
+                shutil.copystat(src, tmp)
+                os.replace(tmp, dst)
+                return method
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+        return "copy"
+    finally:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+
+
+class CopyPool(object):
+    """
+        Runs fast_copy on a pool of threads. At most max_pending copies are queued, submit blocks when there are more.
+        Errors are raised by submit or close. report has the number of files and bytes per method, the time spent copying
+        (summed over the threads) and the time the caller had to wait for the pool.
+    """
+    def __init__(self, threads: int = 4, max_pending: Optional[int] = None, allow_hardlink: bool = True) -> None:
+        self.threads = max(1, threads)
+        self.max_pending = max_pending if max_pending is not None else 8 * self.threads
+        self.allow_hardlink = allow_hardlink
+        self._pool = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = collections.deque()
+        self.report: Dict[str, float] = {"files": 0, "bytes": 0, "copy_seconds": 0.0, "wait_seconds": 0.0}
+        for m in METHODS:
+            self.report[m] = 0
+
+    def _copy(self, src: str, dst: str) -> Tuple[str, int, float]:
+        start = time.perf_counter()
+        with perf.timer("copying"):
+            method = fast_copy(src, dst, self.allow_hardlink)
+        size = os.path.getsize(dst)
+        if method in ("copy_file_range", "copy"):
+            perf.count("bytes_written", size)
+        return method, size, time.perf_counter() - start
+
+    def _collect(self, future: Future) -> None:
+        start = time.perf_counter()
+        method, size, seconds = future.result()
+        self.report["wait_seconds"] += time.perf_counter() - start
+        self.report["files"] += 1
+        self.report["bytes"] += size
+        self.report["copy_seconds"] += seconds
+        self.report[method] += 1
+
+    def submit(self, src: str, dst: str) -> None:
+        self._pending.append(self._pool.submit(self._copy, src, dst))
+        while len(self._pending) > self.max_pending:
+            self._collect(self._pending.popleft())
+
+    def close(self) -> Dict[str, float]:
+        """
+            waits for all copies, returns the report
+        """
+        try:
+            while len(self._pending) > 0:
+                self._collect(self._pending.popleft())
+        finally:
+            self._pool.shutdown(wait=True)
+        logging.info("copied {files} files ({bytes} bytes) in {copy_seconds:.2f}s: {hardlink} hardlinks, {reflink} reflinks, "
+                     "{copy_file_range} copy_file_range, {copy} full copies".format(**self.report))
+        return self.report
@@ -0,0 +1,138 @@
+"""
+    Merkle fingerprint of an annotation directory, used as source hash in the data lineage of directories that have no
+    data-lineage.yaml (eg hand curated datasets), so they can be checked for changes like any other source.
+
+    Every annotation file is a leaf: its hash combines the sha256 of the xml, the image filename it refers to and the size
+    and mtime of that image (as found by the image locator; images are not hashed, they can be big and a changed image gets
+    a new mtime). Every directory is a node: the hash of the names and hashes of its children. The fingerprint is the hash
+    of the root.
+
+    With a hash cache (see tinyvoc.hashcache), the sha256 and image filename of every annotation are cached by path, inode,
+    size and mtime, and read for the whole tree with a single query, so an unchanged tree costs a stat per file. Only
+    annotations that changed are read, on threads threads. Without a cache, every annotation is read and hashed, which is
+    why AnnotationDirectory only fingerprints a directory when a hash cache is used.
+"""
+import hashlib
+import logging
+import os
+import xml.etree.ElementTree as ET
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from . import perf
+from .fastparse import parse_record
+from .hashcache import HashCache
+from .threadpool import ordered_map
+
+# the derived value (sha256 and image filename of an annotation) in the hash cache
+CACHE_ALGO = "tinyvoc-annotation-v1"
+DEFAULT_THREADS = 8
+
+
+def _hash_annotation(path: str, parser: str = "etree") -> str:
+    """
+        returns "<sha256 of the file>:<image filename>", the filename is read with parser (see tinyvoc.fastparse.PARSERS)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    perf.count("bytes_read", len(data))
+    try:
+        if parser == "fast":
+            fn = parse_record(data).filename or ""
+        else:
+            fn = ET.fromstring(data).findtext("filename") or ""
+    except Exception:
+        # not an annotation (or a broken one): its content still counts
+        fn = ""
+    return hashlib.sha256(data).hexdigest() + ":" + fn
+
+
+class DirectoryFingerprint(object):
+    """
+        locator: the tinyvoc.pvocutils.ImageLocator to find the images with (in the same way the writers do)
+        parser: how the annotations are parsed ("etree" or "fast", like the sources)
+    """
+    def __init__(self, path, locator, cache: Optional[HashCache] = None, threads: int = DEFAULT_THREADS, parser: str = "etree") -> None:
+        self.path = os.path.abspath(str(path))
+        self.locator = locator
+        self.cache = cache
+        self.threads = threads
+        self.parser = parser
+        self.changed = 0
+
+    def _walk(self) -> Tuple[List[str], Dict[str, List[Tuple[str, str]]], List[Tuple[str, os.stat_result]]]:
+        """
+            the directories (relative to path, parents first), the (name, path) of the xml files per directory and the
+            (path, stat) of every xml file. follows the same rules as AnnotationDirectory.generate_refs (os.walk)
+        """
+        dirs = []
+        files = {}
+        stats = []
+        todo = ["."]
+        while todo:
+            rel = todo.pop()
+            dirs.append(rel)
+            xmls = []
+            try:
+                entries = sorted(os.scandir(os.path.join(self.path, rel)), key=lambda e: e.name)
+            except OSError:
+                entries = []
+            for entry in entries:
+                name = entry.name
+                if entry.is_dir():
+                    # like os.walk, symlinks to directories are not followed
+                    if not entry.is_symlink():
+                        todo.append(os.path.normpath(os.path.join(rel, name)))
+                # checking the last 4 characters first is a lot faster for big image folders
+                elif name[-4:].lower() == '.xml' and os.path.splitext(name)[1].lower() == '.xml':
+                    xmls.append((name, entry.path))
+                    stats.append((entry.path, entry.stat()))
+            files[rel] = xmls
+        perf.count("stat_calls", len(stats))
+        return dirs, files, stats
+
+    def _annotation_values(self, stats: List[Tuple[str, os.stat_result]]) -> Dict[str, str]:
+        cached = self.cache.get_many(self.path, CACHE_ALGO) if self.cache is not None else {}
+        values = {}
+        todo = []
+        for pth, st in stats:
+            entry = cached.get(pth)
+            if entry is not None and entry[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+                values[pth] = entry[3]
+            else:
+                todo.append((pth, st))
+        self.changed = len(todo)
+        if len(todo) > 0:
+            with perf.timer("hashing"):
+                hashed = list(ordered_map(partial(_hash_annotation, parser=self.parser), [pth for pth, _ in todo], self.threads))
+            for (pth, _), value in zip(todo, hashed):
+                values[pth] = value
+            if self.cache is not None:
+                self.cache.put_many(((pth, st, v) for (pth, st), v in zip(todo, hashed)), CACHE_ALGO)
+        return values
+
+    def _leaf(self, name: str, value: str) -> str:
+        fn = value.split(":", 1)[1]
+        img = self.locator.locate_filename(fn, self.path) if fn != "" else ""
+        if img != "":
+            st = os.stat(img)
+            return f"{name} {value} {st.st_size}:{st.st_mtime_ns}"
+        return f"{name} {value} missing"
+
+    def compute(self) -> str:
+        dirs, files, stats = self._walk()
+        values = self._annotation_values(stats)
+        self.locator.index_roots([self.path])
+        children: Dict[str, List[str]] = {rel: [] for rel in dirs}
+        root_hash = ""
+        # children before parents
+        for rel in reversed(dirs):
+            lines = children[rel] + [self._leaf(name, values[pth]) for name, pth in files[rel]]
+            lines.sort()
+            h = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+            if rel == ".":
+                root_hash = h
+            else:
+                children[os.path.dirname(rel) or "."].append(f"{os.path.basename(rel)}/ {h}")
+        logging.info(f"fingerprinted {len(stats)} annotations in {self.path} ({self.changed} not cached)")
+        return root_hash
@@ -0,0 +1,244 @@
+"""
+    Persistent cache for file content hashes.
+
+    Hashing the multi-GB zips and videos that are the input of our DVC stages takes longer than the rest of a no-op run.
+    The HashCache remembers the hash of a file together with its (path, inode, size, mtime_ns) and only rehashes when one of these changes.
+"""
+import argparse
+import atexit
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple, Union
+import pathlib
+
+from . import perf
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# files modified less than this many seconds ago are not cached: a second write within the mtime granularity would go unnoticed
+RACY_WINDOW = 2.0
+
+# last_used is only updated for entries that were not used for this many seconds, so reads rarely write
+TOUCH_INTERVAL = 3600.0
+
+
+def hash_file_plain(path: str, blocksize: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        block = f.read(blocksize)
+        while len(block) > 0:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+
+def hash_file_readahead(path: str, depth: int, blocksize: int = 4 * 1024 * 1024) -> str:
+    """
+        The sha256 of a file (the same as hash_file_plain), but the file is read on a separate thread, up to depth blocks
+        ahead of the hashing, so reading and hashing overlap. hashlib releases the GIL while hashing, so a thread is enough.
+    """
+    h = hashlib.sha256()
+    blocks = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def read() -> None:
+        try:
+            with open(path, "rb") as f:
+                while not stop.is_set():
+                    block = f.read(blocksize)
+                    blocks.put(block)
+                    if len(block) == 0:
+                        return
+        except BaseException as e:
+            blocks.put(e)
+
+    reader = threading.Thread(target=read, name="tinyvoc-hash-readahead", daemon=True)
+    reader.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, BaseException):
+                raise block
+            if len(block) == 0:
+                break
+            h.update(block)
+    finally:
+        stop.set()
+        # unblock the reader if it is waiting for room in the queue
+        while reader.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    return h.hexdigest()
+
+
+class HashCache(object):
+    """
+        sqlite backed cache of file hashes, keyed by (path, inode, size, mtime_ns).
+        At most max_entries hashes are kept, the least recently used ones are evicted first.
+        When threads > 1, files that are not in the cache are hashed with hash_file_readahead (threads blocks ahead);
+        the digest is the sha256 of the file either way.
+        The cache can be used from multiple threads; multiple processes can share the same file: every write is committed
+        right away (the connection is in autocommit mode), so the write lock is never held between calls.
+    """
+    def __init__(self, path: Union[str, pathlib.Path], max_entries: int = DEFAULT_MAX_ENTRIES, threads: int = 1) -> None:
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.threads = threads
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._puts_since_evict = 0
+        d = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(d, exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT NOT NULL, algo TEXT NOT NULL, inode INTEGER, size INTEGER, mtime_ns INTEGER,
+            digest TEXT, last_used REAL, PRIMARY KEY (path, algo))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes(last_used)")
+
+    # the digests of hash_file
+    algo = "sha256"
+
+    def get(self, path: str, st: Optional[os.stat_result] = None, algo: Optional[str] = None) -> Optional[str]:
+        """
+            the cached digest of path, None if it is not cached or the file changed. see get_many for algo
+        """
+        algo = algo or self.algo
+        path = os.path.abspath(path)
+        if st is None:
+            st = os.stat(path)
+        with self._lock:
+            row = self.db.execute("SELECT inode, size, mtime_ns, digest, last_used FROM hashes WHERE path=? AND algo=?", (path, algo)).fetchone()
+            if row is None or tuple(row[:3]) != (st.st_ino, st.st_size, st.st_mtime_ns):
+                return None
+            now = time.time()
+            if row[4] is None or row[4] < now - TOUCH_INTERVAL:
+                self.db.execute("UPDATE hashes SET last_used=? WHERE path=? AND algo=?", (now, path, algo))
+            return row[3]
+
+    def put(self, path: str, st: os.stat_result, digest: str, algo: Optional[str] = None) -> None:
+        if time.time() - st.st_mtime_ns / 1e9 < RACY_WINDOW:
+            return
+        algo = algo or self.algo
+        path = os.path.abspath(path)
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?)",
+                            (path, algo, st.st_ino, st.st_size, st.st_mtime_ns, digest, time.time()))
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= 1000:
+                self._evict()
+
+    def get_many(self, directory: str, algo: Optional[str] = None) -> Dict[str, Tuple[int, int, int, str]]:
+        """
+            all cached entries for the files under directory, as path -> (inode, size, mtime_ns, digest), with a single query.
+            algo defaults to the algo of this cache, other values can be used to cache other things that are derived from
+            the content of a file.
+        """
+        algo = algo or self.algo
+        lo = os.path.join(os.path.abspath(directory), "")
+        hi = lo[:-1] + chr(ord(os.sep) + 1)
+        now = time.time()
+        with self._lock:
+            rows = self.db.execute("SELECT path, inode, size, mtime_ns, digest FROM hashes WHERE path>=? AND path<? AND algo=?", (lo, hi, algo)).fetchall()
+            # only touch entries that were not used recently, so a no-op run does not rewrite the whole table
+            self.db.execute("UPDATE hashes SET last_used=? WHERE path>=? AND path<? AND algo=? AND last_used<?", (now, lo, hi, algo, now - TOUCH_INTERVAL))
+        return {r[0]: (r[1], r[2], r[3], r[4]) for r in rows}
+
+    def put_many(self, entries: Iterable[Tuple[str, os.stat_result, str]], algo: Optional[str] = None) -> None:
+        """
+            caches (path, stat, digest) entries, like put
+        """
+        algo = algo or self.algo
+        now = time.time()
+        rows = [(os.path.abspath(path), algo, st.st_ino, st.st_size, st.st_mtime_ns, digest, now)
+                for path, st, digest in entries if now - st.st_mtime_ns / 1e9 >= RACY_WINDOW]
+        if len(rows) == 0:
+            return
+        with self._lock:
+            # one transaction for the batch
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?)", rows)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            self._puts_since_evict += len(rows)
+            if self._puts_since_evict >= 1000:
+                self._evict()
+
+    def _evict(self) -> None:
+        self._puts_since_evict = 0
+        (count,) = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()
+        if count <= self.max_entries:
+            return
+        # evict a bit more than needed, so we don't have to do this on every put
+        n_remove = count - int(self.max_entries * 0.9)
+        self.db.execute("DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)", (n_remove,))
+        logging.info(f"evicted {n_remove} entries from hash cache {self.path}")
+
+    def hash_file(self, path: Union[str, pathlib.Path]) -> str:
+        path = str(path)
+        st = os.stat(path)
+        digest = self.get(path, st)
+        if digest is not None:
+            self.hits += 1
+            return digest
+        self.misses += 1
+        perf.count("bytes_read", st.st_size)
+        if self.threads > 1:
+            digest = hash_file_readahead(path, self.threads)
+        else:
+            digest = hash_file_plain(path)
+        # if the file changed while we were hashing, don't cache
+        if os.stat(path).st_mtime_ns == st.st_mtime_ns:
+            self.put(path, st, digest)
+        return digest
+
+    def flush(self) -> None:
+        with self._lock:
+            self._evict()
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
+
+
+def default_cache_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "tinyvoc", "hashes.sqlite")
+
+
+def add_hash_cache_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--hash-cache", type=str, default=os.environ.get("TINYVOC_HASH_CACHE"),
+                        help="sqlite file to cache file hashes in ('default' for ~/.cache/tinyvoc/hashes.sqlite). defaults to $TINYVOC_HASH_CACHE, no caching if unset")
+    parser.add_argument("--hash-cache-size", type=int, default=DEFAULT_MAX_ENTRIES, help="maximum number of hashes to keep in the cache")
+    parser.add_argument("--hash-threads", type=int, default=1,
+                        help="when hashing a file, read up to this many blocks ahead on a separate thread, so reading and hashing overlap (the hashes don't change)")
+
+HASH_CACHE_ARGS = ("hash_cache", "hash_cache_size", "hash_threads")
+
+
+def configure_hash_cache_from_args(args: argparse.Namespace) -> Optional[HashCache]:
+    """
+        sets up the default hash cache used by hashutil.hash_from_file, according to the arguments added by add_hash_cache_args
+    """
+    from .hashutil import set_default_hash_cache
+    if not args.hash_cache:
+        if args.hash_threads > 1:
+            logging.warning("--hash-threads only has an effect when a hash cache is used")
+        return None
+    path = default_cache_path() if args.hash_cache == "default" else args.hash_cache
+    cache = HashCache(path, max_entries=args.hash_cache_size, threads=args.hash_threads)
+    set_default_hash_cache(cache)
+    atexit.register(cache.close)
+    return cache
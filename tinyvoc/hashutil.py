@@ -1,6 +1,8 @@
 import hashlib
+import os
 from pathlib import Path
-from typing import Union, IO
+from typing import Union, IO, Optional
+from . import perf
 # source: https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
 
 def hash_bytestr_iter(bytesiter, hasher, ashexstr=False):
@@ -12,6 +14,7 @@ def file_as_blockiter(afile, blocksize=65536):
         #with afile:
         block = afile.read(blocksize)
         while len(block) > 0:
+            perf.count("bytes_read", len(block))
             yield block
             block = afile.read(blocksize)
 
@@ -20,11 +23,35 @@ def hash_from_fileobj(afile) -> str:
     return hash_bytestr_iter(file_as_blockiter(afile), hashlib.sha256(), True)
 
 
+_default_hash_cache = None
+
+def set_default_hash_cache(cache: Optional["HashCache"]) -> None:
+    """
+        makes hash_from_file use a tinyvoc.hashcache.HashCache (or no cache if None)
+    """
+    global _default_hash_cache
+    _default_hash_cache = cache
+
+
+def get_default_hash_cache() -> Optional["HashCache"]:
+    return _default_hash_cache
+
+
 def hash_from_file(path: Union[str, IO, Path]) -> str:
-    if type(path) == str:
-        path = open(path, "rb")
-    if type(path) == Path:
-        path = open(path.absolute(), "rb")
+    with perf.timer("hashing"):
+        return _hash_from_file(path)
+
+
+def _hash_from_file(path: Union[str, IO, Path]) -> str:
+    if _default_hash_cache is not None:
+        fn = path
+        if not isinstance(fn, (str, Path)):
+            fn = getattr(path, "name", None)
+        if isinstance(fn, (str, Path)) and os.path.isfile(fn):
+            return _default_hash_cache.hash_file(fn)
+    if isinstance(path, (str, Path)):
+        with open(Path(path).absolute(), "rb") as f:
+            return hash_from_fileobj(f)
     return hash_from_fileobj(path)
 
 
@@ -0,0 +1,223 @@
+"""
+    Image sizes from the image headers, and validation of annotations against them.
+
+    probe_image_size reads the width and height (and number of channels) of JPEG (from the SOF marker), PNG (IHDR), GIF,
+    BMP and WebP images from their first bytes, without decoding any pixels.
+
+    The ImageValidator fills in missing or wrong <size> elements of annotations and checks the bounding boxes against the
+    image: boxes that are (partly) outside the image are clipped to the image, or the objects are rejected (policy
+    "reject"). Empty boxes (also after clipping) are always rejected, and an annotation whose objects were all rejected
+    is not written. The counts are in ImageValidator.report.
+
+    Probed sizes are kept in memory by file and, with a hash cache (see tinyvoc.hashcache), stored next to the content hash
+    of the image, keyed by path, inode, size and mtime, so the images of a dataset are only probed once. prefetch probes a
+    list of images on threads threads.
+"""
+import os
+import struct
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from . import perf
+from .hashutil import get_default_hash_cache
+from .threadpool import ordered_map
+
+POLICIES = ("clip", "reject")
+
+# the derived value (width,height,depth of an image) in the hash cache
+CACHE_ALGO = "tinyvoc-imagesize-v1"
+
+# how far to look for the SOF marker of a jpeg (exif thumbnails can come first)
+MAX_JPEG_HEADER = 1024 * 1024
+
+ImageSize = Tuple[int, int, int]
+
+# start of frame markers: all SOFn except DHT (c4), JPG (c8) and DAC (cc)
+_JPEG_SOF = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+# channels per png color type
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+def _jpeg_size(f) -> Optional[ImageSize]:
+    f.seek(2)
+    while f.tell() < MAX_JPEG_HEADER:
+        b = f.read(1)
+        if len(b) == 0:
+            return None
+        if b != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":
+            # fill bytes
+            marker = f.read(1)
+        if len(marker) == 0:
+            return None
+        m = marker[0]
+        if m == 0x01 or 0xd0 <= m <= 0xd9:
+            # markers without a length
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if m in _JPEG_SOF:
+            data = f.read(6)
+            if len(data) < 6:
+                return None
+            _, height, width, components = struct.unpack(">BHHB", data)
+            return (width, height, components)
+        f.seek(struct.unpack(">H", length)[0] - 2, os.SEEK_CUR)
+    return None
+
+
+def _webp_size(header: bytes) -> Optional[ImageSize]:
+    chunk = header[12:16]
+    if chunk == b"VP8 " and len(header) >= 30:
+        w, h = struct.unpack("<HH", header[26:30])
+        return (w & 0x3fff, h & 0x3fff, 3)
+    if chunk == b"VP8L" and len(header) >= 25:
+        bits = struct.unpack("<I", header[21:25])[0]
+        return ((bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1, 4)
+    if chunk == b"VP8X" and len(header) >= 30:
+        w = int.from_bytes(header[24:27], "little") + 1
+        h = int.from_bytes(header[27:30], "little") + 1
+        return (w, h, 4 if header[20] & 0x10 else 3)
+    return None
+
+
+def probe_image_size(path: str) -> Optional[ImageSize]:
+    """
+        (width, height, channels) of the image at path, read from its header. None if the format is not recognized or
+        the file can't be read.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(32)
+            if header[:3] == b"\xff\xd8\xff":
+                size = _jpeg_size(f)
+            elif header[:8] == b"\x89PNG\r\n\x1a\n" and header[12:16] == b"IHDR":
+                w, h, _, color_type = struct.unpack(">IIBB", header[16:26])
+                size = (w, h, _PNG_CHANNELS.get(color_type, 3))
+            elif header[:6] in (b"GIF87a", b"GIF89a"):
+                w, h = struct.unpack("<HH", header[6:10])
+                size = (w, h, 3)
+            elif header[:2] == b"BM" and len(header) >= 30:
+                if struct.unpack("<I", header[14:18])[0] == 12:
+                    # BITMAPCOREHEADER
+                    w, h, _, bpp = struct.unpack("<HHHH", header[18:26])
+                else:
+                    # BITMAPINFOHEADER (or larger): the height is negative for top down bitmaps
+                    w, h, _, bpp = struct.unpack("<iiHH", header[18:30])
+                size = (w, abs(h), 4 if bpp == 32 else (1 if bpp <= 8 else 3))
+            elif header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+                size = _webp_size(header)
+            else:
+                size = None
+            perf.count("bytes_read", f.tell())
+    except (OSError, struct.error):
+        return None
+    if size is None or size[0] <= 0 or size[1] <= 0:
+        return None
+    return size
+
+
+class ImageValidator(object):
+    """
+        Checks annotations against the size of their image (see the module documentation). probing is thread safe.
+    """
+    def __init__(self, policy: str = "clip", threads: int = 4, cache=None) -> None:
+        """
+            cache is a tinyvoc.hashcache.HashCache, defaults to the default hash cache (if any)
+        """
+        if policy not in POLICIES:
+            raise Exception(f"unknown box validation policy {policy}")
+        self.policy = policy
+        self.threads = max(1, threads)
+        self.cache = cache if cache is not None else get_default_hash_cache()
+        self.report: Dict[str, int] = {"probed_images": 0, "unknown_size": 0, "filled_sizes": 0, "corrected_sizes": 0,
+                                       "clipped_boxes": 0, "rejected_boxes": 0,
+                                       "rejected_annotations": 0}
+        self._sizes: Dict[str, Optional[ImageSize]] = {}
+        self._lock = threading.Lock()
+
+    def image_size(self, path: str) -> Optional[ImageSize]:
+        key = os.path.realpath(path)
+        with self._lock:
+            if key in self._sizes:
+                return self._sizes[key]
+        size = None
+        st = None
+        cached = None
+        if self.cache is not None:
+            try:
+                st = os.stat(key)
+                cached = self.cache.get(key, st, CACHE_ALGO)
+            except OSError:
+                st = None
+        if cached is not None:
+            size = tuple(int(x) for x in cached.split(",")) if cached != "" else None
+        else:
+            with perf.timer("probing"):
+                size = probe_image_size(key)
+            with self._lock:
+                self.report["probed_images"] += 1
+            if st is not None:
+                self.cache.put(key, st, ",".join(str(x) for x in size) if size is not None else "", CACHE_ALGO)
+        with self._lock:
+            self._sizes[key] = size
+        return size
+
+    def prefetch(self, paths: Iterable[str]) -> None:
+        """
+            probes the (existing) images in paths in parallel, so the validate calls that follow are answered from memory
+        """
+        todo = {os.path.realpath(p) for p in paths if p}
+        with self._lock:
+            todo = [p for p in todo if p not in self._sizes and os.path.isfile(p)]
+        for _ in ordered_map(self.image_size, todo, self.threads):
+            pass
+
+    def validate(self, annotation, img_path: str) -> bool:
+        """
+            fills in or corrects the size of annotation (a PascalVocAnnotation) and clips or rejects its boxes. returns
+            False if the annotation had objects and all of them were rejected
+        """
+        size = self.image_size(img_path)
+        if size is None:
+            self.report["unknown_size"] += 1
+            return True
+        width, height = size[0], size[1]
+        current = annotation.size
+        if current is None or current[0] <= 0 or current[1] <= 0:
+            self.report["filled_sizes"] += 1
+            annotation.size = size
+        elif current[:2] != (width, height):
+            self.report["corrected_sizes"] += 1
+            annotation.size = (width, height, current[2] if current[2] > 0 else size[2])
+        objects = annotation.objects
+        kept = []
+        for o in objects:
+            b = o.boundingbox
+            if b is None:
+                kept.append(o)
+                continue
+            inside = 0 <= b.xmin and 0 <= b.ymin and b.xmax <= width and b.ymax <= height
+            if not inside:
+                if self.policy == "reject":
+                    self.report["rejected_boxes"] += 1
+                    continue
+                b.xmin, b.xmax = min(max(b.xmin, 0), width), min(max(b.xmax, 0), width)
+                b.ymin, b.ymax = min(max(b.ymin, 0), height), min(max(b.ymax, 0), height)
+            if b.xmax <= b.xmin or b.ymax <= b.ymin:
+                # also a box that was entirely outside the image: rejected, not clipped
+                self.report["rejected_boxes"] += 1
+                continue
+            if not inside:
+                o.boundingbox = b
+                self.report["clipped_boxes"] += 1
+            kept.append(o)
+        if len(kept) != len(objects):
+            annotation.objects = kept
+            if len(kept) == 0:
+                self.report["rejected_annotations"] += 1
+                return False
+        return True
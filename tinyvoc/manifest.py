@@ -0,0 +1,103 @@
+"""
+    Bookkeeping for incremental rebuilds of an annotation directory.
+
+    The manifest maps every input annotation (identified by a key, eg zipfile + member name) to the fingerprint of its content
+    and the files that were written for it. On the next run, annotations with the same fingerprint don't need to be parsed or
+    written again, and outputs of annotations that disappeared from the input can be removed.
+"""
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from .hashutil import hash_from_Str
+
+
+class OutputManifest(object):
+    FILENAME = "tinyvoc-manifest.json"
+
+    def __init__(self, root_dir: str, params: Dict) -> None:
+        """
+            params are the settings that influence the output (eg lineage params, image treatment).
+            when they differ from the previous run, nothing from the previous run is reused (but its outputs are still cleaned up)
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.path = os.path.join(self.root_dir, self.FILENAME)
+        self.params_hash = hash_from_Str(json.dumps(params, sort_keys=True, default=str))
+        self.old_entries: Dict[str, dict] = {}
+        self.entries: Dict[str, dict] = {}
+        self.reusable = False
+        self.rename_counter = 0
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.old_entries = data.get("entries", {})
+            self.reusable = data.get("params_hash") == self.params_hash
+            if self.reusable:
+                self.rename_counter = data.get("rename_counter", 0)
+            else:
+                logging.info("parameters changed since the previous run, rebuilding everything")
+
+    @classmethod
+    def discard(cls, root_dir: str) -> None:
+        """
+            removes the manifest of root_dir (if any). to be called after a non incremental run, which renumbers and
+            overwrites outputs the manifest refers to
+        """
+        pth = os.path.join(os.path.abspath(root_dir), cls.FILENAME)
+        if os.path.isfile(pth):
+            os.remove(pth)
+            logging.info(f"removed {pth}: the output was rebuilt without --incremental")
+
+    def _previous(self, key: str) -> Optional[dict]:
+        if not self.reusable:
+            return None
+        return self.old_entries.get(key)
+
+    def is_unchanged(self, key: str, fingerprint: str) -> bool:
+        prev = self._previous(key)
+        return (prev is not None) and (prev["fingerprint"] == fingerprint)
+
+    def previous_id(self, key: str) -> Optional[str]:
+        prev = self._previous(key)
+        if prev is None:
+            return None
+        return prev["id"]
+
+    def keep(self, key: str) -> dict:
+        """
+            carries over the entry of an unchanged annotation, and returns it
+        """
+        entry = self.old_entries[key]
+        self.entries[key] = entry
+        return entry
+
+    def record(self, key: str, fingerprint: str, id: Optional[str], outputs: List[str], labels: List[str],
+               split_key: Optional[str] = None) -> None:
+        """
+            records the outputs written for an annotation. id is None for annotations that were dropped. split_key is
+            what its split was picked by (see tinyvoc.splits), so an unchanged annotation keeps its split
+        """
+        outputs = [os.path.relpath(os.path.abspath(x), self.root_dir) for x in outputs]
+        self.entries[key] = {"fingerprint": fingerprint, "id": id, "outputs": outputs, "labels": labels, "split_key": split_key}
+
+    def stale_outputs(self) -> List[str]:
+        """
+            outputs of the previous run that were not written or kept in this run
+        """
+        current = set()
+        for e in self.entries.values():
+            current.update(e["outputs"])
+        stale = []
+        for e in self.old_entries.values():
+            for o in e["outputs"]:
+                if o not in current:
+                    stale.append(os.path.join(self.root_dir, o))
+        return stale
+
+    def save(self, rename_counter: int) -> None:
+        data = {"params_hash": self.params_hash, "rename_counter": rename_counter, "entries": self.entries}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
@@ -1,6 +1,12 @@
 import argparse
 import os,sys
 from tinyvoc.pvocutils import *
+from tinyvoc.parallel import write_annotations
+from tinyvoc.shards import ShardedAnnotationWriter, ShardedAnnotationSource, is_sharded_dataset
+from tinyvoc.exporters import create_writer, FORMATS
+from tinyvoc import perf
+from tinyvoc.hashcache import add_hash_cache_args, configure_hash_cache_from_args, HASH_CACHE_ARGS
+from tinyvoc.splits import add_split_args, split_assigner_from_args, split_lineage_param, SPLIT_ARGS
 import yaml
 import pathlib
 import xml.etree.ElementTree as ET
@@ -13,8 +19,27 @@ from typing import List, Dict
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Create a dataset based on multiple source datasets, avoiding filename conflicts")
-    parser.add_argument("--source", type=pathlib.Path, help="path for input", required=True, action='append')
+    parser.add_argument("--source", type=pathlib.Path, help="path for input (an annotation directory, a zip or a sharded dataset)", required=True, action='append')
     parser.add_argument("--destination", type=pathlib.Path, required=True, help="path for output")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes for parsing annotations (default=1)")
+    parser.add_argument("--image-lookup", choices=["index", "probe"], default="index", help="index: list every folder an image can be in once, probe: check candidate paths on disk for every annotation (default=index)")
+    parser.add_argument("--parser", choices=["etree", "fast"], default="etree", help="fast: parse annotations into lightweight records and write modified annotations by splicing the changes into the original xml, building a DOM only when objects change (default=etree)")
+    parser.add_argument("--incremental", action="store_true", help="only relink and write annotations that changed since the previous run, and remove the ones that disappeared")
+    parser.add_argument("--zip-threads", type=int, default=1, help="number of threads for decompressing and parsing members of zip sources (default=1)")
+    parser.add_argument("--copy",  action="store_true", help="copy images instead of symlinking them (hardlink or reflink when possible)")
+    parser.add_argument("--no-hardlink",  action="store_true", help="with --copy: never hardlink, always make a real (possibly reflinked) copy")
+    parser.add_argument("--copy-threads", type=int, default=4, help="number of threads for copying images (default=4)")
+    parser.add_argument("--dedup", choices=["merge", "drop", "flag"], help="identify images by content hash and link every unique image once. the annotations of duplicate images are merged into the first one, dropped, or written referring to the first image and listed in duplicates.json (flag)")
+    parser.add_argument("--dedup-threads", type=int, default=4, help="number of threads for hashing images with --dedup (default=4)")
+    parser.add_argument("--shard-size", type=int, help="write the output as tar shards of about this size (in MB) with a json index, instead of a directory of xml files and symlinks. with --copy, the images are packed in the shards")
+    parser.add_argument("--format", choices=FORMATS, help="annotation format of the output: voc (xml files in Annotations, the default), coco (annotations/instances_default.json) or yolo (labels/*.txt and classes.txt)")
+    parser.add_argument("--metrics", type=pathlib.Path, help="metrics file to write (number of objects per label, and the dedup counts under 'dedup')")
+    parser.add_argument("--validate-images", choices=["clip", "reject"], help="read the image sizes from the image headers, fill in missing or wrong <size> elements and clip boxes that are outside the image to it, or reject them")
+    parser.add_argument("--validate-threads", type=int, default=4, help="number of threads for reading image headers with --validate-images (default=4)")
+    parser.add_argument("--pipeline", type=int, default=0, metavar="THREADS", help="run reading, transforming, locating images and writing as concurrent stages, with THREADS threads for reading and for locating (default=0: off, can't be combined with --jobs)")
+    parser.add_argument("--perf-metrics", type=pathlib.Path, help="json file to write timings, counters and throughput of the processing stages to (enables instrumentation)")
+    add_split_args(parser)
+    add_hash_cache_args(parser)
     return parser.parse_args()
 
 
@@ -22,34 +47,91 @@ def get_args() -> argparse.Namespace:
 def main():
     logging.basicConfig(level=logging.INFO)
     args = get_args()
+    if args.perf_metrics:
+        perf.enable()
+    configure_hash_cache_from_args(args)
     sources = []
     for src in args.source:
         if str(src).lower().endswith(".zip"):
             bdir = os.path.split(src)[0]
-            sources.append(AnnotationZip(src, bdir))
+            sources.append(AnnotationZip(src, bdir, parser=args.parser, workers=args.zip_threads))
+        elif is_sharded_dataset(src):
+            sources.append(ShardedAnnotationSource(src, parser=args.parser))
         else:
-            sources.append(AnnotationDirectory(src))
+            sources.append(AnnotationDirectory(src, parser=args.parser))
+    if args.shard_size and args.format not in (None, "voc"):
+        raise Exception("--shard-size can only be used for voc output")
     os.makedirs(args.destination, exist_ok=True)
-    writer = DirAnnotationWriter(args.destination)
+    if args.shard_size:
+        writer = ShardedAnnotationWriter(args.destination, shard_size=args.shard_size * 1024 * 1024)
+    else:
+        writer = create_writer(args.format or "voc", args.destination)
+    writer.use_image_index = args.image_lookup == "index"
     lineage = DataLineage()
     for s in sources:
+        if isinstance(s, AnnotationDirectory):
+            # fingerprint directories without data lineage with the locator the images are linked with
+            s.image_locator = writer.get_image_locator()
         lineage.add_source(s.as_lineage_source())
-    for k,v in filter_args_for_datalineage(vars(args)).items():
+    for k,v in filter_args_for_datalineage(vars(args), ignore=("jobs", "image_lookup", "incremental", "parser", "zip_threads", "copy", "no_hardlink", "copy_threads", "dedup_threads", "validate_threads", "pipeline", "metrics", "perf_metrics") + HASH_CACHE_ARGS + SPLIT_ARGS).items():
         lineage.add_param(k,v)
+    # only with --copy, so the lineage of existing datasets doesn't change
+    if args.copy:
+        lineage.add_param("copy", True)
+        lineage.add_param("no_hardlink", bool(args.no_hardlink))
+    if args.splits:
+        lineage.add_param("splits", split_lineage_param(args))
     if writer.check_lineage_okay(lineage):
         print("dataset already okay, doing nothing")
+        perf.write_report(args.perf_metrics)
         sys.exit(0)
-    for s in sources:
-        for a in s.generate_annotations():
-            assert isinstance(a, PascalVocAnnotation)
-            writer.add_annotation(a,ImageTreatmentSetting.SYMLINK_IMAGE_RENAME)
+    treat_way = ImageTreatmentSetting.SYMLINK_IMAGE_RENAME
+    if args.copy:
+        treat_way = ImageTreatmentSetting.COPY_IMAGE_RENAME
+        writer.copy_threads = args.copy_threads
+        writer.allow_hardlink = not args.no_hardlink
+    if args.dedup and args.incremental:
+        raise Exception("--dedup can not be combined with --incremental")
+    if args.dedup:
+        writer.enable_dedup(args.dedup, args.dedup_threads)
+    if args.validate_images:
+        writer.enable_validation(args.validate_images, args.validate_threads)
+    if args.incremental:
+        writer.enable_incremental(dict(lineage.data["params"], treat_image=treat_way.name))
+    if args.splits:
+        writer.enable_splits(split_assigner_from_args(args))
+    write_annotations(sources, writer, treat_way, jobs=args.jobs, pipeline_threads=args.pipeline)
+    writer.close()
     writer.write_dataset_meta()
     writer.write_lineage(lineage)
+    perf.write_report(args.perf_metrics)
+    if args.metrics:
+        metrics = dict(writer.metrics)
+        if writer.dedup is not None:
+            metrics["dedup"] = writer.dedup.report
+        if writer.splits is not None:
+            metrics["splits"] = writer.splits.sizes
+        if writer.validator is not None:
+            metrics["validation"] = writer.validator.report
+        if args.format not in (None, "voc"):
+            metrics["export"] = writer.report
+        with open(args.metrics, "w") as f:
+            json.dump(metrics, f)
 
     print("SUMMARY")
     print("=======")
     for k in writer.metrics.keys():
         print("{k}: {v}".format(k=k, v=writer.metrics[k]))
+    if writer.copy_report is not None:
+        print("copied {files} images ({bytes} bytes, {copy_seconds:.2f}s copying, {wait_seconds:.2f}s waiting): {hardlink} hardlinks, {reflink} reflinks, {copy_file_range} copy_file_range, {copy} full copies".format(**writer.copy_report))
+    if writer.dedup is not None:
+        print("dedup ({policy}): {unique_images} unique images, {duplicate_images} duplicate images removed ({merged_annotations} annotations merged, {merged_objects} objects added, {dropped_annotations} dropped, {flagged_annotations} flagged)".format(policy=writer.dedup.policy, **writer.dedup.report))
+    if writer.validator is not None:
+        print("image validation ({policy}): {probed_images} images probed, {unknown_size} of unknown size, {filled_sizes} sizes filled in, {corrected_sizes} corrected, {clipped_boxes} boxes clipped, {rejected_boxes} rejected, {rejected_annotations} annotations without boxes left".format(policy=writer.validator.policy, **writer.validator.report))
+    if args.format not in (None, "voc"):
+        print(f"{args.format} export: " + ", ".join(f"{k.replace('_', ' ')}: {v}" for k, v in writer.report.items()))
+    if writer.splits is not None:
+        print("splits: " + ", ".join(f"{name}: {n}" for name, n in writer.splits.sizes.items()))
 
 
 
@@ -0,0 +1,109 @@
+"""
+    Declarative filter for the objects of an annotation, that can be evaluated while parsing (predicate pushdown).
+
+    With the fast parser (see tinyvoc.fastparse), a rejected object is skipped as soon as one of its fields fails a
+    condition (eg right after its <name>), and never becomes an ObjectRecord or a PascalVocObject. With the etree parser,
+    the same conditions are applied right after parsing.
+
+    The filter can be configured in the parameters file of prepare-annotations:
+
+        annotations:
+          filter:
+            labels: [Car, Pedestrian]       # allowed labels (default: valid-labels)
+            attributes:                      # allowed values of attributes (objects without the attribute are rejected)
+              Type: [A, B]
+            min-width: 4                     # minimum box size in pixels
+            min-height: 4
+            min-area: 16
+            occluded: keep                   # keep, drop (reject occluded objects) or only (reject visible objects)
+"""
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+OCCLUDED_MODES = ("keep", "drop", "only")
+
+
+class ObjectFilter(object):
+    """
+        label_attribute: compare labels with the name followed by the value of this attribute (like the concat-type-attribute
+        option of prepare-annotations, which appends the Type attribute to the name)
+    """
+    def __init__(self, labels: Optional[Iterable[str]] = None, attributes: Optional[Dict[str, List[str]]] = None,
+                 min_width: float = 0, min_height: float = 0, min_area: float = 0, occluded: str = "keep",
+                 label_attribute: Optional[str] = None) -> None:
+        if occluded not in OCCLUDED_MODES:
+            raise Exception(f"unknown occluded mode {occluded}, should be one of {', '.join(OCCLUDED_MODES)}")
+        self.labels = frozenset(labels) if labels is not None else None
+        self.attributes = {k: frozenset([v] if isinstance(v, str) else v) for k, v in (attributes or {}).items()}
+        self.min_width = min_width
+        self.min_height = min_height
+        self.min_area = min_area
+        self.occluded = occluded
+        self.label_attribute = label_attribute
+        self._check_box = min_width > 0 or min_height > 0 or min_area > 0
+
+    @classmethod
+    def from_params(cls, params: Optional[Dict], labels: Optional[Iterable[str]] = None, concat_type: bool = False) -> Optional["ObjectFilter"]:
+        """
+            creates a filter from the annotations.filter section of the parameters file. labels (eg valid-labels) is used
+            when the section has no labels. returns None if there is nothing to filter.
+        """
+        params = dict(params or {})
+        labels = params.get("labels", labels)
+        if labels is not None and len(labels) == 0:
+            labels = None
+        f = cls(labels, params.get("attributes"), params.get("min-width", 0), params.get("min-height", 0),
+                params.get("min-area", 0), params.get("occluded", "keep"), "Type" if concat_type else None)
+        return None if f.is_empty() else f
+
+    def is_empty(self) -> bool:
+        return self.labels is None and len(self.attributes) == 0 and not self._check_box and self.occluded == "keep"
+
+    def to_dict(self) -> Dict:
+        return {
+            "labels": sorted(self.labels) if self.labels is not None else None,
+            "attributes": {k: sorted(v) for k, v in sorted(self.attributes.items())},
+            "min-width": self.min_width, "min-height": self.min_height, "min-area": self.min_area,
+            "occluded": self.occluded, "label-attribute": self.label_attribute,
+        }
+
+    def __str__(self) -> str:
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    # the checks below are used by the parser as soon as the field is known, accepts checks everything
+
+    def accepts_name(self, name: Optional[str]) -> bool:
+        if self.labels is None or self.label_attribute is not None:
+            return True
+        return name in self.labels
+
+    def accepts_occluded(self, occluded: bool) -> bool:
+        if self.occluded == "keep":
+            return True
+        return occluded == (self.occluded == "only")
+
+    def accepts_box(self, bndbox: Optional[Tuple[float, float, float, float]]) -> bool:
+        if not self._check_box:
+            return True
+        if bndbox is None:
+            return False
+        w = bndbox[2] - bndbox[0]
+        h = bndbox[3] - bndbox[1]
+        return w >= self.min_width and h >= self.min_height and w * h >= self.min_area
+
+    def accepts(self, rec) -> bool:
+        """
+            rec is an ObjectRecord
+        """
+        if not (self.accepts_occluded(rec.occluded) and self.accepts_box(rec.bndbox)):
+            return False
+        for k, values in self.attributes.items():
+            if rec.attributes.get(k) not in values:
+                return False
+        if self.labels is None:
+            return True
+        if self.label_attribute is None:
+            return rec.name in self.labels
+        suffix = rec.attributes.get(self.label_attribute)
+        name = rec.name or ""
+        return (name + suffix if suffix is not None else name) in self.labels
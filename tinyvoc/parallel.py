@@ -0,0 +1,163 @@
+"""
+    Process pool support for the annotation writers.
+
+    Loading, transforming (eg filtering labels) and locating the image of an annotation are independent for every annotation,
+    so they are done in worker processes, in batches. Adding the result to the DirAnnotationWriter (which assigns ids, symlinks
+    images and writes the xml) stays in the main process and happens in the original order, so the output is identical to a
+    serial run.
+"""
+import collections
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from .threadpool import ordered_map
+from .pipeline import write_annotations_pipelined
+from . import perf
+from .pvocutils import PascalVocAnnotation, DirAnnotationWriter, ImageTreatmentSetting, ImageLocator
+
+AnnotationTransform = Callable[[PascalVocAnnotation], Optional[PascalVocAnnotation]]
+
+_worker_transform: Optional[AnnotationTransform] = None
+_worker_locator: Optional[ImageLocator] = None
+_worker_root_dir: Optional[str] = None
+
+
+def _init_worker(transform: Optional[AnnotationTransform], locator: ImageLocator, root_dir: str, instrument: bool = False) -> None:
+    global _worker_transform, _worker_locator, _worker_root_dir
+    _worker_transform = transform
+    _worker_locator = locator
+    _worker_root_dir = root_dir
+    if instrument:
+        # a forked worker inherits the numbers of the main process, start from zero
+        perf.enable().take()
+
+
+def _process_batch(refs: list) -> Tuple[List[Tuple[Optional[PascalVocAnnotation], str]], Optional[dict]]:
+    """
+        returns one (annotation, image path) tuple per ref, the annotation is None if the transform dropped it.
+        the second element is what the instrumentation recorded in this worker for the batch (None if it is off)
+    """
+    results = []
+    for ref in refs:
+        annotation = ref.load()
+        if _worker_transform is not None:
+            annotation = _worker_transform(annotation)
+            if annotation is None:
+                results.append((None, ''))
+                continue
+        results.append((annotation, _worker_locator.locate(annotation, _worker_root_dir)))
+    recorder = perf.get_recorder()
+    return results, (recorder.take() if recorder is not None else None)
+
+
+def _load_changed(item: Tuple[object, bool]) -> Tuple[object, bool, Optional[PascalVocAnnotation]]:
+    ref, unchanged = item
+    return ref, unchanged, (None if unchanged else ref.load())
+
+
+def batched(iterable: Iterable, batch_size: int) -> Iterable[list]:
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def write_annotations(sources: list, writer: DirAnnotationWriter, treat_image: ImageTreatmentSetting,
+                      transform: Optional[AnnotationTransform] = None, jobs: int = 1, pipeline_threads: int = 0) -> None:
+    """
+        Adds all annotations of sources to writer, applying transform (which can return None to drop an annotation) first.
+        Uses write_annotations_parallel if jobs > 1, and the threaded pipeline of tinyvoc.pipeline (with pipeline_threads
+        threads for reading and locating) if pipeline_threads > 0. In incremental mode (see DirAnnotationWriter.enable_incremental),
+        unchanged annotations are not parsed. With deduplication (see DirAnnotationWriter.enable_dedup), the images are
+        hashed on the threads of the deduplicator, with validation (see DirAnnotationWriter.enable_validation) they are
+        probed on the threads of the validator.
+    """
+    if jobs > 1 and pipeline_threads > 0:
+        raise Exception("worker processes and the threaded pipeline can not be combined")
+    if jobs > 1:
+        write_annotations_parallel(sources, writer, treat_image, transform=transform, jobs=jobs)
+        return
+    if pipeline_threads > 0:
+        write_annotations_pipelined(sources, writer, treat_image, transform=transform, io_threads=pipeline_threads)
+        return
+    # with deduplication or validation, the images of a window of annotations are located first and hashed or probed in parallel
+    window = max(4 * writer.dedup.threads if writer.dedup is not None else 1,
+                 4 * writer.validator.threads if writer.validator is not None else 1)
+    for s in sources:
+        # sources with workers (AnnotationZip) decompress and parse in threads, ahead of the writer
+        refs = ((ref, writer.is_unchanged(ref)) for ref in s.generate_refs())
+        for items in batched(ordered_map(_load_changed, refs, getattr(s, "workers", 1)), window):
+            located = []
+            for ref, unchanged, annotation in items:
+                if (not unchanged) and (transform is not None):
+                    annotation = transform(annotation)
+                img_path = writer.locate_image(annotation) if (not unchanged) and (annotation is not None) else ''
+                located.append((ref, unchanged, annotation, img_path))
+            if writer.dedup is not None:
+                writer.dedup.prefetch(img_path for _, _, _, img_path in located)
+            if writer.validator is not None:
+                writer.validator.prefetch(img_path for _, _, _, img_path in located)
+            for ref, unchanged, annotation, img_path in located:
+                if unchanged:
+                    writer.keep_unchanged(ref)
+                elif annotation is None:
+                    writer.skip_annotation(ref)
+                else:
+                    writer.add_located_annotation(annotation, img_path, treat_image, ref)
+
+
+def write_annotations_parallel(sources: list, writer: DirAnnotationWriter, treat_image: ImageTreatmentSetting,
+                               transform: Optional[AnnotationTransform] = None, jobs: Optional[int] = None,
+                               batch_size: int = 256) -> None:
+    """
+        Adds all annotations of sources (AnnotationZip or AnnotationDirectory objects) to writer, using jobs worker processes.
+        transform is applied to every annotation in the worker; it should be picklable (a module level function or a
+        functools.partial of one) and can return None to drop an annotation.
+        At most 2 batches per worker are in flight, so memory use does not depend on the size of the dataset.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    refs = itertools.chain.from_iterable(s.generate_refs() for s in sources)
+    locator = writer.get_image_locator()
+    # build the image index (if any) once here, instead of once in every worker
+    locator.index_roots([writer.root_dir if s.root_dir is None else s.root_dir for s in sources])
+    recorder = perf.get_recorder()
+    initargs = (transform, locator, writer.root_dir, recorder is not None)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=initargs) as pool:
+        max_in_flight = 2 * jobs
+        in_flight = collections.deque()
+        batches = batched(refs, batch_size)
+        n_batches = 0
+        while True:
+            for batch in itertools.islice(batches, max_in_flight - len(in_flight)):
+                # in incremental mode, unchanged annotations are not sent to the workers
+                unchanged = [writer.is_unchanged(r) for r in batch]
+                todo = [r for r, u in zip(batch, unchanged) if not u]
+                in_flight.append((batch, unchanged, pool.submit(_process_batch, todo)))
+            if len(in_flight) == 0:
+                break
+            batch, unchanged, future = in_flight.popleft()
+            results, worker_perf = future.result()
+            if worker_perf is not None:
+                recorder.merge(worker_perf)
+            if writer.dedup is not None:
+                writer.dedup.prefetch(img_path for annotation, img_path in results if annotation is not None)
+            if writer.validator is not None:
+                writer.validator.prefetch(img_path for annotation, img_path in results if annotation is not None)
+            results = iter(results)
+            for ref, u in zip(batch, unchanged):
+                if u:
+                    writer.keep_unchanged(ref)
+                    continue
+                annotation, img_path = next(results)
+                if annotation is None:
+                    writer.skip_annotation(ref)
+                else:
+                    writer.add_located_annotation(annotation, img_path, treat_image, ref)
+            n_batches += 1
+    logging.info(f"processed {n_batches} batches using {jobs} worker processes")
@@ -0,0 +1,143 @@
+"""
+    Opt-in instrumentation: time spent per stage (hashing, unzipping, parsing, locating, linking, copying, writing),
+    counters (stat calls, bytes read and written, annotations) and throughput.
+
+    Instrumentation is off by default and then costs next to nothing. enable() turns it on for the process, the CLIs do
+    this for --perf-metrics and write the report as JSON (eg as DVC metrics).
+    Stage times are summed over threads and worker processes, so they can add up to more than the wall time.
+"""
+import json
+import threading
+import time
+from typing import Dict, Optional
+
+STAGES = ("hashing", "unzipping", "parsing", "locating", "probing", "linking", "copying", "writing")
+COUNTERS = ("annotations", "stat_calls", "bytes_read", "bytes_written")
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ("recorder", "stage", "start")
+
+    def __init__(self, recorder: "PerfRecorder", stage: str) -> None:
+        self.recorder = recorder
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.recorder.add_time(self.stage, time.perf_counter() - self.start)
+
+
+class PerfRecorder(object):
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {c: 0 for c in COUNTERS}
+        self._lock = threading.Lock()
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def count(self, counter: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def take(self) -> Dict:
+        """
+            returns what was recorded since the previous take and resets (used to send the numbers of a worker process to the main process)
+        """
+        with self._lock:
+            data = {"seconds": self.seconds, "calls": self.calls, "counters": self.counters}
+            self.seconds = {}
+            self.calls = {}
+            self.counters = {c: 0 for c in COUNTERS}
+        return data
+
+    def merge(self, data: Dict) -> None:
+        with self._lock:
+            for stage, s in data["seconds"].items():
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + s
+            for stage, n in data["calls"].items():
+                self.calls[stage] = self.calls.get(stage, 0) + n
+            for counter, n in data["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def report(self) -> Dict:
+        wall = time.perf_counter() - self.started
+        with self._lock:
+            stages = {s: {"seconds": round(self.seconds.get(s, 0.0), 6), "calls": self.calls.get(s, 0)}
+                      for s in sorted(set(STAGES) | set(self.seconds))}
+            counters = dict(self.counters)
+        annotations = counters.get("annotations", 0)
+        return {
+            "wall_seconds": round(wall, 6),
+            "annotations_per_second": round(annotations / wall, 3) if wall > 0 else 0.0,
+            "stages": stages,
+            "counters": counters,
+        }
+
+    def write(self, path) -> None:
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+_recorder: Optional[PerfRecorder] = None
+
+
+def enable() -> PerfRecorder:
+    """
+        turns instrumentation on for this process (if it wasn't already) and returns the recorder
+    """
+    global _recorder
+    if _recorder is None:
+        _recorder = PerfRecorder()
+    return _recorder
+
+
+def disable() -> None:
+    global _recorder
+    _recorder = None
+
+
+def get_recorder() -> Optional[PerfRecorder]:
+    return _recorder
+
+
+def write_report(path) -> None:
+    """
+        writes the report to path, if instrumentation is on and path is set
+    """
+    if _recorder is not None and path:
+        _recorder.write(path)
+
+
+def timer(stage: str):
+    """
+        context manager that adds the time spent in the block to stage (does nothing when instrumentation is off)
+    """
+    if _recorder is None:
+        return _NULL_TIMER
+    return _Timer(_recorder, stage)
+
+
+def count(counter: str, n: int = 1) -> None:
+    if _recorder is not None:
+        _recorder.count(counter, n)
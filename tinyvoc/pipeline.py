@@ -0,0 +1,220 @@
+"""
+    Threaded pipeline for the annotation writers.
+
+    Reading (eg decompressing zip members), transforming (eg process_annotation), locating the image and writing run as
+    concurrent stages, connected by bounded queues, so the latency of the io in one stage overlaps with the work of the
+    other stages. Reading and locating (the stages that mostly wait for storage) run on multiple threads, transforming
+    runs on one thread (it is cpu bound) and writing happens in the calling thread, in the original order of the
+    annotations (a reorder buffer puts back the order that the threads of the other stages mixed up). The output is
+    identical to a serial run.
+
+    At most max_in_flight annotations are between reading and writing, so memory use does not depend on the size of the
+    dataset nor on how slow a single annotation is.
+"""
+import queue
+import threading
+from typing import Callable, Iterable, List, Optional
+
+from .pvocutils import DirAnnotationWriter, ImageTreatmentSetting, PascalVocAnnotation
+
+AnnotationTransform = Callable[[PascalVocAnnotation], Optional[PascalVocAnnotation]]
+
+# how often blocked threads check whether the pipeline was stopped
+_POLL_SECONDS = 0.1
+
+
+class _End(object):
+    """
+        end of stream marker
+    """
+    pass
+
+
+_END = _End()
+
+
+class _Failure(object):
+    """
+        an exception raised in one of the stages, passed on to the writer (which raises it)
+    """
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class _Item(object):
+    __slots__ = ("seq", "ref", "unchanged", "annotation", "img_path")
+
+    def __init__(self, seq: int, ref, unchanged: bool) -> None:
+        self.seq = seq
+        self.ref = ref
+        self.unchanged = unchanged
+        self.annotation: Optional[PascalVocAnnotation] = None
+        self.img_path = ''
+
+
+class _Stage(object):
+    """
+        threads threads that apply fn to the items of inq and put them in outq. failures and items fn does not need to
+        process are passed on as is. the last thread to see the end marker passes it on.
+    """
+    def __init__(self, name: str, fn: Callable[[_Item], None], threads: int, inq: queue.Queue, outq: queue.Queue, stop: threading.Event) -> None:
+        self.fn = fn
+        self.inq = inq
+        self.outq = outq
+        self.stop = stop
+        self._running = threads
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"tinyvoc-{name}-{i}", daemon=True) for i in range(threads)]
+
+    def start(self) -> None:
+        for t in self.threads:
+            t.start()
+
+    def _run(self) -> None:
+        while True:
+            item = _get(self.inq, self.stop)
+            if item is None:
+                return
+            if item is _END:
+                # let the other threads of this stage see it too
+                _put(self.inq, _END, self.stop)
+                with self._lock:
+                    self._running -= 1
+                    last = self._running == 0
+                if last:
+                    _put(self.outq, _END, self.stop)
+                return
+            if isinstance(item, _Item):
+                try:
+                    self.fn(item)
+                except BaseException as e:
+                    item = _Failure(e)
+            if not _put(self.outq, item, self.stop):
+                return
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """
+        returns None when the pipeline was stopped
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            pass
+    return None
+
+
+class AnnotationPipeline(object):
+    """
+        Adds the annotations of sources to writer, like tinyvoc.parallel.write_annotations, with the stages running
+        concurrently. io_threads is the number of threads for reading and for locating, max_in_flight the maximum number
+        of annotations in the pipeline (default 8 * io_threads), queue_size the size of the queues between the stages.
+    """
+    def __init__(self, writer: DirAnnotationWriter, treat_image: ImageTreatmentSetting, transform: Optional[AnnotationTransform] = None,
+                 io_threads: int = 4, max_in_flight: Optional[int] = None, queue_size: Optional[int] = None) -> None:
+        self.writer = writer
+        self.treat_image = treat_image
+        self.transform = transform
+        self.io_threads = max(1, io_threads)
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 8 * self.io_threads
+        self.queue_size = queue_size if queue_size is not None else 2 * self.io_threads
+
+    def _read(self, item: _Item) -> None:
+        if not item.unchanged:
+            item.annotation = item.ref.load()
+
+    def _transform(self, item: _Item) -> None:
+        if item.annotation is not None and self.transform is not None:
+            item.annotation = self.transform(item.annotation)
+
+    def _locate(self, item: _Item) -> None:
+        if item.annotation is None:
+            return
+        item.img_path = self.locator.locate(item.annotation, self.writer.root_dir)
+        if self.writer.dedup is not None and item.img_path != '':
+            # hash here, so the writer finds the digest in memory
+            self.writer.dedup.digest(item.img_path)
+        if self.writer.validator is not None and item.img_path != '':
+            self.writer.validator.image_size(item.img_path)
+
+    def _feed(self, sources: List, outq: queue.Queue, in_flight: threading.Semaphore, stop: threading.Event) -> None:
+        try:
+            seq = 0
+            for s in sources:
+                for ref in s.generate_refs():
+                    while not in_flight.acquire(timeout=_POLL_SECONDS):
+                        if stop.is_set():
+                            return
+                    if not _put(outq, _Item(seq, ref, self.writer.is_unchanged(ref)), stop):
+                        return
+                    seq += 1
+        except BaseException as e:
+            _put(outq, _Failure(e), stop)
+        _put(outq, _END, stop)
+
+    def _write(self, item: _Item) -> None:
+        writer = self.writer
+        if item.unchanged:
+            writer.keep_unchanged(item.ref)
+        elif item.annotation is None:
+            writer.skip_annotation(item.ref)
+        else:
+            writer.add_located_annotation(item.annotation, item.img_path, self.treat_image, item.ref)
+
+    def run(self, sources: Iterable) -> None:
+        sources = list(sources)
+        self.locator = self.writer.get_image_locator()
+        # build the image index (if any) before the locate threads need it
+        self.locator.index_roots([self.writer.root_dir if s.root_dir is None else s.root_dir for s in sources])
+        stop = threading.Event()
+        in_flight = threading.Semaphore(self.max_in_flight)
+        queues = [queue.Queue(self.queue_size) for _ in range(4)]
+        stages = [
+            _Stage("read", self._read, self.io_threads, queues[0], queues[1], stop),
+            _Stage("transform", self._transform, 1, queues[1], queues[2], stop),
+            _Stage("locate", self._locate, self.io_threads, queues[2], queues[3], stop),
+        ]
+        feeder = threading.Thread(target=self._feed, args=(sources, queues[0], in_flight, stop), name="tinyvoc-feed", daemon=True)
+        feeder.start()
+        for stage in stages:
+            stage.start()
+        try:
+            reorder = {}
+            next_seq = 0
+            while True:
+                item = queues[3].get()
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                reorder[item.seq] = item
+                while next_seq in reorder:
+                    self._write(reorder.pop(next_seq))
+                    next_seq += 1
+                    in_flight.release()
+            if len(reorder) > 0:
+                raise Exception(f"pipeline ended with {len(reorder)} annotations that could not be written in order")
+        finally:
+            stop.set()
+            feeder.join()
+            for stage in stages:
+                for t in stage.threads:
+                    t.join()
+
+
+def write_annotations_pipelined(sources: list, writer: DirAnnotationWriter, treat_image: ImageTreatmentSetting,
+                                transform: Optional[AnnotationTransform] = None, io_threads: int = 4) -> None:
+    AnnotationPipeline(writer, treat_image, transform, io_threads).run(sources)
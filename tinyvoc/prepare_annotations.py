@@ -1,7 +1,14 @@
 import argparse
 from importlib.resources import path
 import os,sys
+import functools
 from .pvocutils import *
+from .parallel import write_annotations
+from .objectfilter import ObjectFilter
+from .exporters import create_writer, FORMATS
+from . import perf
+from .hashcache import add_hash_cache_args, configure_hash_cache_from_args, HASH_CACHE_ARGS
+from .splits import add_split_args, split_assigner_from_args, split_lineage_param, SPLIT_ARGS
 import yaml
 import pathlib
 import xml.etree.ElementTree as ET
@@ -27,13 +34,27 @@ def process_annotation(annot: PascalVocAnnotation, valid_labels, concat_type=Fal
     return annot
 
 
+def process_nonempty_annotation(annot: PascalVocAnnotation, valid_labels, concat_type=False, prefix=None) -> Optional[PascalVocAnnotation]:
+    """
+        process_annotation, returning None for annotations that have no objects left
+    """
+    if len(annot.objects) == 0:
+        # eg all objects were rejected by the object filter while parsing
+        return None
+    processed = process_annotation(annot, valid_labels, concat_type=concat_type, prefix=prefix)
+    if len(processed.objects) > 0:
+        return processed
+    return None
+
+
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="dataset preparation")
     parser.add_argument("--parameters", help="path to parameters.yaml file", type=argparse.FileType("r", encoding="utf8"), required=False)
     parser.add_argument("--root", type=pathlib.Path, required=True, help="root folder for constructing relative paths")
-    parser.add_argument("--source", type=argparse.FileType("rb"), help="zipfile with pascalvoc 1.1 annotations (input)", required=True)
-    parser.add_argument("--destination", type=pathlib.Path, required=False, help="path for output (default=$root/Annotations)")
+    parser.add_argument("--source", type=argparse.FileType("rb"), help="zipfile with pascalvoc 1.1 annotations (input), - to read the zip from stdin", required=True)
+    parser.add_argument("--destination", type=pathlib.Path, required=False, help="path for output (default=$root/Annotations, $root/annotations for coco, $root/labels for yolo)")
+    parser.add_argument("--format", choices=FORMATS, help="annotation format of the output: voc (xml files, the default), coco (instances_default.json) or yolo (txt files, with classes.txt and images.txt in root)")
     parser.add_argument("--label", type=str, required=False, help="allowed label (repeat this option to have multiple allowed labels)", action="append")
     parser.add_argument("--imagedir", type=pathlib.Path, required=False, help="folder in which to find images. to search in multiple folders, repeat this option", action="append")
     parser.add_argument("--prefix", type=str, required=False, help="prefix for images (instead of 'frame')", default='frame')
@@ -42,53 +63,109 @@ def get_args() -> argparse.Namespace:
     parser.add_argument("--concat-type", action="store_true", help="concat type attribute to label")
     parser.add_argument("--no-rewrite",  action="store_true", help="disable filename sanitizing and rewriting: keep original filenames and keep annotations for missing files")
     parser.add_argument("--symlink",  action="store_true", help="symlink images so that you have an JPegImages dir")
+    parser.add_argument("--copy",  action="store_true", help="copy images to the JPEGImages dir (hardlink or reflink when possible)")
+    parser.add_argument("--no-hardlink",  action="store_true", help="with --copy: never hardlink, always make a real (possibly reflinked) copy")
+    parser.add_argument("--copy-threads", type=int, default=4, help="number of threads for copying images (default=4)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes for parsing and filtering annotations (default=1)")
+    parser.add_argument("--image-lookup", choices=["index", "probe"], default="index", help="index: list every folder an image can be in once, probe: check candidate paths on disk for every annotation (default=index)")
+    parser.add_argument("--parser", choices=["etree", "fast"], default="etree", help="fast: parse annotations into lightweight records and write modified annotations by splicing the changes into the original xml, building a DOM only when objects change (default=etree)")
+    parser.add_argument("--incremental", action="store_true", help="only write annotations that changed since the previous run, and remove the ones that disappeared")
+    parser.add_argument("--zip-threads", type=int, default=1, help="number of threads for decompressing and parsing zip members (default=1)")
 
+    parser.add_argument("--validate-images", choices=["clip", "reject"], help="read the image sizes from the image headers, fill in missing or wrong <size> elements and clip boxes that are outside the image to it, or reject them")
+    parser.add_argument("--validate-threads", type=int, default=4, help="number of threads for reading image headers with --validate-images (default=4)")
+    parser.add_argument("--pipeline", type=int, default=0, metavar="THREADS", help="run reading, transforming, locating images and writing as concurrent stages, with THREADS threads for reading and for locating (default=0: off, can't be combined with --jobs)")
+    parser.add_argument("--perf-metrics", type=pathlib.Path, help="json file to write timings, counters and throughput of the processing stages to (enables instrumentation)")
+    add_split_args(parser)
+    add_hash_cache_args(parser)
     return parser.parse_args()
 
 
 def main():
     logging.basicConfig(level=logging.INFO)
     args = get_args()
-    if args.destination is None:
+    if args.perf_metrics:
+        perf.enable()
+    configure_hash_cache_from_args(args)
+    fmt = args.format or "voc"
+    if args.destination is None and fmt == "voc":
         args.destination = args.root / "Annotations"
     if args.parameters:
         params = yaml.load(args.parameters, Loader=yaml.FullLoader)
         labels = params["annotations"]["valid-labels"]
         typeconcat = params["annotations"]["concat-type-attribute"]
+        filter_params = params["annotations"].get("filter")
     else:
         labels = []
         typeconcat = args.concat_type
+        filter_params = None
     if args.label:
         for l in args.label:
             labels.append(l)
-    os.makedirs(args.destination, exist_ok=True)
-    os.system("rm {s}/*.xml".format(s=args.destination))
-    writer = DirAnnotationWriter(args.root, args.destination)
-    writer.extra_search_path = [str(x) for x in args.imagedir]
-    gen = AnnotationZip(args.source)
+    # the valid labels are checked while parsing too, so rejected objects are never fully parsed
+    object_filter = ObjectFilter.from_params(filter_params, labels, typeconcat)
+    if fmt == "voc":
+        os.makedirs(args.destination, exist_ok=True)
+        if not args.incremental:
+            os.system("rm {s}/*.xml".format(s=args.destination))
+    # the valid labels come first in the class list of coco and yolo
+    writer = create_writer(fmt, args.root, args.destination, classes=labels)
+    writer.extra_search_path = [str(x) for x in (args.imagedir or [])]
+    writer.use_image_index = args.image_lookup == "index"
+    gen = AnnotationZip(args.source, parser=args.parser, workers=args.zip_threads, object_filter=object_filter)
     l = DataLineage()
-    for k,v in filter_args_for_datalineage(vars(args)).items():
+    for k,v in filter_args_for_datalineage(vars(args), ignore=("jobs", "image_lookup", "incremental", "parser", "zip_threads", "copy", "no_hardlink", "copy_threads", "validate_threads", "pipeline", "perf_metrics") + HASH_CACHE_ARGS + SPLIT_ARGS).items():
         l.add_param(k,v)
+    # only with --copy, so the lineage of existing datasets doesn't change
+    if args.copy:
+        l.add_param("copy", True)
+        l.add_param("no_hardlink", bool(args.no_hardlink))
+    if args.splits:
+        l.add_param("splits", split_lineage_param(args))
+    # labels from the parameters file or from repeated --label options are not picked up by filter_args_for_datalineage
+    l.add_param("valid-labels", ",".join(sorted(labels)))
+    l.add_param("concat-type-attribute", bool(typeconcat))
+    if filter_params is not None:
+        l.add_param("filter", str(object_filter))
     treat_way = ImageTreatmentSetting.REWRITE_RELPATH
     if args.no_rewrite:
         treat_way = ImageTreatmentSetting.KEEP_PATH
     if args.symlink:
         treat_way = ImageTreatmentSetting.SYMLINK_IMAGE_RENAME
+    if args.copy:
+        treat_way = ImageTreatmentSetting.COPY_IMAGE_RENAME
+        writer.copy_threads = args.copy_threads
+        writer.allow_hardlink = not args.no_hardlink
     l.add_source(gen.as_lineage_source())
     if writer.check_lineage_okay(l):
         print("dataset is up to date, doing nothing")
+        perf.write_report(args.perf_metrics)
         sys.exit(0)
-    for annot in gen.generate_annotations():
-        processed = process_annotation(annot, labels, concat_type=typeconcat, prefix=args.prefix)
-        if len(processed.objects) > 0:
-            writer.add_annotation(processed, treat_way)
+    if args.validate_images:
+        writer.enable_validation(args.validate_images, args.validate_threads)
+    if args.incremental:
+        writer.enable_incremental(dict(l.data["params"], treat_image=treat_way.name))
+    if args.splits:
+        writer.enable_splits(split_assigner_from_args(args))
+    transform = functools.partial(process_nonempty_annotation, valid_labels=labels, concat_type=typeconcat, prefix=args.prefix)
+    write_annotations([gen], writer, treat_way, transform=transform, jobs=args.jobs, pipeline_threads=args.pipeline)
+    writer.close()
+    if not gen.seekable:
+        # the hash of a zip read from a stream is only known now
+        l.sources = [gen.as_lineage_source()]
 
     if args.metrics:
-        json.dump(writer.metrics, open(args.metrics,"w"))
+        metrics = dict(writer.metrics)
+        if writer.validator is not None:
+            metrics["validation"] = writer.validator.report
+        if fmt != "voc":
+            metrics["export"] = writer.report
+        json.dump(metrics, open(args.metrics,"w"))
 
     writer.write_lineage(l)
     if args.export_imagesets:
         writer.write_dataset_meta()
+    perf.write_report(args.perf_metrics)
 
 
 if __name__ == "__main__":
@@ -5,10 +5,23 @@ from posixpath import islink
 import xml.etree.ElementTree as ET
 from typing import List, Dict, IO, Optional, Tuple, Union, Generator
 import zipfile
-import os, shutil
+import os, shutil, copy
+import hashlib
+import json
+import threading
 from enum import Enum
 import logging, pathlib
-from .hashutil import hash_from_Str, hash_from_file
+from .hashutil import hash_from_Str, hash_from_file, get_default_hash_cache
+from .manifest import OutputManifest
+from .filecopy import CopyPool
+from .dedup import ImageDeduplicator, UniqueImage
+from .imagesize import ImageValidator
+from .splits import SplitAssigner, SplitWriter
+from .fingerprint import DirectoryFingerprint
+from . import perf
+from .fastparse import ObjectRecord, parse_record, object_record, _to_int, PARSERS, splice_annotation, text_element, size_element
+from .threadpool import ordered_map
+from .zipstream import HashingReader, StreamMember, iter_members, decompress_member
 import yaml
 
 def SingleFileLineageSource(fn):
@@ -18,29 +31,59 @@ def SingleFileLineageSource(fn):
     l.source_hash = hash
     return l
 
+# the C implementations of the yaml loader and dumper (libyaml) are a lot faster, if pyyaml was built with them
+_YamlLoader = getattr(yaml, "CLoader", yaml.Loader)
+_YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+
+
+class _LineageDumper(_YamlDumper):
+    """
+        never writes anchors and aliases: sources that were loaded from another lineage can share their dicts
+    """
+    def ignore_aliases(self, data) -> bool:
+        return True
+
+
 class LineageSource(object):
     """
         A LineageSource is a reference to a source dataset that was used to create this dataset. It might recursively refer other lineage sources
+        The nested sources of a source that was loaded from a file are only turned into LineageSource objects when they are accessed.
     """
     def __init__(self):
         self.annotation_path = ''
         self.image_path = ''
         self.root_dir = ''
         self.source_hash = ''
-        self.sources = []
-        pass
-    
+        self._sources: List[LineageSource] = []
+        # the dicts of the nested sources as they were loaded, until sources is accessed
+        self._source_dicts: Optional[List[Dict]] = None
+
+    @property
+    def sources(self) -> List[LineageSource]:
+        if self._source_dicts is not None:
+            self._sources = [LineageSource.from_dict(d) for d in self._source_dicts]
+            self._source_dicts = None
+        return self._sources
+
+    @sources.setter
+    def sources(self, s: List[LineageSource]) -> None:
+        self._sources = list(s)
+        self._source_dicts = None
+
+    @classmethod
+    def from_dict(cls, dct: Dict) -> LineageSource:
+        l = cls()
+        l._load_from_dict(dct)
+        return l
+
     def _load_from_dict(self, dct):
         self.annotation_path = dct['annotation_path']
         self.image_path = dct['image_path']
         if "sourcehash" in dct:
             self.source_hash = dct["sourcehash"]
         self.root_dir = dct['root_dir']
-        def create_from_dct(d):
-            l = LineageSource()
-            l._load_from_dict(d)
-            return l
-        self.sources = [create_from_dct(x) for x in dct['sources']]
+        self._sources = []
+        self._source_dicts = dct['sources']
     
     def _to_dict(self):
         d = {}
@@ -48,9 +91,13 @@ class LineageSource(object):
         d['image_path'] = self.image_path
         d['root_dir'] = self.root_dir
         d["sourcehash"] = self.source_hash
-        d['sources'] = [ x._to_dict() for x in self.sources ]
+        if self._source_dicts is not None:
+            d['sources'] = self._source_dicts
+        else:
+            d['sources'] = [ x._to_dict() for x in self._sources ]
         return d
 
+
 class DataLineage(object):
     """
         A DataLineage object holds information about how an artifact was created (which source datasets were used)
@@ -68,50 +115,84 @@ class DataLineage(object):
             * check if this DataLineage contains the same info as what is already in the yaml file (is_uptodate_with)
             * if not, you need to do whatever work is needed (computations, DAG) and dump_yaml the file to that path
 
+        The sources are kept as LineageSource objects (a source is copied when it is added, later changes to it are not
+        picked up) and the hash of their source hashes is updated as they are added. Files can be yaml or json (see
+        dump_json), the format is detected when loading.
     """
-    def __init__(self, src: Optional[Union[str, IO]] = None) -> None:
-        self.data = { 'sources' : [], 'params': {} }
-        if isinstance(src, str):
-            src = open(src, 'r')
+    def __init__(self, src: Optional[Union[str, pathlib.Path, IO]] = None) -> None:
+        self.params: Dict = {}
+        self._sources: List[LineageSource] = []
+        self._sources_hasher = hashlib.sha256()
+        self._has_empty = False
+        # what the file had besides params and sources (eg dataset_hash)
+        self._extra: Dict = {}
         if src is None:
-            pass
+            return
+        if isinstance(src, (str, pathlib.Path)):
+            with open(src, 'r') as f:
+                text = f.read()
         else:
-            self.data = yaml.load(src, yaml.Loader)
-        if not "params" in self.data:
-            self.data["params"] = {}
-    
+            text = src.read()
+        if text.lstrip().startswith("{"):
+            data = json.loads(text)
+        else:
+            data = yaml.load(text, _YamlLoader)
+        data = dict(data or {})
+        self.params = data.pop("params", None) or {}
+        for d in data.pop("sources", None) or []:
+            self._append(LineageSource.from_dict(d))
+        self._extra = data
+
+    @property
+    def data(self) -> Dict:
+        """
+            the lineage as a dict (like it is written to the file). params is the same dict as self.params
+        """
+        d = dict(self._extra)
+        d["params"] = self.params
+        d["sources"] = [x._to_dict() for x in self._sources]
+        return d
+
+    def _changed(self) -> None:
+        # a stored hash is no longer valid
+        self._extra.pop("dataset_hash", None)
+        self._extra.pop("has_sources_without_hash", None)
+
+    def _append(self, src: LineageSource) -> None:
+        self._sources.append(src)
+        self._sources_hasher.update(src.source_hash.encode("utf-8"))
+        if src.source_hash == "":
+            self._has_empty = True
 
     def add_param(self, key: str, val: Union[str, int, bool]):
-        self.data["params"][key] = val
+        self.params[key] = val
+        self._changed()
 
     @property
     def sources(self) -> List[LineageSource]:
-        d = self.data
-        def create_src(d) -> LineageSource:
-            l = LineageSource()
-            l._load_from_dict(d)
-            return l
-        return [create_src(x) for x in d['sources']]
-    
+        return list(self._sources)
+
+    @sources.setter
+    def sources(self, s: List[LineageSource]):
+        self._sources = []
+        self._sources_hasher = hashlib.sha256()
+        self._has_empty = False
+        for x in s:
+            self._append(copy.copy(x))
+        self._changed()
+
     def compute_hash(self):
-        buf = ""
-        hasempty = False
-        for s in self.sources:
-            buf += s.source_hash
-            if s.source_hash == "":
-                hasempty = True
-        
-        params = list(self.data["params"].items())
-        params = [f"{a[0]}:{a[1]}" for a in params]
+        params = [f"{a[0]}:{a[1]}" for a in self.params.items()]
         params.sort()
-        params = ",".join(params)
-        self.data["dataset_hash"] = hash_from_Str(buf+params)
-        self.data["has_sources_without_hash"] = hasempty
+        h = self._sources_hasher.copy()
+        h.update(",".join(params).encode("utf-8"))
+        self._extra["dataset_hash"] = h.hexdigest()
+        self._extra["has_sources_without_hash"] = self._has_empty
 
     def get_hash(self) -> Tuple(str, bool):
-        if not "dataset_hash" in self.data or self.data["dataset_hash"] == "":
+        if self._extra.get("dataset_hash", "") == "" or "has_sources_without_hash" not in self._extra:
             self.compute_hash()
-        return (self.data["dataset_hash"], not self.data["has_sources_without_hash"])
+        return (self._extra["dataset_hash"], not self._extra["has_sources_without_hash"])
     
 
     def is_uptodate_with(self, other: Union["DataLineage", pathlib.Path, str]):
@@ -137,31 +218,30 @@ class DataLineage(object):
     def dump_yaml(self, path: str):
         self.compute_hash()
         with open(path,'w') as f:
-            f.write(yaml.dump(self.data, Dumper=yaml.Dumper))
+            yaml.dump(self.data, f, Dumper=_LineageDumper)
+
+    def dump_json(self, path: str):
+        """
+            compact alternative for dump_yaml (loading it is faster too)
+        """
+        self.compute_hash()
+        with open(path, 'w') as f:
+            json.dump(self.data, f, separators=(",", ":"), sort_keys=True)
 
-    @sources.setter
-    def sources(self, s: List[LineageSource]):
-        self.data['sources'] = [x._to_dict() for x in s]
-    
     def as_source(self) -> LineageSource:
         l = LineageSource()
-        l.sources = self.sources
-        buf = ""
-        hasempty = False
-        for s in self.sources:
-            buf += s.source_hash
-            if s.source_hash == "":
-                hasempty = True
-        l.source_hash = hash_from_Str(buf)
+        l.sources = self._sources
+        l.source_hash = self._sources_hasher.hexdigest()
         return l
 
     def add_source(self, src: LineageSource):
-        s = self.sources
-        s.append(src)
-        self.sources = s
+        self._append(copy.copy(src))
+        self._changed()
 
 
 class BoundingBox(object):
+    __slots__ = ("xmin", "xmax", "ymin", "ymax")
+
     def __init__(self) -> None:
         self.xmin = None
         self.xmax = None
@@ -176,65 +256,288 @@ class BoundingBox(object):
         return True
     
 
+def _format_coord(v: float) -> str:
+    if float(v) == int(v):
+        return str(int(v))
+    return str(v)
+
 
 class PascalVocObject(object):
-    def __init__(self,el) -> None:
-        self.el = el
-    
+    """
+        One object of an annotation. The fields are parsed once (into an ObjectRecord) and cached.
+        Changes are written to the <object> element right away when the annotation has a DOM, otherwise they are kept
+        until the DOM is built (see PascalVocAnnotation).
+        Use PascalVocObject.create to make a new object that can be added to an annotation.
+    """
+    __slots__ = ("record", "_el", "owner", "_changed")
+
+    def __init__(self, el, record: Optional[ObjectRecord] = None, owner: Optional["PascalVocAnnotation"] = None) -> None:
+        """
+            el is the <object> element. Objects of an annotation that was parsed with the fast parser have no element yet,
+            they only have a record.
+        """
+        if record is None:
+            record = object_record(el, 0)
+        self.record = record
+        self._el = el
+        self.owner = owner
+        self._changed = set()
+
+    @classmethod
+    def create(cls, name: str, boundingbox: BoundingBox, occluded: bool = False, attributes: Optional[Dict[str, str]] = None) -> "PascalVocObject":
+        rec = ObjectRecord(None)
+        rec.name = name
+        rec.bndbox = (boundingbox.xmin, boundingbox.ymin, boundingbox.xmax, boundingbox.ymax)
+        rec.occluded = occluded
+        rec.attributes = dict(attributes or {})
+        return cls(None, rec)
+
+    def _new_element(self) -> ET.Element:
+        rec = self.record
+        el = ET.Element("object")
+        ET.SubElement(el, "name").text = rec.name
+        ET.SubElement(el, "occluded").text = "1" if rec.occluded else "0"
+        if rec.bndbox is not None:
+            bndbox = ET.SubElement(el, "bndbox")
+            for tag, v in zip(("xmin", "ymin", "xmax", "ymax"), rec.bndbox):
+                ET.SubElement(bndbox, tag).text = _format_coord(v)
+        if len(rec.attributes) > 0:
+            attrs = ET.SubElement(el, "attributes")
+            for k, v in rec.attributes.items():
+                a = ET.SubElement(attrs, "attribute")
+                ET.SubElement(a, "name").text = k
+                ET.SubElement(a, "value").text = v
+        return el
+
+    @property
+    def el(self) -> ET.Element:
+        """
+            the <object> element (building the DOM of the annotation if needed)
+        """
+        if self._el is None:
+            if self.owner is not None and self.record.index is not None:
+                self._el = self.owner._original_object_element(self.record.index)
+            else:
+                self._el = self._new_element()
+                self._changed.clear()
+            self._apply_changes()
+        return self._el
+
+    def _bound_element(self):
+        """
+            returns the element if the annotation already has a DOM, None otherwise
+        """
+        if self._el is None and (self.owner is None or self.owner._tree is None):
+            return None
+        return self.el
+
+    def _set(self, field: str) -> None:
+        if self.owner is not None:
+            self.owner._dirty = True
+        if self._bound_element() is None:
+            self._changed.add(field)
+        else:
+            self._changed = {field}
+            self._apply_changes()
+
+    def _apply_changes(self) -> None:
+        el = self._el
+        rec = self.record
+        for field in self._changed:
+            if field == "name":
+                if el.find("name") is None:
+                    el.insert(0, ET.Element("name"))
+                el.find("name").text = rec.name
+            elif field == "occluded":
+                if el.find("occluded") is None:
+                    el.append(ET.Element("occluded"))
+                el.find("occluded").text = "1" if rec.occluded else "0"
+            elif field == "bndbox":
+                bndbox = el.find("bndbox")
+                if bndbox is None:
+                    bndbox = ET.SubElement(el, "bndbox")
+                for tag, v in zip(("xmin", "ymin", "xmax", "ymax"), rec.bndbox):
+                    if bndbox.find(tag) is None:
+                        ET.SubElement(bndbox, tag)
+                    bndbox.find(tag).text = _format_coord(v)
+        self._changed.clear()
+
     @property
     def name(self) -> str:
-        return self.el.find("name").text
+        return self.record.name
     
     @property
     def occluded(self) -> bool:
-        if not self.el.find("occluded"):
-            return False
-        return int(self.el.find("occluded").text) == 1
+        return self.record.occluded
 
     @occluded.setter
     def occluded(self, o:bool) -> None:
-        if not self.el.find("occluded"):
-            self.el.append(ET.Element("occluded"))
-        self.el.find("occluded").text = "1" if o else "0"
+        self.record.occluded = bool(o)
+        self._set("occluded")
 
     @name.setter
     def name(self, n: str):
-        self.el.find("name").text = n
+        self.record.name = n
+        self._set("name")
     
     @property
     def boundingbox(self) -> BoundingBox:
-        bndbox = self.el.find("bndbox")
-        if bndbox:
-            b = BoundingBox()
-            b.xmin = float(bndbox.find("xmin").text)
-            b.xmax = float(bndbox.find("xmax").text)
-            b.ymin = float(bndbox.find("ymin").text)
-            b.ymax = float(bndbox.find("ymax").text)
-            return b
-        return None
+        if self.record.bndbox is None:
+            return None
+        b = BoundingBox()
+        b.xmin, b.ymin, b.xmax, b.ymax = self.record.bndbox
+        return b
+
+    @boundingbox.setter
+    def boundingbox(self, b: BoundingBox) -> None:
+        self.record.bndbox = (b.xmin, b.ymin, b.xmax, b.ymax)
+        self._set("bndbox")
 
     @property
     def attributes(self) -> Dict[str, str]:
-        d = {}
-        for a in self.el.find("attributes").findall("attribute"):
-            a_key = a.find("name").text
-            a_val = a.find("value").text
-            d[a_key] = a_val
-        return d
+        return dict(self.record.attributes)
+
+    def _copy_for(self, owner: "PascalVocAnnotation") -> "PascalVocObject":
+        """
+            returns a copy of this object that can be added to owner
+        """
+        if self.owner is None and self._el is None:
+            self.owner = owner
+            return self
+        # copy the element, so fields that are not in the record (pose, truncated, ...) survive
+        el = copy.deepcopy(self.el)
+        return PascalVocObject(el, object_record(el, None), owner)
 
 
 class PascalVocAnnotation(object):
-    def __init__(self, src, annotation_filename=None, root_directory=None) -> None:
+    """
+        A pascal voc annotation. The xml can be parsed into an ElementTree (parser="etree") or into lightweight records
+        (parser="fast", see tinyvoc.fastparse), in which case a DOM is only built when the annotation is modified and written.
+        The objects are parsed once and cached. The annotation keeps track of whether it was modified (dirty): an unmodified
+        annotation that was read from bytes is written back as a byte copy of the original xml.
+    """
+    def __init__(self, src, annotation_filename=None, root_directory=None, parser: str = "etree", object_filter=None) -> None:
+        """
+            src can be an ElementTree, a filename, a file object or the xml as bytes.
+            objects rejected by object_filter (a tinyvoc.objectfilter.ObjectFilter) are left out, with the fast parser
+            they are skipped while parsing.
+        """
         self.annotation_id = None
         self.annotation_fn = annotation_filename
         self.root_directory = root_directory
+        self._tree = None
+        self._raw = None
+        self._record = None
+        self._objects = None
+        self._objects_changed = False
+        self._header_changed = set()
+        self._original_elements = None
+        self._dirty = False
 
         if isinstance(src, ET.ElementTree):
             self.tree = src
             return 
+        if parser not in PARSERS:
+            raise Exception(f"unknown parser {parser}")
         if isinstance(src, str):
-            src = open(src,"r")
-        self.tree = ET.parse(src)
+            with open(src, "rb") as f:
+                src = f.read()
+        elif not isinstance(src, bytes):
+            src = src.read()
+            if isinstance(src, str):
+                src = src.encode("utf-8")
+        self._raw = src
+        with perf.timer("parsing"):
+            if parser == "fast":
+                self._record = parse_record(src, object_filter=object_filter, keep_root=True)
+            else:
+                self._set_tree(ET.ElementTree(ET.fromstring(src)))
+        if object_filter is None:
+            return
+        if self._record is not None:
+            if self._record.rejected > 0:
+                # the rejected objects are still in the original xml
+                self._objects = [PascalVocObject(None, r, self) for r in self._record.objects]
+                self._objects_changed = True
+                self._dirty = True
+            return
+        objects = self.objects
+        kept = [o for o in objects if object_filter.accepts(o.record)]
+        if len(kept) != len(objects):
+            self.objects = kept
+
+    @property
+    def dirty(self) -> bool:
+        """
+            True if the annotation was modified (or its tree was handed out) since it was read
+        """
+        return self._dirty or self._raw is None
+
+    def _set_tree(self, tree: ET.ElementTree) -> None:
+        self._tree = tree
+        self._original_elements = tree.getroot().findall("object")
+
+    def _build_tree(self) -> ET.ElementTree:
+        """
+            returns the DOM, building it from the original bytes (and applying the pending changes) if needed
+        """
+        if self._tree is not None:
+            return self._tree
+        if self._record is not None and self._record.root is not None:
+            # the elements the record was read from
+            self._set_tree(ET.ElementTree(self._record.root))
+            self._record.root = None
+        else:
+            with perf.timer("parsing"):
+                self._set_tree(ET.ElementTree(ET.fromstring(self._raw)))
+        root = self._tree.getroot()
+        for tag in self._header_changed:
+            if tag == "size":
+                self._write_size(self._record.size)
+                continue
+            if root.find(tag) is None:
+                ET.SubElement(root, tag)
+            root.find(tag).text = getattr(self._record, tag)
+        self._header_changed.clear()
+        if self._objects is not None:
+            for o in self._objects:
+                if o._el is None and o.record.index is not None and len(o._changed) > 0:
+                    o.el
+        if self._objects_changed:
+            self._write_object_elements()
+        return self._tree
+
+    def _write_object_elements(self) -> None:
+        root = self._tree.getroot()
+        current = root.findall("object")
+        pos = list(root).index(current[0]) if len(current) > 0 else len(root)
+        for el in current:
+            root.remove(el)
+        for i, o in enumerate(self._objects):
+            root.insert(pos + i, o.el)
+        self._objects_changed = False
+
+    @property
+    def tree(self) -> ET.ElementTree:
+        tree = self._build_tree()
+        # the caller might modify the tree directly, so the cached objects can't be trusted anymore
+        self._dirty = True
+        self._objects = None
+        return tree
+
+    @tree.setter
+    def tree(self, tree: ET.ElementTree):
+        self._set_tree(tree)
+        self._record = None
+        self._objects = None
+        self._dirty = True
+
+    def _original_object_element(self, index: int):
+        """
+            returns the element of the index-th object in the original xml (building the DOM if needed)
+        """
+        self._build_tree()
+        return self._original_elements[index]
     
     @property
     def id(self) -> str:
@@ -254,22 +557,51 @@ class PascalVocAnnotation(object):
 
     @property
     def objects(self) -> List[PascalVocObject]:
-        return [PascalVocObject(x) for x in self.tree.getroot().findall("object")]
+        """
+            the (cached) list of objects. to remove or add objects, assign a new list
+        """
+        if self._objects is None:
+            if self._tree is None:
+                if self._record.objects is None:
+                    # not read while parsing (see parse_record)
+                    self._record.objects = [object_record(el, i) for i, el in enumerate(self._record.root.findall("object"))]
+                self._objects = [PascalVocObject(None, r, self) for r in self._record.objects]
+            else:
+                self._objects = [PascalVocObject(el, object_record(el, i), self) for i, el in enumerate(self._tree.getroot().findall("object"))]
+        return list(self._objects)
     
     @objects.setter
     def objects(self, objs: List[PascalVocObject]):
-        cur = self.tree.getroot().findall("object")
-        for o in objs:
-            if not o.el in cur:
-                raise Exception("adding objects not yet implemented")
-        objs = [x.el for x in objs]
-        for o in cur:
-            if not o in objs:
-                self.tree.getroot().remove(o)
+        cur = self.objects
+        new = [o if o.owner is self else o._copy_for(self) for o in objs]
+        if len(new) == len(cur) and all(a is b for a, b in zip(new, cur)):
+            return
+        self._objects = new
+        self._objects_changed = True
+        self._dirty = True
+        if self._tree is not None:
+            self._write_object_elements()
+
+    def _get_header(self, tag: str) -> Optional[str]:
+        if self._tree is None:
+            return getattr(self._record, tag)
+        return self._tree.getroot().find(tag).text
+
+    def _set_header(self, tag: str, value: str) -> None:
+        self._dirty = True
+        if self._tree is None:
+            setattr(self._record, tag, value)
+            self._header_changed.add(tag)
+            return
+        root = self._tree.getroot()
+        if root.find(tag) is None:
+            # like _build_tree does for the fast parser
+            ET.SubElement(root, tag)
+        root.find(tag).text = value
 
     @property
     def filename(self) -> str:
-        return self.tree.getroot().find("filename").text
+        return self._get_header("filename")
     
     @property
     def annotation_filename(self) -> Optional[str]:
@@ -277,18 +609,206 @@ class PascalVocAnnotation(object):
 
     @filename.setter
     def filename(self, fn: str):
-        self.tree.getroot().find("filename").text = fn
+        self._set_header("filename", fn)
+
+    @property
+    def size(self) -> Optional[Tuple[int, int, int]]:
+        """
+            (width, height, depth) from the size element, None if there is no size element
+        """
+        if self._tree is None:
+            return self._record.size
+        size = self._tree.getroot().find("size")
+        if size is None:
+            return None
+        return (_to_int(size.findtext("width")), _to_int(size.findtext("height")), _to_int(size.findtext("depth")))
+
+    @size.setter
+    def size(self, size: Tuple[int, int, int]) -> None:
+        self._dirty = True
+        if self._tree is None:
+            self._record.size = tuple(size)
+            self._header_changed.add("size")
+            return
+        self._write_size(size)
+
+    def _write_size(self, size: Tuple[int, int, int]) -> None:
+        root = self._tree.getroot()
+        el = root.find("size")
+        if el is None:
+            # before the objects, like CVAT writes it
+            el = ET.Element("size")
+            first = root.find("object")
+            root.insert(list(root).index(first) if first is not None else len(root), el)
+        for tag, v in zip(("width", "height", "depth"), size):
+            if el.find(tag) is None:
+                ET.SubElement(el, tag)
+            el.find(tag).text = str(v)
 
     @property
     def folder(self) -> str:
-        return self.tree.getroot().find("folder").text
+        return self._get_header("folder")
     
     @folder.setter
     def folder(self, fn: str):
-        self.tree.getroot().find("folder").text = fn
+        self._set_header("folder", fn)
         
+    def _spliced(self) -> Optional[bytes]:
+        """
+            without a DOM (fast parser): the original bytes with the changes spliced in, None if that is not possible
+        """
+        if self._tree is not None or self._record is None:
+            return None
+        elements = {}
+        for tag in self._header_changed:
+            if tag == "size":
+                elements[tag] = size_element(self._record.size)
+            else:
+                elements[tag] = text_element(tag, getattr(self._record, tag))
+        kept = None
+        if self._objects is not None:
+            for o in self._objects:
+                if len(o._changed) > 0 or o._el is not None or o.owner is not self or o.record.index is None:
+                    # modified or new objects are written from a DOM
+                    return None
+            if self._objects_changed:
+                kept = [o.record.index for o in self._objects]
+        return splice_annotation(self._raw, elements, kept, len(self._record.objects or []) + self._record.rejected)
+
     def write(self, fileobj: Union[str,IO]):
-        self.tree.write(fileobj)
+        data = self._raw if not self.dirty else self._spliced()
+        if data is not None:
+            # not modified (or only in ways that can be spliced in): no need to serialize the DOM
+            if isinstance(fileobj, str):
+                with open(fileobj, "wb") as f:
+                    f.write(data)
+            else:
+                fileobj.write(data)
+            return
+        self._build_tree().write(fileobj)
+
+
+class ImageLocator(object):
+    """
+        Finds the image file that belongs to an annotation by probing a list of candidate paths.
+        When multiple candidates exist, the last one in the list wins.
+    """
+    def __init__(self, extra_search_path: Optional[List[str]] = None) -> None:
+        self.extra_search_path = list(extra_search_path or [])
+
+    def candidates(self, fn: str, src_root_dir: str) -> List[Tuple[Optional[str], str]]:
+        """
+            returns the candidate locations as (root, relative path) tuples, in increasing order of precedence.
+            a root of None means the path is relative to the working directory.
+        """
+        rel_fn = os.path.basename(fn)
+        search_for_image = []
+        for sp in self.extra_search_path:
+            search_for_image.append((sp, fn))
+            search_for_image.append((sp, rel_fn))
+
+        search_for_image.extend([
+            (None, fn),
+            (src_root_dir, fn),
+            (os.path.join(src_root_dir, "JPEGImages"), fn),
+            (None, rel_fn),
+            (src_root_dir, rel_fn),
+            (os.path.join(src_root_dir, "JPEGImages"), rel_fn),
+        ])
+        return search_for_image
+
+    def index_roots(self, root_dirs: List[str]) -> None:
+        """
+            hook to do preparatory work for the given source root directories. the probing locator has nothing to prepare.
+        """
+        pass
+
+    def exists(self, root: Optional[str], rel: str) -> bool:
+        perf.count("stat_calls")
+        return os.path.isfile(os.path.join(root, rel) if root is not None else rel)
+
+    def locate(self, annotation: PascalVocAnnotation, default_root_dir: str) -> str:
+        """
+            returns the path of the image, or an empty string if it could not be found
+        """
+        with perf.timer("locating"):
+            return self._locate(annotation, default_root_dir)
+
+    def _locate(self, annotation: PascalVocAnnotation, default_root_dir: str) -> str:
+        src_root_dir = annotation.root_directory
+        if src_root_dir is None:
+            src_root_dir = default_root_dir
+        return self.locate_filename(annotation.filename, str(src_root_dir))
+
+    def locate_filename(self, fn: str, src_root_dir: str) -> str:
+        """
+            like locate, for the image filename fn of an annotation in src_root_dir
+        """
+        # walk the candidates from high to low precedence so we can stop at the first hit
+        for root, rel in reversed(self.candidates(fn, src_root_dir)):
+            if self.exists(root, rel):
+                return os.path.join(root, rel) if root is not None else rel
+        return ''
+
+
+class IndexedImageLocator(ImageLocator):
+    """
+        ImageLocator that lists every directory a candidate is in once (a single scandir instead of a stat call per
+        candidate) and answers lookups from the listings. Only the directories that candidates point into are listed, not
+        recursively, and by the path as given, so the same precedence rules apply and the same symlinks are followed as
+        with ImageLocator. Candidates relative to the working directory, absolute paths and paths containing '..' are
+        still probed on disk.
+    """
+    def __init__(self, extra_search_path: Optional[List[str]] = None) -> None:
+        super().__init__(extra_search_path)
+        # directory -> names of the files in it
+        self.index: Dict[str, set] = {}
+
+    @staticmethod
+    def _scan(directory: str) -> set:
+        found = set()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return found
+        perf.count("stat_calls", len(entries))
+        for entry in entries:
+            try:
+                # like os.path.isfile, this follows symlinks
+                if entry.is_file():
+                    found.add(entry.name)
+            except OSError:
+                pass
+        return found
+
+    def _get_index(self, directory: str) -> set:
+        key = os.path.abspath(directory)
+        found = self.index.get(key)
+        if found is None:
+            logging.debug(f"indexing images in {directory}")
+            found = self.index[key] = self._scan(key)
+        return found
+
+    def index_roots(self, root_dirs: List[str]) -> None:
+        """
+            lists the directories that are candidates for every annotation: the extra search path, the source root
+            directories and their JPEGImages folders
+        """
+        for root in self.extra_search_path:
+            self._get_index(root)
+        for root in root_dirs:
+            self._get_index(str(root))
+            self._get_index(os.path.join(str(root), "JPEGImages"))
+
+    def exists(self, root: Optional[str], rel: str) -> bool:
+        if root is None or os.path.isabs(rel):
+            return super().exists(root, rel)
+        if os.sep in rel or rel.startswith("."):
+            rel = os.path.normpath(rel)
+            if rel.startswith("..") or (os.sep + ".." + os.sep) in rel:
+                return super().exists(root, rel)
+        directory, name = os.path.split(rel)
+        return name in self._get_index(os.path.join(root, directory) if directory != "" else root)
 
 
 class ImageTreatmentSetting(Enum):
@@ -300,6 +820,10 @@ class ImageTreatmentSetting(Enum):
     COPY_IMAGE_RENAME=6
     SYMLINK_IMAGE_RENAME=7
 
+# the image treatments that put a copy or link of the image in the output (and can be deduplicated)
+_LINKING_TREATMENTS = (ImageTreatmentSetting.COPY_IMAGE, ImageTreatmentSetting.COPY_IMAGE_RENAME,
+                       ImageTreatmentSetting.SYMLINK_IMAGE, ImageTreatmentSetting.SYMLINK_IMAGE_RENAME)
+
 class DirAnnotationWriter(object):
     def __init__(self, root_dir: str, annotation_output_dir: Optional[str] = None) -> None:
         self.root_dir = root_dir
@@ -313,37 +837,155 @@ class DirAnnotationWriter(object):
         self.metrics = {}
         self.ids = []
         self.extra_search_path = []
+        self.use_image_index = False
+        self._image_locator = None
+        self.manifest: Optional[OutputManifest] = None
+        self.copy_threads = 4
+        self.allow_hardlink = True
+        self._copy_pool: Optional[CopyPool] = None
+        self.copy_report: Optional[Dict[str, float]] = None
+        self.dedup: Optional[ImageDeduplicator] = None
+        self.splits: Optional[SplitWriter] = None
+        self.validator: Optional[ImageValidator] = None
 
     def _log_object(self, label):
         if not label in self.metrics:
             self.metrics[label] = 0
         self.metrics[label] = self.metrics[label] + 1
-        
 
-    def add_annotation(self,annotation: PascalVocAnnotation, treat_image: ImageTreatmentSetting) -> None:
-        fn = annotation.filename
-        src_root_dir = annotation.root_directory
-        if src_root_dir is None:
-            src_root_dir = self.root_dir
-        img_path = ''
-        rel_fn = os.path.basename(fn)
-        search_for_image = []
-        for sp in self.extra_search_path:
-            search_for_image.append(os.path.join(sp, fn)),
-            search_for_image.append(os.path.join(sp, rel_fn)),
+    def _add_id(self, id: str, labels: List[str], split_key: Optional[str] = None, split: Optional[str] = None) -> Optional[str]:
+        """
+            adds id to the dataset (and with splits, to the split picked by split_key, or to split if given), returns its split
+        """
+        self.ids.append(id)
+        if self.splits is not None:
+            return self.splits.add(id, labels, split_key, split)
+        return None
 
-        search_for_image.extend([
-            fn,
-            os.path.join(src_root_dir, fn),
-            os.path.join(src_root_dir, "JPEGImages", fn),
-            rel_fn,
-            os.path.join(src_root_dir, rel_fn),
-            os.path.join(src_root_dir, "JPEGImages", rel_fn),
-        ])
+    def _split_key(self, img_path: str) -> str:
+        """
+            the key the split of an annotation is picked by: the path of its image relative to the output root. unlike
+            the id (which can be a rename counter), it doesn't change when the dataset grows
+        """
+        return os.path.relpath(os.path.abspath(img_path), os.path.abspath(self.root_dir)).replace(os.sep, "/")
+
+    def get_image_locator(self) -> ImageLocator:
+        """
+            returns the (cached) image locator. set use_image_index to scan the search paths once instead of probing the filesystem for every annotation
+        """
+        locator_type = IndexedImageLocator if self.use_image_index else ImageLocator
+        loc = self._image_locator
+        if (loc is None) or (type(loc) != locator_type) or (loc.extra_search_path != list(self.extra_search_path)):
+            self._image_locator = locator_type(self.extra_search_path)
+        return self._image_locator
+
+    def locate_image(self, annotation: PascalVocAnnotation) -> str:
+        return self.get_image_locator().locate(annotation, self.root_dir)
+
+    def enable_incremental(self, params: Dict) -> None:
+        """
+            Keep a manifest of which input annotation produced which output files. Annotations that did not change since the
+            previous run (see is_unchanged/keep_unchanged) are not written again, and at close() the outputs of annotations that
+            are no longer in the input are removed. params should contain everything that influences the output.
+            Note that only the annotation content is fingerprinted: changes to copied images are not detected.
+        """
+        if self.dedup is not None:
+            raise Exception("incremental writing can not be combined with image deduplication")
+        self.manifest = OutputManifest(self.root_dir, params)
+        self.rename_counter = self.manifest.rename_counter
+
+    def enable_dedup(self, policy: str = "merge", threads: int = 4) -> None:
+        """
+            Identify images by content hash, so every unique image is linked or copied once (see tinyvoc.dedup for the
+            policies for the annotations of duplicate images). Only has an effect for the image treatments that link or copy
+            images. The counts are in dedup.report after close().
+        """
+        if self.manifest is not None:
+            raise Exception("image deduplication can not be combined with incremental writing")
+        self.dedup = ImageDeduplicator(policy, threads)
+
+    def enable_validation(self, policy: str = "clip", threads: int = 4) -> None:
+        """
+            Read the size of every image from its header, fill in or correct the size of the annotation and clip or reject
+            the boxes that are outside the image (see tinyvoc.imagesize). The counts are in validator.report.
+        """
+        self.validator = ImageValidator(policy, threads)
+
+    def _validate(self, annotation: PascalVocAnnotation, img_path: str) -> bool:
+        """
+            validates annotation against its image (if enabled), returns False if the annotation should not be written
+        """
+        if self.validator is not None:
+            return self.validator.validate(annotation, img_path)
+        return True
+
+    def enable_splits(self, assigner: SplitAssigner) -> None:
+        """
+            Assign every annotation to a split (see tinyvoc.splits) and write ImageSets/Main/<split>.txt and the per label
+            files <label>_<split>.txt, next to default.txt
+        """
+        self.splits = SplitWriter(os.path.join(self.root_dir, "ImageSets", "Main"), assigner)
+
+    def _manifest_key(self, ref) -> str:
+        src = os.path.relpath(os.path.abspath(ref.source_path), os.path.abspath(self.root_dir))
+        return f"{src}::{ref.member}"
+
+    def is_unchanged(self, ref) -> bool:
+        """
+            True if the annotation behind ref (a ZipAnnotationRef or FileAnnotationRef) was already written in a previous incremental run
+        """
+        if self.manifest is None:
+            return False
+        return self.manifest.is_unchanged(self._manifest_key(ref), ref.fingerprint())
 
-        for candidate in search_for_image:
-            if os.path.isfile(candidate) and os.path.exists(candidate):
-                img_path = candidate
+    def keep_unchanged(self, ref) -> None:
+        perf.count("annotations")
+        entry = self.manifest.keep(self._manifest_key(ref))
+        if entry["id"] is None:
+            return
+        for label in entry["labels"]:
+            self._log_object(label)
+        self._add_id(entry["id"], entry["labels"], entry.get("split_key"))
+
+    def skip_annotation(self, ref) -> None:
+        """
+            to be called for annotations that were dropped before reaching the writer (eg because they have no objects left)
+        """
+        perf.count("annotations")
+        if self.manifest is not None and ref is not None:
+            self.manifest.record(self._manifest_key(ref), ref.fingerprint(), None, [], [])
+
+    def _write_annotation(self, annotation: PascalVocAnnotation) -> str:
+        """
+            writes the annotation (its image was already linked or copied), returns the path of the output.
+            writers for other formats (see tinyvoc.exporters) override this
+        """
+        xml_path = os.path.join(self.annotation_output_dir, annotation.id + ".xml")
+        with perf.timer("writing"):
+            annotation.write(xml_path)
+        if perf.get_recorder() is not None:
+            perf.count("bytes_written", os.path.getsize(xml_path))
+        return xml_path
+
+    def _copy_image(self, src: str, dest: str) -> None:
+        """
+            copies in the background (see tinyvoc.filecopy), close() waits for the copies to finish
+        """
+        if self._copy_pool is None:
+            self._copy_pool = CopyPool(self.copy_threads, allow_hardlink=self.allow_hardlink)
+        self._copy_pool.submit(src, dest)
+
+    def add_annotation(self,annotation: PascalVocAnnotation, treat_image: ImageTreatmentSetting, ref=None) -> None:
+        self.add_located_annotation(annotation, self.locate_image(annotation), treat_image, ref)
+
+    def add_located_annotation(self, annotation: PascalVocAnnotation, img_path: str, treat_image: ImageTreatmentSetting, ref=None) -> None:
+        """
+            Second half of add_annotation: img_path is the result of locate_image (empty if the image was not found).
+            Splitting this out allows the lookup to happen elsewhere (eg in a worker process) while the ids are still assigned in order here.
+            ref is only needed for incremental writing.
+        """
+        perf.count("annotations")
+        fn = annotation.filename
         if ((img_path == '') and (treat_image != ImageTreatmentSetting.KEEP_PATH)):
             logging.warning(f"need to rewrite path but image does not exist {annotation.id} name={fn}, removing annotation")
             return None
@@ -351,38 +993,132 @@ class DirAnnotationWriter(object):
             print(f"path {fn} {img_path} {os.path.abspath(img_path)}")
             img_path = fn
         fn = img_path
+        if not self._validate(annotation, fn):
+            return None
+        split_key = self._split_key(fn)
+
+        digest = None
+        if (self.dedup is not None) and treat_image in _LINKING_TREATMENTS:
+            digest = self.dedup.digest(fn)
+            first = self.dedup.find(digest)
+            if first is not None:
+                self._add_duplicate(annotation, first, treat_image)
+                return None
 
-        self.rename_counter += 1
+        rename_id = None
+        if (self.manifest is not None) and (ref is not None) and treat_image in (ImageTreatmentSetting.COPY_IMAGE_RENAME, ImageTreatmentSetting.SYMLINK_IMAGE_RENAME):
+            # keep the id of the previous run, so other outputs don't have to be renamed
+            rename_id = self.manifest.previous_id(self._manifest_key(ref))
+        if rename_id is None:
+            self.rename_counter += 1
+            rename_id = f'{self.rename_counter:06}'
+        outputs = []
         if treat_image == ImageTreatmentSetting.REWRITE_ABSPATH:
             fn = os.path.abspath(fn)
             annotation.filename = fn
         elif treat_image == ImageTreatmentSetting.REWRITE_RELPATH:
             fn = os.path.relpath(fn, self.image_dir)
             annotation.filename = fn
-        elif treat_image == (ImageTreatmentSetting.COPY_IMAGE, ImageTreatmentSetting.COPY_IMAGE_RENAME):
+        elif treat_image in (ImageTreatmentSetting.COPY_IMAGE, ImageTreatmentSetting.COPY_IMAGE_RENAME):
             os.makedirs(self.image_dir, exist_ok=True)
             dest_fn = os.path.split(fn)[1]
             if treat_image == ImageTreatmentSetting.COPY_IMAGE_RENAME:
-                dest_fn = f'{self.rename_counter:06}' + os.path.splitext(dest_fn)[1]
-                annotation.id = f'{self.rename_counter:06}'
+                dest_fn = rename_id + os.path.splitext(dest_fn)[1]
+                annotation.id = rename_id
             dest_pth = os.path.join(self.image_dir, dest_fn)
-            shutil.copy2(fn, dest_pth)
+            if os.path.islink(dest_pth):
+                os.unlink(dest_pth)
+            self._copy_image(os.path.abspath(fn), dest_pth)
+            outputs.append(dest_pth)
             annotation.filename = os.path.relpath(dest_pth, self.image_dir)
         elif treat_image in (ImageTreatmentSetting.SYMLINK_IMAGE, ImageTreatmentSetting.SYMLINK_IMAGE_RENAME):
             os.makedirs(self.image_dir, exist_ok=True)
             dest_fn = os.path.split(fn)[1]
             if treat_image == ImageTreatmentSetting.SYMLINK_IMAGE_RENAME:
-                dest_fn = f'{self.rename_counter:06}' + os.path.splitext(dest_fn)[1]
-                annotation.id = f'{self.rename_counter:06}'
+                dest_fn = rename_id + os.path.splitext(dest_fn)[1]
+                annotation.id = rename_id
             dest_pth = os.path.join(self.image_dir, dest_fn)
-            if os.path.islink(dest_pth):
-                os.unlink(dest_pth)
-            os.symlink(os.path.abspath(fn), dest_pth)
+            with perf.timer("linking"):
+                if os.path.islink(dest_pth):
+                    os.unlink(dest_pth)
+                os.symlink(os.path.abspath(fn), dest_pth)
+            outputs.append(dest_pth)
             annotation.filename = os.path.relpath(dest_pth, self.image_dir)
-        annotation.write(os.path.join(self.annotation_output_dir, annotation.id + ".xml"))
-        for o in annotation.objects:
-            self._log_object(o.name)
-        self.ids.append(annotation.id)
+        xml_path = self._write_annotation(annotation)
+        outputs.append(xml_path)
+        labels = [o.name for o in annotation.objects]
+        for label in labels:
+            self._log_object(label)
+        split = self._add_id(annotation.id, labels, split_key)
+        if digest is not None:
+            self.dedup.add_unique(digest, annotation, xml_path, split)
+        if (self.manifest is not None) and (ref is not None):
+            self.manifest.record(self._manifest_key(ref), ref.fingerprint(), annotation.id, outputs, labels, split_key)
+
+    def _add_duplicate(self, annotation: PascalVocAnnotation, first: UniqueImage, treat_image: ImageTreatmentSetting) -> None:
+        """
+            handles an annotation whose image was already written for the annotation first, according to the dedup policy
+        """
+        self.dedup.report["duplicate_images"] += 1
+        if self.dedup.policy == "drop":
+            self.dedup.report["dropped_annotations"] += 1
+            logging.debug(f"dropping annotation {annotation.id}: same image as {first.id}")
+            return
+        if self.dedup.policy == "merge":
+            labels = self.dedup.merge(first, annotation)
+            for label in labels:
+                self._log_object(label)
+            if self.splits is not None:
+                self.splits.add_labels(first.id, labels)
+            return
+        # flag: write the annotation, referring to the image that was already linked
+        if treat_image in (ImageTreatmentSetting.COPY_IMAGE_RENAME, ImageTreatmentSetting.SYMLINK_IMAGE_RENAME):
+            self.rename_counter += 1
+            annotation.id = f'{self.rename_counter:06}'
+        annotation.filename = first.filename
+        self._write_annotation(annotation)
+        labels = [o.name for o in annotation.objects]
+        for label in labels:
+            self._log_object(label)
+        # the same split as the image it refers to, so an image is never in two splits
+        self._add_id(annotation.id, labels, split=first.split)
+        self.dedup.duplicates[annotation.id] = first.id
+        self.dedup.report["flagged_annotations"] += 1
+
+    def close(self) -> None:
+        """
+            finishes writing: waits for the image copies (the summary is in copy_report) and in incremental mode, removes
+            outputs that are no longer needed and saves the manifest
+        """
+        if self._copy_pool is not None:
+            self.copy_report = self._copy_pool.close()
+            self._copy_pool = None
+        if self.dedup is not None:
+            self._close_dedup()
+        if self.splits is not None:
+            self.splits.close(self.metrics.keys())
+            logging.info("splits: " + ", ".join(f"{name} {n}" for name, n in self.splits.sizes.items()))
+        if self.manifest is None:
+            # the manifest of an earlier incremental run does not describe this output anymore
+            OutputManifest.discard(self.root_dir)
+            return
+        stale = self.manifest.stale_outputs()
+        for pth in stale:
+            if os.path.lexists(pth):
+                os.remove(pth)
+        self.manifest.save(self.rename_counter)
+        logging.info(f"incremental write: {len(self.manifest.entries)} annotations, {len(stale)} stale outputs removed")
+
+    def _close_dedup(self) -> None:
+        with perf.timer("writing"):
+            self.dedup.write_merged()
+        pth = os.path.join(self.root_dir, "duplicates.json")
+        if len(self.dedup.duplicates) > 0:
+            with open(pth, "w") as f:
+                json.dump(self.dedup.duplicates, f, indent=2, sort_keys=True)
+        elif os.path.isfile(pth):
+            os.remove(pth)
+        logging.info("dedup ({policy}): {unique_images} unique images, {duplicate_images} duplicates".format(policy=self.dedup.policy, **self.dedup.report))
 
     def write_lineage(self, d: DataLineage):
         d.dump_yaml(os.path.join(self.root_dir, "data-lineage.yaml"))
@@ -409,8 +1145,33 @@ class DirAnnotationWriter(object):
 
 
 
+def _is_seekable(f) -> bool:
+    if isinstance(f, (str, pathlib.Path)):
+        return True
+    try:
+        return f.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def _is_annotation_member(name: str) -> bool:
+    return pathlib.Path(name).suffix.lower() == '.xml'
+
+
 class AnnotationZip(object):
-    def __init__(self, zipfile: Union[str, IO, pathlib.Path], root_dir: str=  None) -> None:
+    def __init__(self, zipfile: Union[str, IO, pathlib.Path], root_dir: str=  None, parser: str = "etree", workers: int = 1, object_filter=None) -> None:
+        """
+            parser is "etree" (parse every annotation into an ElementTree) or "fast" (see tinyvoc.fastparse)
+            object_filter (a tinyvoc.objectfilter.ObjectFilter) is applied to the objects while parsing
+            workers is the number of threads that decompress and parse members (the annotations are still yielded in order)
+            zipfile can be a non-seekable stream (eg sys.stdin.buffer): it is then read front to back (see tinyvoc.zipstream),
+            which can only be done once. the hash of a stream is only known after it was read completely.
+        """
+        if parser not in PARSERS:
+            raise Exception(f"unknown parser {parser}")
+        self.parser = parser
+        self.workers = workers
+        self.object_filter = object_filter
         self.zipfile = zipfile
         if isinstance(zipfile, str):
             if not os.path.exists(zipfile):
@@ -419,61 +1180,230 @@ class AnnotationZip(object):
             if not zipfile.exists():
                 raise Exception(f"file {zipfile} not found")
         self.root_dir = root_dir
+        self.seekable = _is_seekable(zipfile)
+        self._stream_hash = None
+        self._stream_consumed = False
     
     def as_lineage_source(self):
         src = LineageSource()
         src.root_dir = self.root_dir
-        src.source_hash = hash_from_file(self.zipfile)
+        if self.seekable:
+            src.source_hash = hash_from_file(self.zipfile)
+        elif self._stream_hash is not None:
+            src.source_hash = self._stream_hash
+        else:
+            logging.info("source is a stream, its hash is only known after reading it")
         if self.root_dir is None:
             src.root_dir = os.getcwd()
         if isinstance(self.zipfile, str):
             src.annotation_path = self.zipfile
         else:
-            src.annotation_path = self.zipfile.name
+            src.annotation_path = str(getattr(self.zipfile, "name", ""))
         return src
 
     def generate_annotations(self) -> Generator[PascalVocAnnotation, None, None]:
+        if not self.seekable:
+            yield from ordered_map(_load_ref, self.generate_refs(), self.workers)
+            return
         with zipfile.ZipFile(self.zipfile) as zip:
+            def load(info: zipfile.ZipInfo) -> PascalVocAnnotation:
+                # ZipFile supports reading members from several threads, decompression happens outside its lock
+                with perf.timer("unzipping"):
+                    data = zip.read(info)
+                perf.count("bytes_read", len(data))
+                return PascalVocAnnotation(data, info.filename, self.root_dir, parser=self.parser, object_filter=self.object_filter)
+            infos = (info for info in zip.infolist() if _is_annotation_member(info.filename))
+            yield from ordered_map(load, infos, self.workers)
+
+    def generate_refs(self) -> Generator[Union["ZipAnnotationRef", "StreamAnnotationRef"], None, None]:
+        """
+            like generate_annotations, but yields lightweight references that can be loaded later (eg in another process)
+        """
+        if not self.seekable:
+            yield from self._generate_stream_refs()
+            return
+        zip_path = self.zipfile
+        if not isinstance(zip_path, (str, pathlib.Path)):
+            if not hasattr(zip_path, "name"):
+                raise Exception("cannot create references to a zipfile without a filename")
+            zip_path = zip_path.name
+        zip_path = os.path.abspath(str(zip_path))
+        with zipfile.ZipFile(zip_path) as zip:
             for info in zip.infolist():
-                if pathlib.Path(info.filename).suffix.lower() == '.xml':
-                    try:
-                        fobj = zip.open(info.filename)
-                        f = ET.parse(zip.open(info.filename))
-                        yield PascalVocAnnotation(f, info.filename, self.root_dir)
-                    finally:
-                        fobj.close()
+                if _is_annotation_member(info.filename):
+                    yield ZipAnnotationRef(zip_path, info.filename, self.root_dir, info.CRC, info.file_size, self.parser, self.object_filter)
+
+    def _generate_stream_refs(self) -> Generator["StreamAnnotationRef", None, None]:
+        if self._stream_consumed:
+            raise Exception("a zip stream can only be read once")
+        self._stream_consumed = True
+        reader = HashingReader(self.zipfile)
+        source_path = os.path.abspath(str(getattr(self.zipfile, "name", "<stream>")))
+        for member in iter_members(reader, _is_annotation_member):
+            if _is_annotation_member(member.filename):
+                yield StreamAnnotationRef(member, source_path, self.root_dir, self.parser, self.object_filter)
+        # read the central directory too, so we have the hash of the complete file
+        reader.drain()
+        self._stream_hash = reader.hexdigest()
+
+
+def _load_ref(ref) -> PascalVocAnnotation:
+    return ref.load()
+
+
+_open_zipfiles: Dict[str, zipfile.ZipFile] = {}
+_open_zipfiles_lock = threading.Lock()
+
+class ZipAnnotationRef(object):
+    """
+        Reference to one annotation inside a zipfile. Refs are small and picklable.
+    """
+    def __init__(self, zip_path: str, member: str, root_dir: Optional[str] = None, crc: int = 0, size: int = 0, parser: str = "etree", object_filter=None) -> None:
+        self.zip_path = zip_path
+        self.member = member
+        self.root_dir = root_dir
+        self.crc = crc
+        self.size = size
+        self.parser = parser
+        self.object_filter = object_filter
+
+    @property
+    def source_path(self) -> str:
+        return self.zip_path
+
+    def fingerprint(self) -> str:
+        # the zip directory already has a checksum of every member, no need to read anything
+        return f"crc32:{self.crc:08x}:{self.size}"
+
+    def load(self) -> PascalVocAnnotation:
+        # keep the zipfile open for the lifetime of the process, refs of the same zip usually come in long runs
+        with _open_zipfiles_lock:
+            zip = _open_zipfiles.get(self.zip_path)
+            if zip is None:
+                zip = zipfile.ZipFile(self.zip_path)
+                _open_zipfiles[self.zip_path] = zip
+        with perf.timer("unzipping"):
+            data = zip.read(self.member)
+        perf.count("bytes_read", len(data))
+        return PascalVocAnnotation(data, self.member, self.root_dir, parser=self.parser, object_filter=self.object_filter)
+
+
+class StreamAnnotationRef(object):
+    """
+        Annotation read from a zip stream. The ref holds the compressed data, decompressing and parsing happens in load
+        (so it can be done in another thread or process).
+    """
+    def __init__(self, member: StreamMember, source_path: str, root_dir: Optional[str] = None, parser: str = "etree", object_filter=None) -> None:
+        self.zip_member = member
+        self.member = member.filename
+        self.source_path = source_path
+        self.root_dir = root_dir
+        self.parser = parser
+        self.object_filter = object_filter
+
+    def fingerprint(self) -> str:
+        return f"crc32:{self.zip_member.CRC:08x}:{self.zip_member.file_size}"
+
+    def load(self) -> PascalVocAnnotation:
+        with perf.timer("unzipping"):
+            data = decompress_member(self.zip_member)
+        perf.count("bytes_read", len(data))
+        return PascalVocAnnotation(data, self.member, self.root_dir, parser=self.parser, object_filter=self.object_filter)
+
 
 def get_zip_annotations(zipfile: Union[str, IO], root_dir: str = None) -> Generator[PascalVocAnnotation, None, None]:
     az = AnnotationZip(zipfile, root_dir)
     return az.generate_annotations()
 
 class AnnotationDirectory(object):
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, parser: str = "etree", object_filter=None) -> None:
+        """
+            parser is "etree" (parse every annotation into an ElementTree) or "fast" (see tinyvoc.fastparse)
+            object_filter (a tinyvoc.objectfilter.ObjectFilter) is applied to the objects while parsing
+            image_locator is used to find the images for the fingerprint (see as_lineage_source), set it to the locator
+            of the writer so the images are found the same way (default: a probing ImageLocator)
+        """
+        if parser not in PARSERS:
+            raise Exception(f"unknown parser {parser}")
         self.path = path
+        self.parser = parser
+        self.object_filter = object_filter
+        self.image_locator: Optional[ImageLocator] = None
+
+    @property
+    def root_dir(self) -> str:
+        return self.path
 
     def as_lineage_source(self):
         if os.path.isfile(os.path.join(self.path,'data-lineage.yaml')):
             src = DataLineage(os.path.join(self.path,'data-lineage.yaml')).as_source()
         else:
+            # no lineage (eg a hand curated dataset): fingerprint the annotations and their images. that reads every
+            # annotation, so only when the hashes are cached; without a hash the source is never up to date
             src = LineageSource()
+            cache = get_default_hash_cache()
+            if cache is None:
+                logging.info(f"{self.path} has no data lineage and no hash cache is used to fingerprint it, so it is never up to date")
+            else:
+                fp = DirectoryFingerprint(self.path, self.image_locator or ImageLocator(), cache, parser=self.parser)
+                src.source_hash = fp.compute()
         
         src.root_dir = str(self.path.absolute())
         return src
 
     def generate_annotations(self) -> Generator[PascalVocAnnotation, None, None]:
+        for ref in self.generate_refs():
+            yield ref.load()
+
+    def generate_refs(self) -> Generator["FileAnnotationRef", None, None]:
         for root,dirs,files in os.walk(self.path):
             for f in files:
                 if os.path.splitext(f)[1].lower() == '.xml':
-                    yield PascalVocAnnotation(os.path.join(root,f), f, self.path)
+                    yield FileAnnotationRef(os.path.join(root,f), self.path, self.parser, self.object_filter)
+
+
+class FileAnnotationRef(object):
+    """
+        Reference to one annotation file in an annotation directory.
+    """
+    def __init__(self, path: str, root_dir: Optional[str] = None, parser: str = "etree", object_filter=None) -> None:
+        self.path = path
+        self.root_dir = root_dir
+        self.parser = parser
+        self.object_filter = object_filter
+        self.member = ""
+        self._fingerprint = None
+
+    @property
+    def source_path(self) -> str:
+        return self.path
+
+    def fingerprint(self) -> str:
+        if self._fingerprint is None:
+            self._fingerprint = hash_from_file(self.path)
+        return self._fingerprint
+
+    def load(self) -> PascalVocAnnotation:
+        with open(self.path, "rb") as f:
+            data = f.read()
+        perf.count("bytes_read", len(data))
+        return PascalVocAnnotation(data, os.path.basename(self.path), self.root_dir, parser=self.parser, object_filter=self.object_filter)
+
 
 def get_dir_annotations(path: str) -> Generator[PascalVocAnnotation, None, None]:
     ad = AnnotationDirectory(path)
     return ad.generate_annotations()
 
-def filter_args_for_datalineage(args: dict):
+def filter_args_for_datalineage(args: dict, ignore: Tuple[str, ...] = ()):
+    """
+        keeps the arguments that can be stored as lineage parameters.
+        arguments in ignore (eg the number of worker processes) don't influence the result and are left out
+    """
     allowed = [(int, False), (str, False), (pathlib.Path, True), (bool, False), (pathlib.PosixPath, True)]
     new_d = {}
     for (k,v) in args.items():
+        if k in ignore:
+            continue
         for (a,to_str) in allowed:
             if isinstance(v,a):
                 if to_str:
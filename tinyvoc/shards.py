@@ -0,0 +1,299 @@
+"""
+    Sharded output: annotations (and optionally the image bytes) packed in tar files of a fixed maximum size, with a json
+    index, instead of one xml file and one symlink per annotation.
+
+    The index (index.json in the root of the dataset) lists the shards and, for every annotation id, where its xml (and its
+    packed image, if any) is in which shard, so an annotation can be read with a single pread. The shards are plain tar
+    files (the xml is <id>.xml, the image is the filename the annotation refers to), so they can also be streamed by
+    other tools (eg webdataset).
+"""
+import io
+import json
+import logging
+import os
+import pathlib
+import tarfile
+import zlib
+from typing import Dict, Generator, List, Optional
+
+from . import perf
+from .fastparse import PARSERS
+from .pvocutils import (AnnotationDirectory, AnnotationZip, DirAnnotationWriter, ImageTreatmentSetting, PascalVocAnnotation,
+                        DataLineage, LineageSource, _LINKING_TREATMENTS)
+
+INDEX_FILENAME = "index.json"
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+
+
+def is_sharded_dataset(path) -> bool:
+    return os.path.isfile(os.path.join(str(path), INDEX_FILENAME))
+
+
+def open_source(path, parser: str = "etree"):
+    """
+        returns the AnnotationZip, ShardedAnnotationSource or AnnotationDirectory for path (the same way merge-annotations does)
+    """
+    if str(path).lower().endswith(".zip"):
+        return AnnotationZip(str(path), os.path.split(str(path))[0], parser=parser)
+    if is_sharded_dataset(path):
+        return ShardedAnnotationSource(str(path), parser=parser)
+    return AnnotationDirectory(pathlib.Path(path), parser=parser)
+
+
+class ShardedAnnotationWriter(DirAnnotationWriter):
+    """
+        DirAnnotationWriter that packs the annotations in tar shards of at most shard_size bytes (an annotation and its
+        image always go to the same shard, so a shard can be a bit bigger). The image treatment decides what happens to
+        the images: with COPY_IMAGE(_RENAME), the image bytes are packed next to the annotation, with SYMLINK_IMAGE(_RENAME)
+        and REWRITE_ABSPATH the annotation refers to the absolute path of the image, with REWRITE_RELPATH to the path
+        relative to the root dir. The _RENAME treatments rename the annotations like DirAnnotationWriter does.
+        Incremental writing is not supported, and the only dedup policies are drop and flag.
+    """
+    def __init__(self, root_dir: str, shard_size: int = DEFAULT_SHARD_SIZE, prefix: str = "shard") -> None:
+        # no Annotations folder: the annotations go to the shards
+        super().__init__(root_dir, annotation_output_dir=root_dir)
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.shards: List[str] = []
+        self.entries: Dict[str, dict] = {}
+        self._tar: Optional[tarfile.TarFile] = None
+
+    def enable_incremental(self, params: Dict) -> None:
+        raise Exception("incremental writing is not supported for sharded output")
+
+    def enable_dedup(self, policy: str = "merge", threads: int = 4) -> None:
+        if policy == "merge":
+            # the first annotation of an image may already be in a closed shard
+            raise Exception("the merge dedup policy is not supported for sharded output")
+        super().enable_dedup(policy, threads)
+
+    def _open_shard(self) -> tarfile.TarFile:
+        if self._tar is not None and self._tar.offset < self.shard_size:
+            return self._tar
+        if self._tar is not None:
+            self._tar.close()
+        name = f"{self.prefix}-{len(self.shards):06d}.tar"
+        self.shards.append(name)
+        self._tar = tarfile.open(os.path.join(self.root_dir, name), "w", format=tarfile.PAX_FORMAT)
+        return self._tar
+
+    def _add_member(self, name: str, fileobj, size: int, mtime: float = 0) -> List:
+        """
+            adds a member to the current shard, returns [shard, offset, size] of its data
+        """
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        self._tar.addfile(info, fileobj)
+        offset = self._tar.offset - ((size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        perf.count("bytes_written", size)
+        return [len(self.shards) - 1, offset, size]
+
+    def add_located_annotation(self, annotation: PascalVocAnnotation, img_path: str, treat_image: ImageTreatmentSetting, ref=None) -> None:
+        perf.count("annotations")
+        if (img_path == '') and (treat_image != ImageTreatmentSetting.KEEP_PATH):
+            logging.warning(f"need to rewrite path but image does not exist {annotation.id} name={annotation.filename}, removing annotation")
+            return None
+        elif img_path == '':
+            img_path = annotation.filename
+        if not self._validate(annotation, img_path):
+            return None
+        split_key = self._split_key(img_path)
+
+        digest = None
+        first = None
+        if (self.dedup is not None) and treat_image in _LINKING_TREATMENTS:
+            digest = self.dedup.digest(img_path)
+            first = self.dedup.find(digest)
+            if first is not None:
+                self.dedup.report["duplicate_images"] += 1
+                if self.dedup.policy == "drop":
+                    self.dedup.report["dropped_annotations"] += 1
+                    return None
+
+        if treat_image in (ImageTreatmentSetting.COPY_IMAGE_RENAME, ImageTreatmentSetting.SYMLINK_IMAGE_RENAME):
+            self.rename_counter += 1
+            annotation.id = f'{self.rename_counter:06}'
+        if annotation.id in self.entries:
+            logging.warning(f"annotation id {annotation.id} was already written, the index will refer to the last one")
+
+        self._open_shard()
+        entry = {}
+        if first is not None:
+            # flag: refer to the image of the first annotation
+            annotation.filename = first.filename
+            if "image" in self.entries[first.id]:
+                entry["image"] = self.entries[first.id]["image"]
+        elif treat_image in (ImageTreatmentSetting.COPY_IMAGE, ImageTreatmentSetting.COPY_IMAGE_RENAME):
+            name = os.path.basename(img_path)
+            if treat_image == ImageTreatmentSetting.COPY_IMAGE_RENAME:
+                name = annotation.id + os.path.splitext(name)[1]
+            st = os.stat(img_path)
+            with perf.timer("copying"), open(img_path, "rb") as f:
+                entry["image"] = self._add_member(name, f, st.st_size, st.st_mtime) + [name]
+            annotation.filename = name
+        elif treat_image in (ImageTreatmentSetting.SYMLINK_IMAGE, ImageTreatmentSetting.SYMLINK_IMAGE_RENAME, ImageTreatmentSetting.REWRITE_ABSPATH):
+            annotation.filename = os.path.abspath(img_path)
+        elif treat_image == ImageTreatmentSetting.REWRITE_RELPATH:
+            annotation.filename = os.path.relpath(img_path, self.root_dir)
+
+        buf = io.BytesIO()
+        with perf.timer("writing"):
+            annotation.write(buf)
+            xml = buf.getvalue()
+            buf.seek(0)
+            entry["xml"] = self._add_member(annotation.id + ".xml", buf, len(xml)) + [zlib.crc32(xml)]
+        self.entries[annotation.id] = entry
+        labels = [o.name for o in annotation.objects]
+        for label in labels:
+            self._log_object(label)
+        split = self._add_id(annotation.id, labels, split_key, first.split if first is not None else None)
+        if first is not None:
+            self.dedup.duplicates[annotation.id] = first.id
+            self.dedup.report["flagged_annotations"] += 1
+        elif digest is not None:
+            self.dedup.add_unique(digest, annotation, None, split)
+
+    def close(self) -> None:
+        super().close()
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+        # shards of a previous (bigger) run
+        for fn in os.listdir(self.root_dir):
+            if fn.startswith(self.prefix + "-") and fn.endswith(".tar") and fn not in self.shards:
+                os.remove(os.path.join(self.root_dir, fn))
+        with open(os.path.join(self.root_dir, INDEX_FILENAME), "w") as f:
+            json.dump({"version": 1, "shards": self.shards, "annotations": self.entries}, f, separators=(",", ":"))
+        logging.info(f"wrote {len(self.entries)} annotations to {len(self.shards)} shards")
+
+
+class ShardedAnnotationSource(object):
+    """
+        Reads a dataset written by ShardedAnnotationWriter: random access by annotation id (get, read_xml, read_image),
+        and the same interface as AnnotationDirectory, so it can be a source for the writers (eg in merge-annotations).
+        Packed images are not files, so before the images can be linked or copied, they have to be extracted to image_dir
+        (default: JPEGImages in the dataset root) with extract_images (generate_refs does this too).
+    """
+    def __init__(self, path, parser: str = "etree", image_dir: Optional[str] = None) -> None:
+        if parser not in PARSERS:
+            raise Exception(f"unknown parser {parser}")
+        self.path = path
+        self.parser = parser
+        self.image_dir = image_dir if image_dir is not None else os.path.join(str(path), "JPEGImages")
+        with open(os.path.join(str(path), INDEX_FILENAME)) as f:
+            index = json.load(f)
+        if index.get("version") != 1:
+            raise Exception(f"unsupported shard index version {index.get('version')} in {path}")
+        self.shards: List[str] = [os.path.join(str(path), s) for s in index["shards"]]
+        self.entries: Dict[str, dict] = index["annotations"]
+        self._fds: Dict[int, int] = {}
+        self._extracted = False
+
+    @property
+    def root_dir(self) -> str:
+        return self.path
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.entries
+
+    def ids(self) -> List[str]:
+        return list(self.entries.keys())
+
+    def _read(self, loc: List) -> bytes:
+        shard, offset, size = loc[:3]
+        fd = self._fds.get(shard)
+        if fd is None:
+            fd = self._fds[shard] = os.open(self.shards[shard], os.O_RDONLY)
+        return os.pread(fd, size, offset)
+
+    def read_xml(self, id: str) -> bytes:
+        return self._read(self.entries[id]["xml"])
+
+    def read_image(self, id: str) -> Optional[bytes]:
+        """
+            the packed image of the annotation, None if its image is not packed
+        """
+        loc = self.entries[id].get("image")
+        return self._read(loc) if loc is not None else None
+
+    def get(self, id: str) -> PascalVocAnnotation:
+        return PascalVocAnnotation(self.read_xml(id), id + ".xml", root_directory=self.path, parser=self.parser)
+
+    def close(self) -> None:
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+    def extract_images(self) -> int:
+        """
+            writes the packed images to image_dir (skipping the ones that are already there with the right size),
+            returns the number of images written
+        """
+        if self._extracted:
+            return 0
+        n = 0
+        os.makedirs(self.image_dir, exist_ok=True)
+        for entry in self.entries.values():
+            loc = entry.get("image")
+            if loc is None:
+                continue
+            pth = os.path.join(self.image_dir, loc[3])
+            if os.path.isfile(pth) and os.path.getsize(pth) == loc[2]:
+                continue
+            tmp = pth + ".tinyvoc-part"
+            with open(tmp, "wb") as f:
+                f.write(self._read(loc))
+            os.replace(tmp, pth)
+            n += 1
+        self._extracted = True
+        if n > 0:
+            logging.info(f"extracted {n} images from the shards in {self.path} to {self.image_dir}")
+        return n
+
+    def as_lineage_source(self):
+        pth = os.path.join(str(self.path), 'data-lineage.yaml')
+        if os.path.isfile(pth):
+            src = DataLineage(pth).as_source()
+        else:
+            src = LineageSource()
+        src.root_dir = os.path.abspath(str(self.path))
+        return src
+
+    def generate_annotations(self) -> Generator[PascalVocAnnotation, None, None]:
+        for id in self.entries:
+            yield self.get(id)
+
+    def generate_refs(self) -> Generator["ShardAnnotationRef", None, None]:
+        self.extract_images()
+        for id, entry in self.entries.items():
+            yield ShardAnnotationRef(self.shards[entry["xml"][0]], id, entry["xml"], self.path, self.parser)
+
+
+class ShardAnnotationRef(object):
+    """
+        Lightweight, picklable reference to an annotation in a shard
+    """
+    def __init__(self, shard_path: str, member: str, loc: List, root_dir: Optional[str] = None, parser: str = "etree") -> None:
+        self.shard_path = shard_path
+        self.member = member
+        self.loc = loc
+        self.root_dir = root_dir
+        self.parser = parser
+
+    @property
+    def source_path(self) -> str:
+        return self.shard_path
+
+    def fingerprint(self) -> str:
+        return f"{self.loc[3]}:{self.loc[2]}"
+
+    def load(self) -> PascalVocAnnotation:
+        with open(self.shard_path, "rb") as f:
+            f.seek(self.loc[1])
+            data = f.read(self.loc[2])
+        perf.count("bytes_read", len(data))
+        return PascalVocAnnotation(data, self.member + ".xml", root_directory=self.root_dir, parser=self.parser)
@@ -0,0 +1,211 @@
+"""
+    Deterministic train/val/test splits for the annotation writers.
+
+    The split of an annotation is picked by hashing a key (with an optional seed): the writers use the path of its image
+    relative to the output root, not the id, which can be a rename counter. So it does not depend on the order or the
+    number of annotations: nothing has to be kept in memory to assign a split, and annotations keep their split when the
+    dataset grows. An annotation can also be put in a given split (eg a duplicate of an image that is already in one).
+
+    With stratification, the split is balanced per label: if the hashed split already has more than its share of the
+    rarest label of the annotation, the split that is furthest below its share is used instead. That depends on the
+    order of the annotations, so the splits of a previous run are read back (from ImageSets/Main) and kept.
+
+    The ids are written to ImageSets/Main/<split>.txt while the annotations are added. At close, the VOC per label files
+    (<label>_<split>.txt, with 1 or -1 for every id of the split) are written from those files.
+"""
+import argparse
+import hashlib
+import os
+from typing import Dict, IO, Iterable, List, Optional, Tuple
+
+DEFAULT_SPLITS = "train=0.8,val=0.1,test=0.1"
+
+
+def parse_split_spec(spec: str) -> List[Tuple[str, float]]:
+    """
+        parses "train=0.8,val=0.1,test=0.1" into [("train", 0.8), ...]. the fractions are normalized to sum to 1
+    """
+    splits = []
+    for part in spec.split(","):
+        if "=" not in part:
+            raise Exception(f"invalid split {part}, expected name=fraction")
+        name, fraction = part.split("=", 1)
+        splits.append((name.strip(), float(fraction)))
+    total = sum(f for _, f in splits)
+    if total <= 0 or any(f < 0 for _, f in splits):
+        raise Exception(f"invalid split fractions in {spec}")
+    return [(name, f / total) for name, f in splits]
+
+
+def hash_fraction(key: str) -> float:
+    """
+        maps key to a number in [0, 1), uniformly and the same on every machine and python version
+    """
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big") / 2 ** 64
+
+
+class SplitAssigner(object):
+    def __init__(self, splits: List[Tuple[str, float]], seed: str = "", stratify: bool = False) -> None:
+        self.splits = splits
+        self.names = [name for name, _ in splits]
+        self.seed = seed
+        self.stratify = stratify
+        # with stratification: counts[label][split]
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.previous: Dict[str, str] = {}
+
+    def hashed_split(self, key: str) -> str:
+        u = hash_fraction(f"{self.seed}:{key}")
+        cumulative = 0.0
+        for name, fraction in self.splits:
+            cumulative += fraction
+            if u < cumulative:
+                return name
+        return self.names[-1]
+
+    def assign(self, id: str, labels: Iterable[str] = (), key: Optional[str] = None) -> str:
+        """
+            the split of annotation id, picked by hashing key (id if key is None)
+        """
+        if key is None:
+            key = id
+        if not self.stratify:
+            return self.hashed_split(key)
+        labels = set(labels)
+        split = self.previous.get(id)
+        if split is None:
+            split = self.hashed_split(key)
+            if len(labels) > 0:
+                split = self._balance(split, self._rarest(labels))
+        self.count(split, labels)
+        return split
+
+    def count(self, split: str, labels: Iterable[str]) -> None:
+        """
+            counts the labels of an annotation in split (for stratification)
+        """
+        if not self.stratify:
+            return
+        for label in set(labels):
+            per_split = self.counts.setdefault(label, {n: 0 for n in self.names})
+            per_split[split] = per_split.get(split, 0) + 1
+
+    def _rarest(self, labels: set) -> str:
+        return min(labels, key=lambda l: (sum(self.counts.get(l, {}).values()), l))
+
+    def _balance(self, split: str, label: str) -> str:
+        counts = self.counts.get(label, {})
+        total = sum(counts.values()) + 1
+        deficit = {name: fraction * total - counts.get(name, 0) for name, fraction in self.splits}
+        # allow one annotation of slack, so small strata still follow the hash
+        if deficit[split] > -1:
+            return split
+        return max(self.names, key=lambda n: (deficit[n], -self.names.index(n)))
+
+
+class SplitWriter(object):
+    """
+        Writes the ids of every split to <image_sets_dir>/<split>.txt while they are assigned, and the per label files
+        at close.
+    """
+    def __init__(self, image_sets_dir: str, assigner: SplitAssigner) -> None:
+        self.dir = image_sets_dir
+        self.assigner = assigner
+        self.sizes: Dict[str, int] = {name: 0 for name in assigner.names}
+        os.makedirs(self.dir, exist_ok=True)
+        if assigner.stratify:
+            assigner.previous = self.read_previous()
+        self._files: Dict[str, IO] = {}
+        self._tmp = os.path.join(self.dir, ".tinyvoc-positives.part")
+        self._positives_file = open(self._tmp, "w")
+
+    def read_previous(self) -> Dict[str, str]:
+        previous = {}
+        for name in self.assigner.names:
+            pth = os.path.join(self.dir, name + ".txt")
+            if os.path.isfile(pth):
+                with open(pth) as f:
+                    for line in f:
+                        if line.strip() != "":
+                            previous[line.strip()] = name
+        return previous
+
+    def add(self, id: str, labels: Iterable[str], key: Optional[str] = None, split: Optional[str] = None) -> str:
+        """
+            assigns id to a split by hashing key (see SplitAssigner.assign), or puts it in split if that is given,
+            and returns the split
+        """
+        labels = sorted(set(labels))
+        if split is None:
+            split = self.assigner.assign(id, labels, key)
+        else:
+            self.assigner.count(split, labels)
+        f = self._files.get(split)
+        if f is None:
+            f = self._files[split] = open(os.path.join(self.dir, split + ".txt.part"), "w")
+        f.write(id + "\n")
+        self.sizes[split] += 1
+        # label and id can't contain tabs or newlines (they are used in filenames)
+        self.add_labels(id, labels)
+        return split
+
+    def add_labels(self, id: str, labels: Iterable[str]) -> None:
+        """
+            labels that were added to an annotation after it was assigned (eg merged duplicates), for the per label files
+        """
+        for label in sorted(set(labels)):
+            self._positives_file.write(f"{label}\t{id}\n")
+
+    def close(self, labels: Iterable[str]) -> None:
+        """
+            finishes the split files and writes the per label files for labels (all labels of the dataset)
+        """
+        for f in self._files.values():
+            f.close()
+        self._positives_file.close()
+        for name in self.assigner.names:
+            part = os.path.join(self.dir, name + ".txt.part")
+            if not os.path.isfile(part):
+                open(part, "w").close()
+            os.replace(part, os.path.join(self.dir, name + ".txt"))
+        positives: Dict[str, set] = {}
+        with open(self._tmp) as f:
+            for line in f:
+                label, id = line.rstrip("\n").split("\t", 1)
+                positives.setdefault(label, set()).add(id)
+        os.remove(self._tmp)
+        for name in self.assigner.names:
+            with open(os.path.join(self.dir, name + ".txt")) as f:
+                ids = [line.strip() for line in f if line.strip() != ""]
+            for label in labels:
+                pos = positives.get(label, set())
+                with open(os.path.join(self.dir, f"{label}_{name}.txt"), "w") as f:
+                    f.writelines(f"{id} {'1' if id in pos else '-1'}\n" for id in ids)
+
+
+def add_split_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--splits", type=str, nargs="?", const=DEFAULT_SPLITS,
+                        help=f"also write ImageSets/Main/<split>.txt and <label>_<split>.txt, assigning annotations to splits by hashing the path of their image (default when given without value: {DEFAULT_SPLITS})")
+    parser.add_argument("--split-seed", type=str, default="", help="seed for the split assignment (another seed gives other splits)")
+    parser.add_argument("--stratify", action="store_true", help="with --splits: balance the splits per label")
+
+SPLIT_ARGS = ("splits", "split_seed", "stratify")
+
+
+def split_assigner_from_args(args: argparse.Namespace) -> Optional[SplitAssigner]:
+    """
+        the assigner configured by the arguments added by add_split_args, None if no splits were requested
+    """
+    if not args.splits:
+        return None
+    return SplitAssigner(parse_split_spec(args.splits), args.split_seed, args.stratify)
+
+
+def split_lineage_param(args: argparse.Namespace) -> Optional[str]:
+    """
+        description of the split arguments for the data lineage (None if no splits were requested)
+    """
+    if not args.splits:
+        return None
+    splits = ",".join(f"{name}={fraction:g}" for name, fraction in parse_split_spec(args.splits))
+    return f"{splits};seed={args.split_seed};stratify={bool(args.stratify)}"
@@ -1,16 +1,76 @@
 from tinyvoc.pvocutils import PascalVocObject
 from tinyvoc import PascalVocAnnotation
-from typing import List, Tuple
+from typing import Iterable, List, Sequence, Tuple, Union
+
+Box = Tuple[float, float, float, float]
+
+
+def overlapping_pairs(boxes: Sequence[Box]) -> List[Tuple[int, int]]:
+    """
+        returns all pairs (i, j) with i < j of (xmin, ymin, xmax, ymax) boxes that overlap (touching counts as overlapping,
+        like BoundingBox.overlaps), sorted.
+        sweep line over the boxes sorted by xmin: a box only has to be compared with the boxes that start before it ends.
+    """
+    order = sorted(range(len(boxes)), key=lambda i: boxes[i][0])
+    pairs = []
+    for pos, i in enumerate(order):
+        axmin, aymin, axmax, aymax = boxes[i]
+        for j in order[pos+1:]:
+            bxmin, bymin, bxmax, bymax = boxes[j]
+            if bxmin > axmax:
+                break
+            if (axmin > bxmax) or (aymax < bymin) or (aymin > bymax):
+                continue
+            pairs.append((i, j) if i < j else (j, i))
+    pairs.sort()
+    return pairs
+
+
+class _UnionFind(object):
+    def __init__(self, n: int) -> None:
+        self.parent = list(range(n))
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            # keep the smallest index as root, so components are numbered in order of their first member
+            if ri < rj:
+                self.parent[rj] = ri
+            else:
+                self.parent[ri] = rj
+
+
+def component_indices(boxes: Sequence[Box]) -> List[List[int]]:
+    """
+        groups the boxes in connected components of overlapping boxes. components are ordered by their first box, and
+        contain the box indices in increasing order.
+    """
+    uf = _UnionFind(len(boxes))
+    for i, j in overlapping_pairs(boxes):
+        uf.union(i, j)
+    components = {}
+    for i in range(len(boxes)):
+        components.setdefault(uf.find(i), []).append(i)
+    return list(components.values())
+
+
+def _boxes(nodes: List[PascalVocObject]) -> List[Box]:
+    boxes = []
+    for n in nodes:
+        b = n.boundingbox
+        boxes.append((b.xmin, b.ymin, b.xmax, b.ymax))
+    return boxes
+
 
 def overlapping_objects(nodes: List[PascalVocObject]) -> List[Tuple[PascalVocObject, PascalVocObject]]:
-    aj = []
-    for i in range(len(nodes)):
-        test_node = nodes[i]
-        the_rest = nodes[i+1:]
-        for n in the_rest:
-            if test_node.boundingbox.overlaps(n.boundingbox):
-                aj.append( (test_node, n))
-    return aj
+    return [(nodes[i], nodes[j]) for i, j in overlapping_pairs(_boxes(nodes))]
 
 
 def dfs(start, adjacency_list, nodes):
@@ -36,15 +96,30 @@ def dfs(start, adjacency_list, nodes):
 
 def connected_components(annot: PascalVocAnnotation) -> List[List[PascalVocObject]]:
     L = annot.objects[:]
-    AJ = overlapping_objects(L)
-    Cs = []
-    while len(L) > 0:
-        N = L[0]
-        C = dfs(N, AJ, L)
-        Cs.append(C)
-        for n in C:
-            L.remove(n)
-    return Cs
+    return [[L[i] for i in c] for c in component_indices(_boxes(L))]
 
 def overlap_factor(annot: PascalVocAnnotation):
-    return float(len(annot.objects)) / float(len(connected_components(annot)))
\ No newline at end of file
+    return float(len(annot.objects)) / float(len(connected_components(annot)))
+
+
+def overlap_factors(annotations: Union[Iterable[PascalVocAnnotation], "AnnotationTable"]) -> List[Tuple[str, float]]:
+    """
+        overlap_factor for every annotation of a dataset, as (annotation id, factor) tuples. annotations without objects are skipped.
+        annotations can be any annotation source (eg AnnotationZip), an iterable of annotations or a columnar AnnotationTable,
+        which avoids building objects altogether.
+    """
+    result = []
+    if hasattr(annotations, "object_offsets"):
+        table = annotations
+        for img in range(table.n_images):
+            boxes = [tuple(float(v) for v in b) for b in table.boxes[table.objects_of(img)]]
+            if len(boxes) > 0:
+                result.append((str(table.annotation_ids[img]), len(boxes) / len(component_indices(boxes))))
+        return result
+    if hasattr(annotations, "generate_annotations"):
+        annotations = annotations.generate_annotations()
+    for annot in annotations:
+        boxes = _boxes(annot.objects)
+        if len(boxes) > 0:
+            result.append((annot.id, len(boxes) / len(component_indices(boxes))))
+    return result
@@ -0,0 +1,91 @@
+"""
+    Generates synthetic pascal voc datasets, eg for benchmarks (see tinyvoc.benchmark).
+
+    A dataset is a root directory with JPEGImages (small dummy image files) and the annotations, either as a CVAT like
+    export zip (cvat.zip with Annotations/frame_%06d.xml members) or as an Annotations directory.
+"""
+import os
+import random
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import List, Optional, Sequence, Tuple
+
+DEFAULT_LABELS = ["Car", "Pedestrian", "Bicycle", "Truck", "Tree"]
+LAYOUTS = ("zip", "dir")
+
+
+def annotation_xml(filename: str, objects: Sequence[Tuple[str, bool, int, int, int, int, str]], width: int = 640, height: int = 480) -> bytes:
+    """
+        objects are (label, occluded, xmin, ymin, xmax, ymax, type attribute) tuples
+    """
+    root = ET.Element("annotation")
+    ET.SubElement(root, "folder").text = ""
+    ET.SubElement(root, "filename").text = filename
+    source = ET.SubElement(root, "source")
+    ET.SubElement(source, "database").text = "Unknown"
+    size = ET.SubElement(root, "size")
+    for tag, v in (("width", width), ("height", height), ("depth", 3)):
+        ET.SubElement(size, tag).text = str(v)
+    ET.SubElement(root, "segmented").text = "0"
+    for label, occluded, xmin, ymin, xmax, ymax, type_attr in objects:
+        obj = ET.SubElement(root, "object")
+        ET.SubElement(obj, "name").text = label
+        ET.SubElement(obj, "pose").text = "Unspecified"
+        ET.SubElement(obj, "truncated").text = "0"
+        ET.SubElement(obj, "difficult").text = "0"
+        ET.SubElement(obj, "occluded").text = "1" if occluded else "0"
+        bndbox = ET.SubElement(obj, "bndbox")
+        for tag, v in (("xmin", xmin), ("ymin", ymin), ("xmax", xmax), ("ymax", ymax)):
+            ET.SubElement(bndbox, tag).text = str(v)
+        attributes = ET.SubElement(obj, "attributes")
+        attribute = ET.SubElement(attributes, "attribute")
+        ET.SubElement(attribute, "name").text = "Type"
+        ET.SubElement(attribute, "value").text = type_attr
+    return ET.tostring(root)
+
+
+def random_objects(rnd: random.Random, n: int, labels: Sequence[str], width: int = 640, height: int = 480, max_box: int = 120) -> List[Tuple[str, bool, int, int, int, int, str]]:
+    objects = []
+    for _ in range(n):
+        w = rnd.randint(1, max_box)
+        h = rnd.randint(1, max_box)
+        x = rnd.randint(0, width - w)
+        y = rnd.randint(0, height - h)
+        objects.append((rnd.choice(labels), rnd.random() < 0.2, x, y, x + w, y + h, rnd.choice(["A", "B"])))
+    return objects
+
+
+def make_dataset(root: str, images: int = 1000, objects: Tuple[int, int] = (0, 8), labels: Optional[Sequence[str]] = None,
+                 layout: str = "zip", image_size: int = 4096, missing_images: int = 0, seed: int = 0) -> str:
+    """
+        writes a synthetic dataset to root, returns the path of the annotations (the zip or the Annotations directory).
+        every image gets between objects[0] and objects[1] objects. every missing_images-th image file is left out
+        (0: all images exist), to exercise the code paths for annotations without image.
+    """
+    if layout not in LAYOUTS:
+        raise Exception(f"unknown layout {layout}")
+    labels = list(labels or DEFAULT_LABELS)
+    rnd = random.Random(seed)
+    image_dir = os.path.join(root, "JPEGImages")
+    os.makedirs(image_dir, exist_ok=True)
+    members = []
+    for i in range(images):
+        fn = f"frame_{i:06d}.PNG"
+        if missing_images <= 0 or i % missing_images != missing_images - 1:
+            with open(os.path.join(image_dir, fn), "wb") as f:
+                # not a real image, but unique content per image (for hashing/dedup)
+                f.write(b"\x89PNG" + i.to_bytes(4, "little") * (image_size // 4))
+        xml = annotation_xml(fn, random_objects(rnd, rnd.randint(*objects), labels))
+        members.append((f"frame_{i:06d}.xml", xml))
+    if layout == "zip":
+        path = os.path.join(root, "cvat.zip")
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+            for name, xml in members:
+                z.writestr("Annotations/" + name, xml)
+        return path
+    path = os.path.join(root, "Annotations")
+    os.makedirs(path, exist_ok=True)
+    for name, xml in members:
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(xml)
+    return path
@@ -0,0 +1,40 @@
+"""
+    Ordered map over a thread pool.
+
+    Used for work that releases the GIL for a good part of the time (zlib decompression, file io, hashing): the results
+    come back in the order of the input, and only a bounded number of items is in flight, so a huge input (eg a zip
+    with tens of thousands of members) is never read ahead completely.
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def ordered_map(fn: Callable[[T], R], iterable: Iterable[T], workers: int = 1, max_pending: Optional[int] = None) -> Iterator[R]:
+    """
+        like map(fn, iterable), but fn runs in workers threads. at most max_pending (default 4 * workers) items are
+        submitted but not yet yielded. the iterable is consumed in the calling thread.
+        with workers <= 1, this is just map.
+    """
+    if workers <= 1:
+        yield from map(fn, iterable)
+        return
+    if max_pending is None:
+        max_pending = 4 * workers
+    it = iter(iterable)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in it:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            # when the consumer stops early (or fn raised), don't start the work that is still queued
+            for f in pending:
+                f.cancel()
@@ -2,28 +2,278 @@
 import sys
 import os
 import argparse
+import json
+import logging
+import math
 import pathlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterator, List, Optional, Tuple
 from .pvocutils import DataLineage, LineageSource, SingleFileLineageSource
+from . import perf
+from .hashcache import add_hash_cache_args, configure_hash_cache_from_args, HASH_CACHE_ARGS
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXTENSIONS = {"png": ".PNG", "jpeg": ".jpg"}
+
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="dataset preparation")
     parser.add_argument("--source", type=pathlib.Path, required=True, help="input movie")
     parser.add_argument("--destination", type=pathlib.Path, required=True, help="output directory (will be deleted)")
     parser.add_argument("--prefix", type=str, required=True, help="prefix for images (instead of 'frame')", default='frame')
-    return parser.parse_args()
+    parser.add_argument("--stream", action="store_true", help="read the frames from an ffmpeg pipe and write them with their final names (needed for the options below)")
+    parser.add_argument("--every", type=int, default=1, help="only keep every Nth frame (frame numbers stay the ones of the video) (default=1)")
+    parser.add_argument("--start", type=float, help="start time in seconds")
+    parser.add_argument("--end", type=float, help="end time in seconds")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default="png", help="image format (default=png)")
+    parser.add_argument("--jpeg-qscale", type=int, default=2, help="jpeg quality as ffmpeg -q:v value, 2 (best) to 31 (default=2)")
+    parser.add_argument("--segments", type=int, default=1, help="decode this many time segments in parallel (default=1)")
+    parser.add_argument("--ffmpeg", type=str, default="ffmpeg", help="ffmpeg executable")
+    parser.add_argument("--ffprobe", type=str, default="ffprobe", help="ffprobe executable")
+    parser.add_argument("--perf-metrics", type=pathlib.Path, help="json file to write timings, counters and throughput of the processing stages to (enables instrumentation)")
+    add_hash_cache_args(parser)
+    args = parser.parse_args()
+    if not args.stream:
+        for opt in ["every", "start", "end", "format", "segments"]:
+            if getattr(args, opt) != parser.get_default(opt):
+                parser.error(f"--{opt} needs --stream")
+    return args
+
+
+class _PipeReader(object):
+    def __init__(self, stream: IO[bytes]) -> None:
+        self.stream = stream
+        self.buf = bytearray()
+
+    def _fill(self, n: int) -> bool:
+        while len(self.buf) < n:
+            more = self.stream.read(max(n - len(self.buf), 1 << 16))
+            if len(more) == 0:
+                return False
+            self.buf += more
+        return True
+
+    def at_end(self) -> bool:
+        return not self._fill(1)
+
+    def read_exact(self, n: int) -> bytes:
+        if not self._fill(n):
+            raise Exception("unexpected end of frame stream")
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def read_until(self, marker: bytes) -> bytes:
+        """
+            reads up to and including marker
+        """
+        start = 0
+        while True:
+            pos = self.buf.find(marker, start)
+            if pos >= 0:
+                return self.read_exact(pos + len(marker))
+            start = max(0, len(self.buf) - len(marker) + 1)
+            if not self._fill(len(self.buf) + 1):
+                raise Exception("unexpected end of frame stream")
+
+
+def iter_png_frames(stream: IO[bytes]) -> Iterator[bytes]:
+    """
+        splits a stream of concatenated png images (ffmpeg -f image2pipe -c:v png) in images, by walking the png chunks
+    """
+    r = _PipeReader(stream)
+    while not r.at_end():
+        parts = [r.read_exact(len(PNG_SIGNATURE))]
+        if parts[0] != PNG_SIGNATURE:
+            raise Exception("frame stream is not a png stream")
+        while True:
+            header = r.read_exact(8)
+            length = int.from_bytes(header[:4], "big")
+            parts.append(header)
+            parts.append(r.read_exact(length + 4))
+            if header[4:8] == b"IEND":
+                break
+        yield b"".join(parts)
+
+
+def iter_jpeg_frames(stream: IO[bytes]) -> Iterator[bytes]:
+    """
+        splits a stream of concatenated jpeg images (ffmpeg -f image2pipe -c:v mjpeg) in images.
+        the header segments are skipped by their length (they can contain any byte), after the start of scan the image
+        ends at the first EOI marker (0xff bytes in the entropy coded data are always followed by 0x00 or a RST marker)
+    """
+    r = _PipeReader(stream)
+    while not r.at_end():
+        parts = [r.read_exact(2)]
+        if parts[0] != b"\xff\xd8":
+            raise Exception("frame stream is not a jpeg stream")
+        while True:
+            marker = r.read_exact(2)
+            if marker[0] != 0xFF:
+                raise Exception("corrupt jpeg in frame stream")
+            parts.append(marker)
+            if marker[1] == 0xD9:
+                break
+            if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+                continue
+            length = r.read_exact(2)
+            parts.append(length)
+            parts.append(r.read_exact(int.from_bytes(length, "big") - 2))
+            if marker[1] == 0xDA:
+                parts.append(r.read_until(b"\xff\xd9"))
+                break
+        yield b"".join(parts)
+
+
+def probe_video(ffprobe: str, path: str) -> Tuple[float, int]:
+    """
+        returns (frames per second, number of frames) of the first video stream
+    """
+    out = subprocess.run([ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries",
+                          "stream=r_frame_rate,nb_frames,duration:format=duration", "-of", "json", path],
+                         check=True, stdout=subprocess.PIPE).stdout
+    info = json.loads(out)
+    stream = info["streams"][0]
+    num, den = stream["r_frame_rate"].split("/")
+    fps = float(num) / float(den)
+    if str(stream.get("nb_frames", "")).isdigit():
+        return fps, int(stream["nb_frames"])
+    duration = float(stream.get("duration") or info["format"]["duration"])
+    return fps, int(math.floor(duration * fps))
 
 
+class FrameSegment(object):
+    """
+        frames first_frame, first_frame + every, ... (count frames) of a video
+    """
+    def __init__(self, first_frame: int, count: int) -> None:
+        self.first_frame = first_frame
+        self.count = count
+
+
+def plan_segments(fps: float, n_frames: int, every: int, start: Optional[float], end: Optional[float], segments: int) -> List[FrameSegment]:
+    """
+        splits the frames to extract in segments of (almost) the same number of frames
+    """
+    first = 0 if start is None else int(math.ceil(start * fps - 1e-6))
+    last = n_frames if end is None else min(n_frames, int(math.ceil(end * fps - 1e-6)))
+    total = max(0, (last - first + every - 1) // every)
+    plan = []
+    done = 0
+    for i in range(segments):
+        count = total * (i + 1) // segments - done
+        if count > 0:
+            plan.append(FrameSegment(first + done * every, count))
+        done += count
+    return plan
+
+
+class StreamFrameExtractor(object):
+    """
+        Extracts frames by reading them from an ffmpeg pipe (instead of letting ffmpeg write every frame and renaming them
+        afterwards), so only the frames we keep are encoded and written, directly with their CVAT name (prefix_%06d,
+        numbered from 0 like the frames of the video).
+        Segments of the video are decoded by separate ffmpeg processes in parallel. Seeking is done by time, so frame
+        numbers are exact for constant frame rate videos.
+    """
+    def __init__(self, source: str, destination: str, prefix: str = "frame", every: int = 1, start: Optional[float] = None,
+                 end: Optional[float] = None, format: str = "png", jpeg_qscale: int = 2, segments: int = 1,
+                 ffmpeg: str = "ffmpeg", ffprobe: str = "ffprobe") -> None:
+        if format not in EXTENSIONS:
+            raise Exception(f"unknown image format {format}")
+        if every < 1:
+            raise Exception("every should be at least 1")
+        self.source = source
+        self.destination = destination
+        self.prefix = prefix
+        self.every = every
+        self.start = start
+        self.end = end
+        self.format = format
+        self.jpeg_qscale = jpeg_qscale
+        self.segments = segments
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+
+    def _command(self, seek: Optional[float], count: Optional[int]) -> List[str]:
+        cmd = [self.ffmpeg, "-v", "error", "-nostdin"]
+        if seek is not None:
+            cmd += ["-ss", "%.6f" % seek]
+        cmd += ["-i", self.source]
+        if self.every > 1:
+            cmd += ["-vf", "select=not(mod(n\\,%d))" % self.every]
+        cmd += ["-vsync", "0"]
+        if count is not None:
+            cmd += ["-frames:v", str(count)]
+        cmd += ["-f", "image2pipe"]
+        if self.format == "png":
+            cmd += ["-c:v", "png"]
+        else:
+            cmd += ["-c:v", "mjpeg", "-q:v", str(self.jpeg_qscale)]
+        return cmd + ["-"]
+
+    def _run(self, cmd: List[str], first_frame: int, expected: Optional[int]) -> int:
+        split = iter_png_frames if self.format == "png" else iter_jpeg_frames
+        ext = EXTENSIONS[self.format]
+        n = 0
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            for img in split(proc.stdout):
+                fn = os.path.join(self.destination, self.prefix + "_%06d" % (first_frame + n * self.every) + ext)
+                with perf.timer("writing"), open(fn, "wb") as f:
+                    f.write(img)
+                perf.count("bytes_written", len(img))
+                n += 1
+        if proc.returncode != 0:
+            raise Exception(f"{self.ffmpeg} failed with exit code {proc.returncode}")
+        if expected is not None and n != expected:
+            logging.warning(f"expected {expected} frames from frame {first_frame}, got {n}")
+        return n
+
+    def run(self) -> int:
+        """
+            extracts the frames, returns the number of frames written
+        """
+        os.makedirs(self.destination, exist_ok=True)
+        if self.segments <= 1 and self.start is None and self.end is None:
+            # everything from the start: frame numbers are known without probing the video
+            return self._run(self._command(None, None), 0, None)
+        fps, n_frames = probe_video(self.ffprobe, self.source)
+        plan = plan_segments(fps, n_frames, self.every, self.start, self.end, self.segments)
+        def extract(seg: FrameSegment) -> int:
+            # seek half a frame before the first frame, so rounding can't make us miss it
+            seek = max(0.0, (seg.first_frame - 0.5) / fps)
+            return self._run(self._command(seek if seg.first_frame > 0 else None, seg.count), seg.first_frame, seg.count)
+        with ThreadPoolExecutor(max_workers=max(1, len(plan))) as pool:
+            return sum(pool.map(extract, plan))
+
+
+def clear_directory(path: str) -> None:
+    """
+        removes the files (not the subdirectories or hidden files) in path, creates path if it does not exist
+    """
+    os.makedirs(path, exist_ok=True)
+    for entry in os.scandir(path):
+        if not entry.name.startswith(".") and not entry.is_dir(follow_symlinks=False):
+            os.remove(entry.path)
+
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     args = get_args()
+    if args.perf_metrics:
+        perf.enable()
+    configure_hash_cache_from_args(args)
     pth = os.path.abspath(args.source)
     opth = os.path.abspath(args.destination)
     lineage = DataLineage()
     lineage.add_source(SingleFileLineageSource(pth))
     for k,v in vars(args).items():
-        if type(v) in [int, str, bool, pathlib.Path]:
+        if k in HASH_CACHE_ARGS or k in ("segments", "ffmpeg", "ffprobe", "perf_metrics"):
+            continue
+        if type(v) in [int, str, bool, float, pathlib.Path]:
             lineage.add_param(k,v)
-    lineage_fn = args.destination
+    lineage_fn = str(args.destination.absolute())
     if lineage_fn.endswith("/"):
         lineage_fn = lineage_fn[:-1]
     lineage_fn += "_frames_lineage.yaml"
@@ -31,11 +281,21 @@ def main():
         old_lineage = DataLineage(lineage_fn)
         if lineage.is_uptodate_with(old_lineage):
             print("nothing to do, already done")
+            perf.write_report(args.perf_metrics)
             sys.exit(0)
-    os.system("rm {opth}/*".format(opth=opth))
-    os.system("mkdir -p {opth}".format(opth=opth))
+    clear_directory(opth)
+    if args.stream:
+        n = StreamFrameExtractor(pth, opth, prefix=args.prefix, every=args.every, start=args.start, end=args.end,
+                                 format=args.format, jpeg_qscale=args.jpeg_qscale, segments=args.segments,
+                                 ffmpeg=args.ffmpeg, ffprobe=args.ffprobe).run()
+        print(f"wrote {n} frames")
+        lineage.dump_yaml(lineage_fn)
+        perf.write_report(args.perf_metrics)
+        return
     os.chdir(opth)
-    os.system("ffmpeg -i {a} -vsync 0 tmpframe_%06d.PNG".format(a=pth))
+    returncode = subprocess.run([args.ffmpeg, "-i", pth, "-vsync", "0", "tmpframe_%06d.PNG"]).returncode
+    if returncode != 0:
+        raise Exception(f"{args.ffmpeg} failed with exit code {returncode}")
     lineage.dump_yaml(lineage_fn)
     imgs = [x for x in os.listdir(".") if x.endswith("PNG")]
     framenrs = [int(x.split("_")[1].split(".")[0]) for x in imgs]
@@ -44,10 +304,7 @@ def main():
         for nr,i in zip(framenrs,imgs):
             new_framenr = pfx + "_%06d.PNG" % (nr-1)
             os.rename(i, new_framenr)
+    perf.write_report(args.perf_metrics)
 
 if __name__ == '__main__':
     main()
-
-
-
-
@@ -0,0 +1,247 @@
+"""
+    Sequential reader for zip files that are not seekable (eg a CVAT export piped through stdin).
+
+    zipfile.ZipFile needs the central directory at the end of the file. A zip can also be read front to back: every
+    member is preceded by a local file header with its name, compression method and (usually) its size. Members that
+    were written in streaming mode have no size in the local header (flag bit 3), their size and crc follow the data in
+    a data descriptor; for compressed members the end of the data is found by decompressing it, for stored members by
+    looking for a data descriptor that matches the data before it.
+
+    The compressed data of a member is returned as is, so decompression (decompress_member) can be done in another thread.
+"""
+import bz2
+import hashlib
+import struct
+import zlib
+from typing import Callable, IO, Iterator, Optional
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_LOCAL_HEADER_SIG = 0x04034b50
+_DATA_DESCRIPTOR_SIG = 0x08074b50
+_ZIP64_EXTRA = 0x0001
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+_FLAG_UTF8 = 0x800
+
+STORED = 0
+DEFLATED = 8
+BZIP2 = 12
+
+_CHUNK = 1 << 20
+
+
+class HashingReader(object):
+    """
+        wraps a binary stream and computes the sha256 of everything that was read from it (the same hash as hash_from_file)
+    """
+    def __init__(self, stream: IO[bytes]) -> None:
+        self.stream = stream
+        self.hasher = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.stream.read(n)
+        self.hasher.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def drain(self) -> None:
+        while len(self.read(_CHUNK)) > 0:
+            pass
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+class _Buffer(object):
+    """
+        exact reads on top of a stream, with push back of data that was read too far
+    """
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.pushed = b""
+
+    def read(self, n: int) -> bytes:
+        data = self.pushed[:n]
+        self.pushed = self.pushed[n:]
+        while len(data) < n:
+            more = self.stream.read(n - len(data))
+            if len(more) == 0:
+                break
+            data += more
+        return data
+
+    def read_chunk(self) -> bytes:
+        if len(self.pushed) > 0:
+            data, self.pushed = self.pushed, b""
+            return data
+        return self.stream.read(65536)
+
+    def unread(self, data: bytes) -> None:
+        self.pushed = data + self.pushed
+
+    def read_exact(self, n: int) -> bytes:
+        data = self.read(n)
+        if len(data) != n:
+            raise Exception("unexpected end of zip stream")
+        return data
+
+
+class StreamMember(object):
+    """
+        one member of a zip stream. data is the compressed data, or None if the member was skipped.
+        for members that were decompressed while reading (compressed, with data descriptor), data is the uncompressed data
+        and compress_type is STORED
+    """
+    __slots__ = ("filename", "compress_type", "CRC", "compress_size", "file_size", "data")
+
+    def __init__(self, filename: str, compress_type: int, crc: int, compress_size: int, file_size: int, data: Optional[bytes]) -> None:
+        self.filename = filename
+        self.compress_type = compress_type
+        self.CRC = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.data = data
+
+
+def decompress_member(member: StreamMember) -> bytes:
+    """
+        returns the uncompressed data of member, checking its crc
+    """
+    if member.compress_type == STORED:
+        data = member.data
+    elif member.compress_type == DEFLATED:
+        data = zlib.decompress(member.data, -15)
+    elif member.compress_type == BZIP2:
+        data = bz2.decompress(member.data)
+    else:
+        raise Exception(f"unsupported compression method {member.compress_type} for {member.filename}")
+    if zlib.crc32(data) != member.CRC:
+        raise Exception(f"bad crc for zip member {member.filename}")
+    return data
+
+
+def _zip64_sizes(extra: bytes, compress_size: int, file_size: int):
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from("<HH", extra, pos)
+        if tag == _ZIP64_EXTRA:
+            field = extra[pos + 4:pos + 4 + size]
+            values = []
+            for i in range(0, len(field) - 7, 8):
+                values.append(struct.unpack_from("<Q", field, i)[0])
+            # the zip64 field only contains the sizes that overflowed, uncompressed size first
+            if file_size == 0xFFFFFFFF and len(values) > 0:
+                file_size = values.pop(0)
+            if compress_size == 0xFFFFFFFF and len(values) > 0:
+                compress_size = values.pop(0)
+            return compress_size, file_size, True
+        pos += 4 + size
+    return compress_size, file_size, False
+
+
+def _decompress_until_end(buf: _Buffer, method: int, keep: bool):
+    """
+        decompresses a deflate or bzip2 stream of unknown length. returns (uncompressed data or None, compressed size)
+    """
+    d = zlib.decompressobj(-15) if method == DEFLATED else bz2.BZ2Decompressor()
+    parts = []
+    compressed = 0
+    while not d.eof:
+        chunk = buf.read_chunk()
+        if len(chunk) == 0:
+            raise Exception("unexpected end of zip stream")
+        out = d.decompress(chunk)
+        if keep:
+            parts.append(out)
+        compressed += len(chunk) - len(d.unused_data)
+    buf.unread(d.unused_data)
+    return (b"".join(parts) if keep else None), compressed
+
+
+def _read_stored_until_descriptor(buf: _Buffer, zip64: bool):
+    """
+        reads a stored member of unknown length: the data ends at a data descriptor (with signature) that matches the size
+        and crc of the data before it. returns (data, crc, compress_size, file_size)
+    """
+    fmt = "<IIQQ" if zip64 else "<IIII"
+    desc_len = struct.calcsize(fmt)
+    sig = struct.pack("<I", _DATA_DESCRIPTOR_SIG)
+    data = bytearray()
+    search_from = 0
+    while True:
+        pos = data.find(sig, search_from)
+        if pos >= 0 and len(data) >= pos + desc_len:
+            _sig, crc, compress_size, file_size = struct.unpack_from(fmt, data, pos)
+            if compress_size == pos and file_size == pos and zlib.crc32(data[:pos]) == crc:
+                buf.unread(bytes(data[pos + desc_len:]))
+                return bytes(data[:pos]), crc, compress_size, file_size
+            search_from = pos + 1
+            continue
+        if pos < 0:
+            search_from = max(0, len(data) - 3)
+        chunk = buf.read_chunk()
+        if len(chunk) == 0:
+            raise Exception("unexpected end of zip stream")
+        data += chunk
+
+
+def _read_data_descriptor(buf: _Buffer, zip64: bool):
+    sig = buf.read_exact(4)
+    if struct.unpack("<I", sig)[0] != _DATA_DESCRIPTOR_SIG:
+        # the signature is optional
+        buf.unread(sig)
+    if zip64:
+        return struct.unpack("<IQQ", buf.read_exact(20))
+    return struct.unpack("<III", buf.read_exact(12))
+
+
+def _skip(buf: _Buffer, n: int) -> None:
+    while n > 0:
+        data = buf.read(min(n, _CHUNK))
+        if len(data) == 0:
+            raise Exception("unexpected end of zip stream")
+        n -= len(data)
+
+
+def iter_members(stream: IO[bytes], want: Callable[[str], bool] = lambda name: True) -> Iterator[StreamMember]:
+    """
+        yields the members of the zip in stream, in the order they are stored. only the data of members for which
+        want(filename) is true is kept. stops at the central directory, the rest of the stream is not read
+        (use HashingReader.drain if the whole stream needs to be consumed).
+    """
+    buf = _Buffer(stream)
+    while True:
+        header = buf.read(_LOCAL_HEADER.size)
+        if len(header) < _LOCAL_HEADER.size or struct.unpack_from("<I", header)[0] != _LOCAL_HEADER_SIG:
+            # central directory (or anything else after the last member)
+            buf.unread(header)
+            return
+        (_sig, _version, flags, method, _time, _date, crc, compress_size, file_size,
+         name_len, extra_len) = _LOCAL_HEADER.unpack(header)
+        raw_name = buf.read_exact(name_len)
+        extra = buf.read_exact(extra_len)
+        filename = raw_name.decode("utf-8" if flags & _FLAG_UTF8 else "cp437")
+        compress_size, file_size, zip64 = _zip64_sizes(extra, compress_size, file_size)
+        if flags & _FLAG_ENCRYPTED:
+            raise Exception(f"encrypted zip member {filename} is not supported")
+        keep = want(filename)
+        if flags & _FLAG_DATA_DESCRIPTOR:
+            if method == STORED:
+                data, crc, compress_size, file_size = _read_stored_until_descriptor(buf, zip64)
+                yield StreamMember(filename, STORED, crc, compress_size, file_size, data if keep else None)
+                continue
+            if method not in (DEFLATED, BZIP2):
+                raise Exception(f"cannot stream zip member {filename}: size unknown and unsupported compression method {method}")
+            data, compressed = _decompress_until_end(buf, method, keep)
+            crc, compress_size, file_size = _read_data_descriptor(buf, zip64)
+            if compressed != compress_size:
+                raise Exception(f"corrupt zip stream at member {filename}")
+            yield StreamMember(filename, STORED, crc, compress_size, file_size, data)
+            continue
+        if keep:
+            data = buf.read_exact(compress_size)
+        else:
+            _skip(buf, compress_size)
+            data = None
+        yield StreamMember(filename, method, crc, compress_size, file_size, data)